@@ -15,7 +15,7 @@ manage the Windows Routing table plus multiple iPerf sessions when trying to tes
 
 To use the script, the user must pass the path to a valid configuration file as the only parameter to the script. (see ConfigExample.ini). This
 configuration file contains all details necessary to form the iPerf test string and log into the FTP server.
-The script will first obtain a list of the active interfaces and their IP addresses from the system using the Windows Management Instrumentation framework (WMI).
+The script will first obtain a list of the active interfaces and their IP addresses from the system, using the Windows Management Instrumentation framework (WMI) on Windows or netlink on Linux.
 Using this information, plus the FTP server and test config entered by the user, it will then form the iPerf strings, and execute them on both the 
 local machine and the remote server. As of version 1.0, logging is now supported as well as TCP testing!!
 
@@ -30,6 +30,11 @@ Handles command line arguments and exception handling. Calls the initialize() fu
 initialize()
 Creates a new instance of SysEnvironment, then creates a new instance of TestInstance using the SysEnvironment instance, and the path to the config file.
 Then runs the run_test() method of the newly created TestInstance object.
+With --search, it runs a ThroughputSearch instead, which finds the highest UDP rate each UE sustains, and prints the results.
+With --sweep, it runs a Sweep instead, which runs every combination of the values in the config's [Sweep] section as a
+test of its own, back to back, and prints the results of them all.
+With --trace, the stages of the test (from the config parse on) are traced, and written out as a Chrome trace (see Tracing.py);
+with --sweep, each cell's trace is written with that cell's logs, and with --search, the search's with the search's logs.
 
 @author:     Oliver Thomas
 
@@ -48,6 +53,9 @@ import sys
 
 from loadtest.SysEnvironment import SysEnvironment
 from loadtest.TestInstance import TestInstance
+from loadtest.ThroughputSearch import ThroughputSearch
+from loadtest.Sweep import Sweep
+from loadtest import Tracing
 
 
 __all__ = []
@@ -106,6 +114,13 @@ USAGE
         # Setup argument parser
         parser = ArgumentParser(description=program_license, formatter_class=RawDescriptionHelpFormatter)
         parser.add_argument('-V', '--version', action='version', version=program_version_message)
+        parser.add_argument('-s', '--search', action='store_true',
+                            help="search for the highest UDP rate each UE sustains, instead of running the test")
+        parser.add_argument('-w', '--sweep', action='store_true',
+                            help="run a test for every combination of the values in the config's [Sweep] section, "
+                            "carrying on from where an interrupted sweep stopped")
+        parser.add_argument('-t', '--trace', action='store_true',
+                            help="trace the stages of the test, and write them to trace.json with the logs")
         parser.add_argument(dest="path", help="path to Test Config File test#.ini", metavar="path")
     
         # Process arguments
@@ -113,7 +128,7 @@ USAGE
     
         config_file = args.path
     
-        initialize(config_file)
+        initialize(config_file, args.search, args.trace, args.sweep)
         
         return 0
     except Exception, e:
@@ -124,12 +139,23 @@ USAGE
         sys.stderr.write(indent + "  for help use --help")
         return 2
     
-def initialize(config_file):
+def initialize(config_file, search=False, trace=False, sweep=False):
     '''
     Instantiate SysEnvironment (which will hold current interface and IP address information)
     '''
     
+    if trace: Tracing.enable()
     env = SysEnvironment()
+    if search:
+        throughput_search = ThroughputSearch(config_file, env)
+        throughput_search.run()
+        print throughput_search.get_report()
+        return
+    if sweep:
+        test_sweep = Sweep(config_file, env)
+        test_sweep.run()
+        print test_sweep.get_report()
+        return
     test = TestInstance(config_file, env)
     test.run_test()
 
@@ -0,0 +1,401 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.Benchmark measures the overhead of the orchestration itself (TestInstance, the SSH pool, the run engine etc.),
+without any network or real iperf in the way. The real code is run against a stand-in iperf shell script and an SSH
+server running inside the benchmark, on loopback, for a range of UE counts. The results are written as JSON so that they
+can be compared from one release to the next.
+
+Usage (Linux, or anything else with a POSIX shell):
+    python -m loadtest.Benchmark [--ues 1,8,64,256] [--duration 3] [--output results.json] [--compare previous.json]
+
+Benchmark.py implements the LoopbackSSHServer and BenchmarkBackend classes, and the benchmark functions.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import logging
+import tempfile
+import resource
+import threading
+import subprocess
+from argparse import ArgumentParser, SUPPRESS
+
+import paramiko
+
+# Stand-in for iperf. Prints the 'Server listening' line of a server as iperf does, then one report a second (servers
+# until they are killed, clients for -t seconds), and logs when it starts and exits so the benchmark can work out the
+# start skew and teardown time:
+FAKE_IPERF = '''#!/bin/sh
+server=0; t=10; port=5001; proto=TCP
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -s) server=1 ;;
+        -t) t=$2; shift ;;
+        -p) port=$2; shift ;;
+        -u) proto=UDP ;;
+    esac
+    shift
+done
+echo "`date +%s.%N` start $server $$" >> "$LOADTEST_BENCH_LOG"
+echo "------------------------------------------------------------"
+if [ $server = 1 ]; then
+    echo "Server listening on $proto port $port"
+    echo "------------------------------------------------------------"
+fi
+i=0
+while [ $server = 1 ] || [ $i -lt $t ]; do
+    # (sleep's output is redirected so it doesn't hold the pipe open after this script is killed)
+    sleep 1 >/dev/null 2>&1
+    echo "[  3] $i.0-`expr $i + 1`.0 sec   128 KBytes  1049 Kbits/sec"
+    i=`expr $i + 1`
+done
+echo "[  3]  0.0-$t.0 sec  `expr 128 \\* $t` KBytes  1049 Kbits/sec"
+echo "`date +%s.%N` exit $server $$" >> "$LOADTEST_BENCH_LOG"
+'''
+
+# Order of the metrics in the comparison table:
+METRICS = ('config_parse_s', 'ssh_connect_mean_s', 'ssh_connect_max_s', 'channel_open_mean_s', 'first_start_s',
+           'start_skew_s', 'teardown_s', 'total_s', 'peak_rss_kb', 'peak_threads')
+
+
+class LoopbackSSHServer(paramiko.ServerInterface): #{
+    '''
+    class LoopbackSSHServer(paramiko.ServerInterface):
+    Sub-class of:                    paramiko.ServerInterface
+    Private instance variables:
+        __key = Host key, generated for the run
+        __sock = Listening socket on 127.0.0.1
+        __transports = List of the paramiko.Transport of every connection accepted
+        __processes = List of the subprocess.Popen of every command run
+        __lock = threading.Lock guarding __transports and __processes
+
+    Overview:
+    A minimal SSH server: any username and password is accepted, and every exec request is run with sh -c, its output
+    sent back on the channel followed by its exit status, the same as OpenSSH without a terminal. There is no limit on
+    the number of sessions per connection.
+
+    Public methods:
+    start(self):
+    Starts accepting connections on a background thread.
+
+    get_port(self):
+    Returns the port the server is listening on.
+
+    kill_processes(self):
+    Kills every command that is still running.
+
+    stop(self):
+    Stops accepting connections, and closes the open ones.
+
+    '''
+
+    def __init__(self): #{
+        '''
+        Constructor
+        '''
+        self.__key = paramiko.RSAKey.generate(1024)
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__sock.bind(('127.0.0.1', 0))
+        self.__sock.listen(1024)
+        self.__transports = []
+        self.__processes = []
+        self.__lock = threading.Lock()
+    #} End method __init__
+
+    def start(self): #{
+        acceptor = threading.Thread(target=self.__accept)
+        acceptor.setName('ssh-server')
+        acceptor.setDaemon(True)
+        acceptor.start()
+    #} End method start
+
+    def get_port(self): #{
+        return self.__sock.getsockname()[1]
+    #} End method get_port
+
+    def kill_processes(self): #{
+        with self.__lock:
+            processes = self.__processes
+            self.__processes = []
+        for process in processes:
+            if process.poll() is None: process.kill()
+    #} End method kill_processes
+
+    def stop(self): #{
+        self.__sock.close()
+        with self.__lock:
+            for transport in self.__transports:
+                transport.close()
+            self.__transports = []
+        self.kill_processes()
+    #} End method stop
+
+    # paramiko.ServerInterface methods:
+    def get_allowed_auths(self, username): #{
+        return 'password'
+    #} End method get_allowed_auths
+
+    def check_auth_password(self, username, password): #{
+        return paramiko.AUTH_SUCCESSFUL
+    #} End method check_auth_password
+
+    def check_channel_request(self, kind, chanid): #{
+        if kind == 'session': return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+    #} End method check_channel_request
+
+    def check_channel_exec_request(self, channel, command): #{
+        runner = threading.Thread(target=self.__run, args=[channel, command])
+        runner.setDaemon(True)
+        runner.start()
+        return True
+    #} End method check_channel_exec_request
+
+    def __accept(self): #{
+        while True:
+            try:
+                conn, _ = self.__sock.accept()
+            except socket.error:
+                return # stop() closed the socket
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.__key)
+            with self.__lock:
+                self.__transports.append(transport)
+            transport.start_server(server=self)
+    #} End method __accept
+
+    def __run(self, channel, command): #{
+        devnull = open(os.devnull, 'w')
+        process = subprocess.Popen(['sh', '-c', command], stdout=subprocess.PIPE, stderr=devnull, close_fds=True)
+        with self.__lock:
+            self.__processes.append(process)
+        is_open = True
+        while True:
+            data = os.read(process.stdout.fileno(), 4096)
+            if not data: break
+            # Keep reading after the client has closed the channel, so the process never blocks on a full pipe:
+            if is_open:
+                try:
+                    channel.sendall(data)
+                except Exception:
+                    is_open = False
+        status = process.wait()
+        devnull.close()
+        try:
+            channel.send_exit_status(status if status >= 0 else 128 - status)
+            channel.close()
+        except Exception:
+            pass
+    #} End method __run
+#} End class LoopbackSSHServer
+
+
+class BenchmarkBackend(object): #{
+    '''
+    class BenchmarkBackend(object):
+    Sub-class of:                    object
+
+    Overview:
+    Interface backend for SysEnvironment (see InterfaceBackends.py) with one loopback 'interface' per UE: UE1, UE2 etc.
+
+    Public methods:
+    enumerate(self):
+    Returns the (name, interface index, IPv4 address) tuples of the UEs.
+
+    '''
+
+    def __init__(self, ues): #{
+        '''
+        Constructor:
+            ues = number of UEs
+        '''
+        self.__ues = ues
+    #} End method __init__
+
+    def enumerate(self): #{
+        return [('UE' + str(n), n, '127.0.0.1') for n in range(1, self.__ues + 1)]
+    #} End method enumerate
+#} End class BenchmarkBackend
+
+
+def write_config(path, ues, duration, ssh_port, logdir): #{
+    '''
+    Writes a test config for the given number of UEs, each running a simultaneous DL and UL test for duration seconds
+    '''
+    config = open(path, 'w')
+    config.write('[Globals]\nbaselogdir: ' + logdir + '\nlogging: 0\nlogprefix: Benchmark-\n')
+    for n in range(1, ues + 1):
+        config.write('\n[UE' + str(n) + ']\nueId: ' + str(n) + '\ntestType: SIM\ntrafficType: TCP\n' +
+                     'adapterName: UE' + str(n) + '\nt0: 0\nt1: ' + str(duration) + '\nt2: ' + str(duration) + '\n' +
+                     'ftpServer: 127.0.0.1,benchmark,benchmark,' + str(ssh_port) + '\n')
+    config.close()
+#} End method write_config
+
+
+def run_one(ues, duration, config_path, bench_log): #{
+    '''
+    Runs one test with the real TestInstance and returns its metrics. Run in a process of its own (see run_all), so that
+    the peak RSS and thread count are for this test only.
+    '''
+    from loadtest.SysEnvironment import SysEnvironment
+    from loadtest.TestInstance import TestInstance
+
+    peak = {'threads': threading.active_count()}
+    done = threading.Event()
+
+    def sample_threads():
+        while not done.wait(0.01):
+            peak['threads'] = max(peak['threads'], threading.active_count())
+    sampler = threading.Thread(target=sample_threads)
+    sampler.setDaemon(True)
+    sampler.start()
+
+    env = SysEnvironment(BenchmarkBackend(ues))
+    start = time.time()
+    test = TestInstance(config_path, env)
+    config_parse = time.time() - start
+    run_start = time.time()
+    test.run_test()
+    run_end = time.time()
+    done.set()
+
+    # The stand-in iperfs log lines of '<time> start|exit <is server> <pid>':
+    client_starts = []
+    client_exits = []
+    for line in open(bench_log):
+        fields = line.split()
+        if len(fields) != 4 or fields[2] != '0': continue
+        if fields[1] == 'start': client_starts.append(float(fields[0]))
+        if fields[1] == 'exit': client_exits.append(float(fields[0]))
+
+    handshakes = []
+    channel_opens = []
+    for stats in test.get_pool_stats().values():
+        handshakes.extend(stats['handshake'])
+        channel_opens.extend(stats['channel_open'])
+
+    result = {'ues': ues, 'duration_s': duration, 'config_parse_s': config_parse, 'total_s': run_end - run_start,
+              'clients_started': len(client_starts),
+              # Linux reports ru_maxrss in KB:
+              'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              'peak_threads': peak['threads']}
+    if handshakes:
+        result['ssh_connect_mean_s'] = sum(handshakes) / len(handshakes)
+        result['ssh_connect_max_s'] = max(handshakes)
+    if channel_opens:
+        result['channel_open_mean_s'] = sum(channel_opens) / len(channel_opens)
+    if client_starts:
+        # From run_test being called to the first client starting (sweep, port checks, SSH connects etc.):
+        result['first_start_s'] = min(client_starts) - run_start
+        # Every client is due at t0, so any spread in their start times is overhead:
+        result['start_skew_s'] = max(client_starts) - min(client_starts)
+    if client_exits:
+        # From the last client finishing its traffic to run_test returning:
+        result['teardown_s'] = run_end - max(client_exits)
+    return result
+#} End method run_one
+
+
+def run_all(ue_counts, duration): #{
+    '''
+    Runs the benchmark for each UE count, each in a new process, against one SSH server in this process.
+    Returns the list of results.
+    '''
+    workdir = tempfile.mkdtemp(prefix='loadtest-benchmark-')
+    bindir = os.path.join(workdir, 'bin')
+    os.mkdir(bindir)
+    fake_iperf = os.path.join(bindir, 'iperf')
+    script = open(fake_iperf, 'w')
+    script.write(FAKE_IPERF)
+    script.close()
+    os.chmod(fake_iperf, 0755)
+
+    # The SSH server's commands and the test's local processes both find the stand-in iperf first on the PATH:
+    os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+    server = LoopbackSSHServer()
+    server.start()
+    results = []
+    try:
+        for ues in ue_counts:
+            config_path = os.path.join(workdir, 'benchmark_' + str(ues) + '.ini')
+            bench_log = os.path.join(workdir, 'benchmark_' + str(ues) + '.log')
+            open(bench_log, 'w').close()
+            write_config(config_path, ues, duration, server.get_port(), workdir)
+            os.environ['LOADTEST_BENCH_LOG'] = bench_log
+            child = subprocess.Popen([sys.executable, '-m', 'loadtest.Benchmark', '--child', str(ues),
+                                      '--duration', str(duration), '--config', config_path], stdout=subprocess.PIPE)
+            output = child.communicate()[0]
+            server.kill_processes()
+            if child.returncode != 0:
+                logging.warning('Benchmark for ' + str(ues) + ' UEs failed with exit status ' + str(child.returncode))
+                continue
+            result = json.loads(output.strip().splitlines()[-1])
+            sys.stderr.write('UEs = ' + str(ues) + ': ' + json.dumps(result, sort_keys=True) + '\n')
+            results.append(result)
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+#} End method run_all
+
+
+def compare(previous, current): #{
+    '''
+    Returns a printable table of the change in every metric between two sets of results
+    '''
+    previous_by_ues = dict([(result['ues'], result) for result in previous])
+    table = ''
+    for result in current:
+        old = previous_by_ues.get(result['ues'])
+        if old is None: continue
+        table = table + 'UEs = ' + str(result['ues']) + '\n'
+        for metric in METRICS:
+            if metric not in result or metric not in old: continue
+            change = ''
+            if old[metric]: change = '%+.1f%%' % (100.0 * (result[metric] - old[metric]) / old[metric])
+            table = table + '    %-20s %12.4f %12.4f %10s\n' % (metric, old[metric], result[metric], change)
+    return table
+#} End method compare
+
+
+def main(): #{
+    parser = ArgumentParser(description='Measures the orchestration overhead of the load test script')
+    parser.add_argument('--ues', default='1,8,64,256', help='comma-separated list of UE counts (default 1,8,64,256)')
+    parser.add_argument('--duration', type=int, default=3, help='test duration in seconds (default 3)')
+    parser.add_argument('--output', help='file to write the JSON results to (default stdout)')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--child', type=int, help=SUPPRESS)
+    parser.add_argument('--config', help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print json.dumps(run_one(args.child, args.duration, args.config, os.environ['LOADTEST_BENCH_LOG']))
+        return 0
+
+    results = run_all([int(ues) for ues in args.ues.split(',')], args.duration)
+    report = {'python': sys.version.split()[0], 'platform': sys.platform, 'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+              'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+    if args.output:
+        output = open(args.output, 'w')
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.close()
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+    if args.compare:
+        sys.stderr.write(compare(json.load(open(args.compare))['results'], results))
+    return 0
+#} End method main
+
+
+if __name__ == '__main__':
+    sys.exit(main())
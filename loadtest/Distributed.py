@@ -0,0 +1,478 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.Distributed runs one test over several test machines, each with its own UEs: a controller hands each agent its
+slice of the test, starts all the agents at the same moment, and merges the results they stream back as the test runs.
+Start an agent on each test machine with:
+    python -m loadtest.Distributed [--port 7000] [--workdir DIR] [--trace]
+then run the test as normal on the controller, with the agents listed in the Globals 'agents' item and each UE's
+'agent' item saying which of them its adapter is on.
+
+Distributed.py implements the Controller, Agent and Connection classes and methods, as well as the main() function.
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import tempfile
+from threading import Thread, Event, Lock
+from argparse import ArgumentParser
+
+from loadtest.RunEngine import monotonic
+from loadtest.TestPlan import to_str
+from loadtest import Tracing
+
+DEFAULT_PORT = 7000
+# Each agent allocates its iperf server ports from its own block, so agents sharing a test server (or a machine) can't
+# collide: agent n gets PORT_BASE + n * PORT_BLOCK up to the next block.
+PORT_BASE = 5000
+PORT_BLOCK = 1000
+# Round trips used to measure each agent's clock offset, the one with the lowest round trip time is kept:
+SYNC_SAMPLES = 8
+# Seconds between the last agent being ready and the start of the test, for the start messages to get through:
+START_DELAY = 2.0
+# Seconds between the interval reports streamed to the controller:
+STREAM_INTERVAL = 1.0
+# The series columns sent in each interval report, in ThroughputSeries.append order:
+INTERVAL_COLUMNS = ('start', 'end', 'kbytes', 'kbps', 'jitter', 'lost', 'total', 'stream')
+
+
+class Connection(object): #{
+    '''
+    class Connection(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __sock = The connected socket
+        __reader = File object reading the socket a line at a time
+        __lock = threading.Lock so that messages sent from different threads don't get interleaved
+
+    Overview:
+    Messages are JSON objects, one per line, each with a 'type'.
+
+    Public methods:
+    send(self, message):
+    Sends a message (a dict). Thread safe.
+
+    receive(self):
+    Returns the next message, or None if the other end has closed the connection.
+
+    close(self):
+    Closes the connection.
+
+    '''
+
+    def __init__(self, sock): #{
+        '''
+        Constructor:
+            sock = connected socket
+        '''
+        self.__sock = sock
+        self.__reader = sock.makefile('rb')
+        self.__lock = Lock()
+    #} End method __init__
+
+    def send(self, message): #{
+        data = json.dumps(message) + '\n'
+        with self.__lock:
+            self.__sock.sendall(data)
+    #} End method send
+
+    def receive(self): #{
+        line = self.__reader.readline()
+        if not line: return None
+        return to_str(json.loads(line))
+    #} End method receive
+
+    def close(self): #{
+        try:
+            self.__sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.__reader.close()
+        self.__sock.close()
+    #} End method close
+#} End class Connection
+
+
+class Controller(object): #{
+    '''
+    class Controller(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __agents = List of the agents' host:port strings
+        __config_file = Path of the config file, which is sent to every agent as it is
+        __slices = Dictionary of agent to the list of adapter names of its UEs
+        __series = SeriesStore the agents' reports are merged into
+        __connections = Dictionary of agent to its Connection
+        __ready = Dictionary of agent to its (offset, round trip time) once it is ready to start
+        __done = Dictionary of agent to True if its test ran to completion, False if it was interrupted
+        __errors = Dictionary of agent to the error that stopped it
+        __reports = Dictionary of agent to its SSH pool report
+        __changed = threading.Event set whenever an agent becomes ready, finishes or fails
+        __started = threading.Event set once the start time has been sent to the agents
+
+    Overview:
+    The controller connects to every agent and sends it the config file and the names of its UEs (every UE has an
+    'agent' item naming one of the Globals 'agents'), with the block of ports it is to use. Each agent builds, checks
+    and connects its slice of the test as a normal run would (see TestInstance.py), then measures the offset of its
+    clock from the controller's NTP style, over a few round trips to the controller, and says it is ready.
+    Once every agent is ready, the controller sends them all the same start time, START_DELAY seconds on, in its own
+    clock. Each agent works out when that is in its own clock and starts its RunEngine then, so all the phases
+    of every agent start together, to within the error of the offset (about half the round trip time).
+    While the test runs, each agent streams the new interval reports of its series every STREAM_INTERVAL seconds, and
+    they are added to the controller's SeriesStore, so the ResultsStore, MetricsExporter and summary.csv all work on
+    the controller as they do for a local test. The iperf logs stay on the agents.
+    If anything goes wrong with one agent before the start, the others are stopped and a RuntimeError is raised. Ctrl-C
+    on the controller (or an agent dropping out once started) stops all the agents, which tear down as interrupted.
+    Several agents can run on one machine for testing, each on its own port.
+
+    Public methods:
+    run(self):
+    Runs the test on the agents. Returns True if every agent ran to completion, False if the test was interrupted.
+
+    get_report(self):
+    Returns the clock offset, round trip time and SSH pool report of every agent.
+
+    '''
+
+    def __init__(self, agents, config_file, ue_configs, series): #{
+        '''
+        Constructor:
+            agents = list of agent host:port strings
+            config_file = path of the config file
+            ue_configs = list of UE config dicts from TestConfig
+            series = SeriesStore to merge the agents' reports into
+        '''
+        self.__agents = agents
+        self.__config_file = config_file
+        self.__slices = dict([(agent, []) for agent in agents])
+        for ue_config in ue_configs:
+            agent = ue_config.get('agent')
+            if agent not in self.__slices:
+                raise ValueError(ue_config['adaptername'] + ': the agent item must be one of the Globals agents (' +
+                                 ', '.join(agents) + '), not ' + str(agent))
+            self.__slices[agent].append(ue_config['adaptername'])
+        self.__series = series
+        self.__connections = {}
+        self.__ready = {}
+        self.__done = {}
+        self.__errors = {}
+        self.__reports = {}
+        self.__changed = Event()
+        self.__started = Event()
+    #} End method __init__
+
+    def run(self): #{
+        config_file = open(self.__config_file, 'rb')
+        config = config_file.read()
+        config_file.close()
+        agents = [agent for agent in self.__agents if self.__slices[agent]]
+        threads = []
+        for index, agent in enumerate(agents):
+            plan = {'type': 'plan', 'config': config, 'ues': self.__slices[agent],
+                    'port_base': PORT_BASE + index * PORT_BLOCK, 'port_limit': PORT_BASE + (index + 1) * PORT_BLOCK - 1}
+            t = Thread(target=self.__serve_agent, args=[agent, plan])
+            t.setName('agent-' + agent)
+            t.setDaemon(True)
+            threads.append(t)
+            t.start()
+
+        try:
+            # Wait for every agent to be ready (or for one of them to fail), waking up now and again for Ctrl-C:
+            while len(self.__ready) < len(agents) and not self.__errors:
+                self.__changed.wait(0.5)
+                self.__changed.clear()
+            if self.__errors:
+                self.__stop_all()
+                self.__join(threads)
+                raise RuntimeError('The test could not be started on every agent:\n  ' + '\n  '.join(
+                    [agent + ': ' + error for agent, error in sorted(self.__errors.items())]))
+            start = time.time() + START_DELAY + max([rtt for _, rtt in self.__ready.values()])
+            logging.debug('Starting ' + str(len(agents)) + ' agents at ' + repr(start))
+            self.__started.set()
+            for agent in agents:
+                self.__connections[agent].send({'type': 'start', 'time': start})
+            self.__join(threads)
+        except KeyboardInterrupt:
+            logging.warning('Process interrupted by user, waiting for the agents to tear down...\n')
+            self.__stop_all()
+            while True:
+                try:
+                    self.__join(threads)
+                    break
+                except KeyboardInterrupt:
+                    continue
+            return False
+        for agent, error in sorted(self.__errors.items()):
+            logging.warning('Agent ' + agent + ' failed: ' + error)
+        return len(self.__done) == len(agents) and all(self.__done.values())
+    #} End method run
+
+    def get_report(self): #{
+        report = ''
+        for agent in self.__agents:
+            if agent not in self.__ready: continue
+            offset, rtt = self.__ready[agent]
+            report += 'Agent ' + agent + ': clock offset %.1f ms, round trip %.1f ms\n' % (offset * 1000, rtt * 1000)
+            report += self.__reports.get(agent, '')
+        return report
+    #} End method get_report
+
+    def __join(self, threads): #{
+        # Join with a timeout, so that Ctrl-C gets through:
+        for t in threads:
+            while t.isAlive():
+                t.join(0.5)
+    #} End method __join
+
+    def __stop_all(self): #{
+        for agent, connection in self.__connections.items():
+            try:
+                connection.send({'type': 'stop'})
+            except socket.error:
+                pass
+    #} End method __stop_all
+
+    def __serve_agent(self, agent, plan): #{
+        host, _, port = agent.rpartition(':')
+        try:
+            connection = Connection(socket.create_connection((host, int(port)), 10))
+        except (socket.error, ValueError), e:
+            self.__errors[agent] = 'could not connect: ' + str(e)
+            self.__changed.set()
+            return
+        self.__connections[agent] = connection
+        try:
+            connection.send(plan)
+            while True:
+                message = connection.receive()
+                if message is None:
+                    self.__errors[agent] = 'connection closed by the agent'
+                    break
+                if message['type'] == 'time':
+                    connection.send({'type': 'time', 'time': time.time()})
+                elif message['type'] == 'ready':
+                    self.__ready[agent] = (message['offset'], message['rtt'])
+                    logging.debug('Agent ' + agent + ' ready, clock offset ' + str(message['offset']))
+                elif message['type'] == 'intervals':
+                    series = self.__series.get_series(*message['key'])
+                    for row in message['rows']:
+                        series.append(*row)
+                elif message['type'] == 'done':
+                    for key, outages, busy, start_skew, tcp, summary_records in message['series']:
+                        series = self.__series.get_series(*key)
+                        series.start_skew = start_skew
+                        series.tcp = tcp
+                        for start, end in outages: series.mark_outage(start, end)
+                        for start, end in busy: series.mark_busy(start, end)
+                        for record in summary_records: series.append_summary(*record)
+                    self.__reports[agent] = message['report']
+                    self.__done[agent] = message['completed']
+                    break
+                elif message['type'] == 'error':
+                    self.__errors[agent] = message['message']
+                    break
+                self.__changed.set()
+        except (socket.error, ValueError), e:
+            self.__errors[agent] = str(e)
+        finally:
+            # An agent that drops out once the test has started stops the rest, as Ctrl-C would:
+            if agent in self.__errors and self.__started.is_set():
+                self.__stop_all()
+            connection.close()
+            self.__changed.set()
+    #} End method __serve_agent
+#} End class Controller
+
+
+class Agent(object): #{
+    '''
+    class Agent(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __env = SysEnvironment of this machine
+        __port = TCP port to listen for the controller on
+        __workdir = Directory the controller's config files (and their cached test plans) are written to
+
+    Overview:
+    The agent runs one test at a time for whichever controller connects to it, until it is killed. Each test is run by
+    a TestInstance for the agent's slice of the UEs, exactly as if it had been started here, except that it waits for
+    the controller's start time once it is connected to the test servers, and that the results database and metrics
+    are left to the controller.
+    See Controller for the messages that go between them.
+
+    Public methods:
+    serve_forever(self):
+    Listens for the controller and runs its tests.
+
+    '''
+
+    def __init__(self, env, port=DEFAULT_PORT, workdir=None): #{
+        '''
+        Constructor:
+            env = SysEnvironment of this machine
+            port = TCP port to listen on
+            workdir = directory for the config files, the system temporary directory if None
+        '''
+        self.__env = env
+        self.__port = port
+        self.__workdir = workdir if workdir is not None else tempfile.gettempdir()
+    #} End method __init__
+
+    def serve_forever(self): #{
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('', self.__port))
+        listener.listen(1)
+        logging.warning('Agent listening on port ' + str(self.__port))
+        try:
+            while True:
+                sock, address = listener.accept()
+                logging.warning('Running a test for the controller at ' + address[0])
+                connection = Connection(sock)
+                try:
+                    self.run_test(connection)
+                except socket.error, e:
+                    logging.warning('Lost the controller: ' + str(e))
+                finally:
+                    connection.close()
+        finally:
+            listener.close()
+    #} End method serve_forever
+
+    def run_test(self, connection): #{
+        '''
+        Runs one test for the controller on the other end of connection
+        '''
+        # Imported here, as TestInstance imports this module:
+        from loadtest.TestInstance import TestInstance
+        plan = connection.receive()
+        if plan is None or plan['type'] != 'plan': return
+        config_file = os.path.join(self.__workdir, 'agent_' + str(self.__port) + '.ini')
+        config_out = open(config_file, 'wb')
+        config_out.write(plan['config'])
+        config_out.close()
+        # Each test gets a trace of its own, written with the test's logs:
+        if Tracing.is_enabled(): Tracing.enable()
+
+        try:
+            test = TestInstance(config_file, self.__env, plan['ues'], plan['port_base'], plan['port_limit'])
+        except Exception, e:
+            connection.send({'type': 'error', 'message': str(e)})
+            return
+        stop = Event()
+        written = {}
+        streamer = Thread(target=self.__stream_loop, args=[connection, test.get_series_store(), written, stop])
+        streamer.setName('agent-stream')
+        streamer.setDaemon(True)
+        streamer.start()
+        try:
+            completed = test.run_test(lambda: self.__wait_for_start(connection, test, stop))
+        except Exception, e:
+            connection.send({'type': 'error', 'message': str(e)})
+            return
+        finally:
+            stop.set()
+            streamer.join()
+        self.__stream(connection, test.get_series_store(), written)
+        series = [((s.ue, s.phase, s.direction, s.role), s.outages, s.busy, s.start_skew, s.tcp,
+                   s.summary_records)
+                  for s in test.get_series_store().get_all_series()]
+        connection.send({'type': 'done', 'series': series, 'report': test.get_pool_report(), 'completed': completed})
+    #} End method run_test
+
+    def __wait_for_start(self, connection, test, stop): #{
+        # Called by the TestInstance once it is connected to all its test servers. Measures the clock offset from the
+        # controller (controller clock - this clock), waits for the start time and then until it comes round:
+        best = None
+        for _ in range(SYNC_SAMPLES):
+            sent = time.time()
+            connection.send({'type': 'time'})
+            reply = connection.receive()
+            received = time.time()
+            if reply is None: raise socket.error('connection closed by the controller')
+            rtt = received - sent
+            offset = reply['time'] - (sent + received) / 2.0
+            if best is None or rtt < best[1]: best = (offset, rtt)
+        offset, rtt = best
+        connection.send({'type': 'ready', 'offset': offset, 'rtt': rtt})
+        message = connection.receive()
+        if message is None or message['type'] != 'start':
+            test.interrupt()
+            return
+        # From here on only the monotonic clock is used, so a jump in the wall clock can't move the start:
+        deadline = monotonic() + message['time'] - offset - time.time()
+        if deadline < monotonic(): logging.warning('The start time had passed when it was received, starting now')
+        listener = Thread(target=self.__listen, args=[connection, test, stop])
+        listener.setName('agent-listen')
+        listener.setDaemon(True)
+        listener.start()
+        while monotonic() < deadline and not test.is_interrupted():
+            time.sleep(min(0.1, max(0, deadline - monotonic())))
+        logging.debug('Started at ' + repr(time.time() + offset) + ' in the controller clock, for ' + repr(message['time']))
+    #} End method __wait_for_start
+
+    def __listen(self, connection, test, stop): #{
+        # Once the test has started, the only message is 'stop', and losing the controller stops the test too (unless it
+        # has already finished):
+        try:
+            message = connection.receive()
+        except (socket.error, ValueError):
+            message = None
+        if stop.is_set(): return
+        if message is None or message['type'] == 'stop':
+            logging.warning('Test stopped by the controller')
+            test.interrupt()
+    #} End method __listen
+
+    def __stream_loop(self, connection, series_store, written, stop): #{
+        while not stop.wait(STREAM_INTERVAL):
+            try:
+                self.__stream(connection, series_store, written)
+            except socket.error, e:
+                logging.warning('Could not send the interval reports to the controller: ' + str(e))
+                return
+    #} End method __stream_loop
+
+    def __stream(self, connection, series_store, written): #{
+        for series in series_store.get_all_series():
+            key = (series.ue, series.phase, series.direction, series.role)
+            # The capture threads append to the columns one at a time, and stream is always the last, so every column has
+            # at least this many entries:
+            count = len(series.columns['stream'])
+            first = written.get(key, 0)
+            if count <= first: continue
+            rows = [[series.columns[name][row] for name in INTERVAL_COLUMNS] for row in xrange(first, count)]
+            connection.send({'type': 'intervals', 'key': key, 'rows': rows})
+            written[key] = count
+    #} End method __stream
+#} End class Agent
+
+
+def main(): #{
+    parser = ArgumentParser(description='Runs the load tests of a controller on this machine')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on (default %(default)s)')
+    parser.add_argument('--workdir', help='directory to write the config files to (default the temporary directory)')
+    parser.add_argument('--trace', action='store_true', help='trace the stages of each test, written to trace.json')
+    args = parser.parse_args()
+
+    from loadtest.SysEnvironment import SysEnvironment
+    if args.trace: Tracing.enable()
+    agent = Agent(SysEnvironment(), args.port, args.workdir)
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+#} End method main
+
+
+if __name__ == '__main__':
+    sys.exit(main())
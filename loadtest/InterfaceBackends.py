@@ -0,0 +1,223 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.InterfaceBackends implements the platform-specific part of SysEnvironment: listing the interfaces of the machine
+with their names, interface indexes and IPv4 addresses. WMI is used on Windows, and netlink on Linux.
+
+InterfaceBackends.py implements the WMIBackend and LinuxBackend classes, and the get_default_backend() function.
+'''
+
+import re
+import sys
+import socket
+import struct
+
+
+class WMIBackend(object): #{
+    '''
+    class WMIBackend(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __c	= Instance of the WMI object
+
+    Overview:
+    Lists the interfaces through the Windows Management Instrumentation API. The adapters and the adapter configurations
+    are each fetched with one query, and joined on InterfaceIndex locally, rather than running one configuration query per
+    adapter (which is very slow on machines with lots of virtual adapters).
+
+    Public methods:
+    enumerate(self):
+    Returns a list of (name, interface index, IPv4 address) tuples, one per active interface with an IPv4 address.
+    If an interface has more than one IPv4 address, only the last one found is returned.
+
+    '''
+
+    def __init__(self): #{
+        '''
+        Constructor
+        '''
+        import wmi
+        self.__c = wmi.WMI()
+    #} End method __init__
+
+    def enumerate(self): #{
+        '''
+		RegEx string to match valid IPv4 address:
+		'''
+        ipv4 = re.compile('^(?:[0-9]{1,3}\.){3}[0-9]{1,3}$')
+        # One query for all the adapter configurations that have an address, indexed by InterfaceIndex:
+        configs = {}
+        for interfaceConfig in self.__c.Win32_NetworkAdapterConfiguration(IPEnabled=True):
+            configs[interfaceConfig.InterfaceIndex] = interfaceConfig
+
+        interfaces = []
+        for interface in self.__c.Win32_NetworkAdapter():
+            interfaceConfig = configs.get(interface.InterfaceIndex)
+            if interfaceConfig is None or interface.NetConnectionID is None or interfaceConfig.IPAddress is None: continue
+            ipv4_addr = None
+            for ip in interfaceConfig.IPAddress:
+                if ipv4.match(ip):
+                    ipv4_addr = ip
+            if ipv4_addr is not None:
+                interfaces.append((interface.NetConnectionID, interface.InterfaceIndex, ipv4_addr))
+        return interfaces
+    #} End method enumerate
+#} End class WMIBackend
+
+
+class LinuxBackend(object): #{
+    '''
+    class LinuxBackend(object):
+    Sub-class of:                    object
+
+    Overview:
+    Lists the interfaces through an rtnetlink socket: one dump request for all the links (names and indexes) and one for
+    all the IPv4 addresses, whatever the number of interfaces. If netlink isn't available, it falls back on reading
+    /sys/class/net and asking for each interface's address with the SIOCGIFADDR ioctl.
+
+    Public methods:
+    enumerate(self):
+    Returns a list of (name, interface index, IPv4 address) tuples, one per interface with an IPv4 address.
+    If an interface has more than one IPv4 address, only the last one found is returned.
+
+    get_name_of_index(self, index):
+    Returns the name of the interface with the given interface index, or None if there isn't one.
+
+    '''
+
+    # From <linux/netlink.h> and <linux/rtnetlink.h>
+    NLMSG_HEADER = struct.Struct('=IHHII')
+    RTATTR_HEADER = struct.Struct('=HH')
+    IFINFOMSG = struct.Struct('=BBHiII')
+    IFADDRMSG = struct.Struct('=BBBBI')
+    NLMSG_ERROR, NLMSG_DONE = 2, 3
+    NLM_F_REQUEST, NLM_F_DUMP = 0x1, 0x300
+    RTM_NEWLINK, RTM_GETLINK, RTM_NEWADDR, RTM_GETADDR = 16, 18, 20, 22
+    IFLA_IFNAME = 3
+    IFA_ADDRESS, IFA_LOCAL = 1, 2
+    SIOCGIFADDR = 0x8915
+
+    def enumerate(self): #{
+        try:
+            return self.__enumerate_netlink()
+        except (socket.error, AttributeError):
+            # AttributeError: no socket.AF_NETLINK
+            return self.__enumerate_sysfs()
+    #} End method enumerate
+
+    def get_name_of_index(self, index): #{
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        name = ctypes.create_string_buffer(16) # IF_NAMESIZE
+        if not libc.if_indextoname(index, name): return None
+        return name.value
+    #} End method get_name_of_index
+
+    def __enumerate_netlink(self): #{
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, 0) # 0 = NETLINK_ROUTE
+        try:
+            sock.bind((0, 0))
+            names = {}
+            for msg_type, body in self.dump(sock, self.RTM_GETLINK, self.IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0, 0), 1):
+                if msg_type != self.RTM_NEWLINK: continue
+                index, name, _ = self.parse_link(body)
+                if name is not None: names[index] = name
+            addrs = {}
+            for msg_type, body in self.dump(sock, self.RTM_GETADDR, self.IFADDRMSG.pack(socket.AF_INET, 0, 0, 0, 0), 2):
+                if msg_type != self.RTM_NEWADDR: continue
+                index, addr = self.parse_addr(body)
+                if addr is not None: addrs[index] = addr
+        finally:
+            sock.close()
+        return [(names[index], index, addr) for index, addr in sorted(addrs.items()) if index in names]
+    #} End method __enumerate_netlink
+
+    def dump(self, sock, request_type, request_body, seq): #{
+        '''
+        Sends a netlink dump request and returns all the (message type, message body) replies to it
+        '''
+        header = self.NLMSG_HEADER.pack(self.NLMSG_HEADER.size + len(request_body), request_type,
+                                        self.NLM_F_REQUEST | self.NLM_F_DUMP, seq, 0)
+        sock.send(header + request_body)
+        messages = []
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + self.NLMSG_HEADER.size <= len(data):
+                length, msg_type, _, msg_seq, _ = self.NLMSG_HEADER.unpack_from(data, offset)
+                if length < self.NLMSG_HEADER.size: return messages
+                if msg_seq == seq:
+                    if msg_type == self.NLMSG_DONE: return messages
+                    if msg_type == self.NLMSG_ERROR: raise socket.error('netlink dump request failed')
+                    messages.append((msg_type, data[offset + self.NLMSG_HEADER.size:offset + length]))
+                offset += (length + 3) & ~3
+    #} End method dump
+
+    def parse_link(self, body): #{
+        '''
+        Returns (interface index, name, flags) from the body of an RTM_NEWLINK message
+        '''
+        _, _, _, index, flags, _ = self.IFINFOMSG.unpack_from(body, 0)
+        attrs = self.parse_attrs(body, self.IFINFOMSG.size)
+        name = attrs.get(self.IFLA_IFNAME)
+        if name is not None: name = name.rstrip('\0')
+        return index, name, flags
+    #} End method parse_link
+
+    def parse_addr(self, body): #{
+        '''
+        Returns (interface index, IPv4 address) from the body of an RTM_NEWADDR message (address None if not IPv4)
+        '''
+        family, _, _, _, index = self.IFADDRMSG.unpack_from(body, 0)
+        if family != socket.AF_INET: return index, None
+        attrs = self.parse_attrs(body, self.IFADDRMSG.size)
+        # IFA_LOCAL is the interface's own address, IFA_ADDRESS is the peer address on point-to-point links:
+        raw = attrs.get(self.IFA_LOCAL, attrs.get(self.IFA_ADDRESS))
+        if raw is None: return index, None
+        return index, socket.inet_ntoa(raw[:4])
+    #} End method parse_addr
+
+    def parse_attrs(self, body, offset): #{
+        attrs = {}
+        while offset + self.RTATTR_HEADER.size <= len(body):
+            length, attr_type = self.RTATTR_HEADER.unpack_from(body, offset)
+            if length < self.RTATTR_HEADER.size: break
+            attrs[attr_type] = body[offset + self.RTATTR_HEADER.size:offset + length]
+            offset += (length + 3) & ~3
+        return attrs
+    #} End method parse_attrs
+
+    def __enumerate_sysfs(self): #{
+        import os
+        import fcntl
+        interfaces = []
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for name in sorted(os.listdir('/sys/class/net')):
+                try:
+                    index = int(open(os.path.join('/sys/class/net', name, 'ifindex')).read())
+                    ifreq = fcntl.ioctl(sock.fileno(), self.SIOCGIFADDR, struct.pack('256s', name[:15]))
+                except (IOError, OSError, ValueError):
+                    # No IPv4 address (or the interface went away)
+                    continue
+                interfaces.append((name, index, socket.inet_ntoa(ifreq[20:24])))
+        finally:
+            sock.close()
+        return interfaces
+    #} End method __enumerate_sysfs
+#} End class LinuxBackend
+
+
+def get_default_backend(): #{
+    '''
+    Returns a new instance of the interface backend for the current platform
+    '''
+    if sys.platform == 'win32': return WMIBackend()
+    if sys.platform.startswith('linux'): return LinuxBackend()
+    raise NotImplementedError('No interface backend for platform ' + sys.platform)
+#} End method get_default_backend
@@ -0,0 +1,205 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.InterfaceWatcher keeps the SysEnvironment up to date while a test is running, so that a UE which re-attaches
+and gets a new address (or loses its link altogether) is noticed, rather than its iperf silently running at zero for the
+rest of the test.
+
+InterfaceWatcher.py implements the InterfaceWatcher class and methods only.
+'''
+
+import sys
+import errno
+import select
+import socket
+import logging
+from threading import Thread, Event
+
+from loadtest.InterfaceBackends import LinuxBackend, get_default_backend
+
+
+class InterfaceWatcher(object): #{
+    '''
+    class InterfaceWatcher(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __env = SysEnvironment to keep up to date
+        __poll = How often (in seconds) the interfaces are re-read on platforms without change events
+        __listeners = List of functions to call when the usable address of an interface changes
+        __down = Set of the names of interfaces whose link is down
+        __stop = threading.Event set to stop the watcher thread
+        __thread = The watcher thread
+
+    Overview:
+    On Linux the watcher subscribes to the rtnetlink link and IPv4 address multicast groups, and applies each event to the
+    SysEnvironment as it arrives: only the interface in the event is updated, nothing is re-enumerated. If the kernel
+    drops events (the socket buffer overflowed) the interfaces are re-read once to catch up.
+    Everywhere else (i.e. WMI on Windows) there are no cheap change events, so the interfaces are re-read every poll
+    seconds on the watcher thread, and the differences applied.
+    Listeners are called as listener(name, addr) whenever the usable address of an interface changes, where addr is None
+    if the interface has no address or its link is down. They are called on the watcher thread.
+
+    Public methods:
+    add_listener(self, listener):
+    Adds a function to be called on every change.
+
+    get_addr_of(self, name):
+    Returns the usable address of an interface: its IPv4 address, or None if it has none or its link is down.
+
+    start(self):
+    Starts the watcher thread.
+
+    stop(self):
+    Stops the watcher thread and waits for it to finish.
+
+    '''
+
+    # From <linux/rtnetlink.h> and <linux/if.h>
+    RTMGRP_LINK, RTMGRP_IPV4_IFADDR = 0x1, 0x10
+    RTM_DELLINK, RTM_DELADDR = 17, 21
+    IFF_RUNNING = 0x40
+
+    def __init__(self, env, poll=2.0): #{
+        '''
+        Constructor:
+            env = SysEnvironment to keep up to date
+            poll = re-read interval in seconds, where the platform has no change events
+        '''
+        self.__env = env
+        self.__poll = poll
+        self.__listeners = []
+        self.__down = set()
+        self.__stop = Event()
+        self.__thread = None
+    #} End method __init__
+
+    def add_listener(self, listener): #{
+        self.__listeners.append(listener)
+    #} End method add_listener
+
+    def get_addr_of(self, name): #{
+        if name in self.__down: return None
+        return self.__env.get_interfaces_dict().get(name)
+    #} End method get_addr_of
+
+    def start(self): #{
+        backend = self.__env.get_backend()
+        target, args = self.__watch_polling, ()
+        if isinstance(backend, LinuxBackend) and hasattr(socket, 'AF_NETLINK'):
+            try:
+                sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, 0) # 0 = NETLINK_ROUTE
+                sock.bind((0, self.RTMGRP_LINK | self.RTMGRP_IPV4_IFADDR))
+                target, args = self.__watch_netlink, (backend, sock)
+            except socket.error, e:
+                logging.warning('Could not subscribe to interface events (' + str(e) + '), polling instead')
+        self.__thread = Thread(target=target, args=args)
+        self.__thread.setName('if-watcher')
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+    #} End method start
+
+    def stop(self): #{
+        self.__stop.set()
+        if self.__thread is not None: self.__thread.join()
+    #} End method stop
+
+    def __watch_netlink(self, backend, sock): #{
+        header = backend.NLMSG_HEADER
+        try:
+            while not self.__stop.is_set():
+                # Wake up now and again to check for stop():
+                readable, _, _ = select.select([sock], [], [], 0.5)
+                if not readable: continue
+                try:
+                    data = sock.recv(65536)
+                except socket.error, e:
+                    if e.args[0] != errno.ENOBUFS: raise
+                    logging.warning('Missed some interface events, re-reading the interfaces')
+                    self.__resync(backend.enumerate())
+                    continue
+                offset = 0
+                while offset + header.size <= len(data):
+                    length, msg_type, _, _, _ = header.unpack_from(data, offset)
+                    if length < header.size: break
+                    self.__apply(backend, msg_type, data[offset + header.size:offset + length])
+                    offset += (length + 3) & ~3
+        except Exception, e:
+            logging.warning('Interface watcher stopped: ' + str(e))
+        finally:
+            sock.close()
+    #} End method __watch_netlink
+
+    def __apply(self, backend, msg_type, body): #{
+        env = self.__env
+        if msg_type == backend.RTM_NEWLINK:
+            index, name, flags = backend.parse_link(body)
+            if name is not None: self.__set_link(name, flags & self.IFF_RUNNING != 0)
+        elif msg_type == self.RTM_DELLINK:
+            index, name, _ = backend.parse_link(body)
+            if name is not None:
+                self.__set_addr(name, index, None)
+                self.__down.discard(name)
+        elif msg_type == backend.RTM_NEWADDR:
+            index, addr = backend.parse_addr(body)
+            if addr is None: return
+            name = env.get_name_of_id(index) or backend.get_name_of_index(index)
+            if name is not None: self.__set_addr(name, index, addr)
+        elif msg_type == self.RTM_DELADDR:
+            index, addr = backend.parse_addr(body)
+            name = env.get_name_of_addr(addr)
+            # Only if it's the address we know about (an interface with several addresses may lose one of the others):
+            if name is not None: self.__set_addr(name, index, None)
+    #} End method __apply
+
+    def __watch_polling(self): #{
+        backend = self.__env.get_backend()
+        try:
+            if sys.platform == 'win32':
+                # WMI objects can only be used on the thread that created them, so this thread needs its own:
+                import pythoncom
+                pythoncom.CoInitialize()
+                backend = get_default_backend()
+            while not self.__stop.wait(self.__poll):
+                self.__resync(backend.enumerate())
+        except Exception, e:
+            logging.warning('Interface watcher stopped: ' + str(e))
+    #} End method __watch_polling
+
+    def __resync(self, interfaces): #{
+        current = {}
+        for name, interface_id, addr in interfaces:
+            current[name] = (interface_id, addr)
+        for name in self.__env.get_interfaces_dict().keys():
+            if name not in current: self.__set_addr(name, None, None)
+        for name, (interface_id, addr) in current.items():
+            if self.__env.get_interfaces_dict().get(name) != addr: self.__set_addr(name, interface_id, addr)
+    #} End method __resync
+
+    def __set_addr(self, name, interface_id, addr): #{
+        before = self.get_addr_of(name)
+        self.__env.update_interface(name, interface_id, addr)
+        self.__notify(name, before)
+    #} End method __set_addr
+
+    def __set_link(self, name, is_up): #{
+        before = self.get_addr_of(name)
+        if is_up: self.__down.discard(name)
+        else: self.__down.add(name)
+        self.__notify(name, before)
+    #} End method __set_link
+
+    def __notify(self, name, before): #{
+        after = self.get_addr_of(name)
+        if after == before: return
+        logging.warning('Interface ' + name + ' changed from ' + str(before) + ' to ' + str(after))
+        for listener in self.__listeners:
+            try:
+                listener(name, after)
+            except Exception, e:
+                logging.warning('Interface change listener failed: ' + str(e))
+    #} End method __notify
+#} End class InterfaceWatcher
@@ -0,0 +1,140 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.IntervalParser turns the interval report lines that iperf prints (-i 1) into typed records in a ThroughputSeries,
+as the lines arrive from the capture stage.
+
+IntervalParser.py implements the IntervalParser class and methods, as well as the parse_size() and format_kilo() functions
+the rest of the load test uses to read and write iperf's units.
+'''
+
+import re
+
+# Matches iperf 2 report lines such as:
+# [  3]  0.0- 1.0 sec   128 KBytes  1049 Kbits/sec
+# [  3]  0.0- 1.0 sec   586 KBytes  4801 Kbits/sec   0.012 ms    0/  408 (0%)
+# [SUM]  0.0- 1.0 sec  1172 KBytes  9602 Kbits/sec
+REPORT_LINE = re.compile(r'^\[\s*(\d+|SUM)\]\s*(\d+(?:\.\d+)?)\s*-\s*(\d+(?:\.\d+)?)\s+sec'
+                         r'\s+(\d+(?:\.\d+)?)\s+([KMG]?)Bytes'
+                         r'\s+(\d+(?:\.\d+)?)\s+([KMG]?)bits/sec'
+                         r'(?:\s+(\d+(?:\.\d+)?)\s+ms\s+(\d+)\s*/\s*(\d+))?')
+
+# Multipliers to convert the reported units to KBytes and Kbits/sec (iperf uses 1024 for bytes and 1000 for bits):
+BYTE_UNITS = {'': 1.0 / 1024, 'K': 1.0, 'M': 1024.0, 'G': 1024.0 * 1024}
+BIT_UNITS = {'': 1.0 / 1000, 'K': 1.0, 'M': 1000.0, 'G': 1000.0 * 1000}
+
+
+def parse_size(value): #{
+    '''
+    Converts an iperf size or rate string (e.g. 32M, 1200B, 512k) to a number, the same way iperf 2 does:
+    upper case suffixes are powers of 1024, lower case suffixes are powers of 1000, anything else is ignored.
+    '''
+    multipliers = {'K': 1024.0, 'M': 1024.0 ** 2, 'G': 1024.0 ** 3, 'k': 1e3, 'm': 1e6, 'g': 1e9}
+    value = value.strip()
+    number = value.rstrip('KMGkmgBb')
+    suffix = value[len(number):len(number) + 1]
+    return float(number) * multipliers.get(suffix, 1.0)
+#} End method parse_size
+
+
+def format_kilo(value): #{
+    '''
+    Formats a KBytes or Kbits value with the same precision iperf uses
+    '''
+    if value >= 99.95: return '%4.0f' % value
+    if value >= 9.995: return '%4.1f' % value
+    return '%4.2f' % value
+#} End method format_kilo
+
+
+class IntervalParser(object): #{
+    '''
+    class IntervalParser(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __series = The ThroughputSeries that parsed records are added to
+        __interval = The iperf report interval (-i) in seconds
+        __offset = Seconds added to every report time (for an iperf restarted part way through its phase)
+        __last_end = End time of the last interval report, used to spot the summary lines
+        __partial = Any incomplete line left over from the last chunk of data fed in
+        __is_chained = True if the output is from a chain of iperf runs, one after the other (see RateProfile.py)
+        __max_end = Latest end time of any interval report so far (only used if __is_chained)
+
+    Overview:
+    The parser is given every line of iperf output. Report lines are parsed into a record and added to the series, every
+    other line (headers, connection info etc.) is ignored. A report covering more than one interval, or one that starts
+    before the previous report ended, is a summary report (end of test, or the UDP 'Server Report') and is added as such.
+    If the output is chained, each iperf run (or each new client of an iperf server) starts its times from 0 again. So an
+    interval report going back more than an interval and a half starts a new run, and that run's times are moved on to
+    follow the last report of the one before.
+
+    Public methods:
+    feed(self, data):
+    Parses a chunk of iperf output, which doesn't have to end on a line boundary.
+
+    feed_line(self, line):
+    Parses a single line of iperf output.
+
+    '''
+
+    def __init__(self, series, interval=1.0, offset=0.0, is_chained=False): #{
+        '''
+        Constructor:
+            series = ThroughputSeries to add the parsed records to
+            interval = iperf report interval in seconds
+            offset = seconds to add to the report times
+            is_chained = True for the output of a chain of iperf runs
+        '''
+        self.__series = series
+        self.__interval = interval
+        self.__offset = offset
+        self.__last_end = {}
+        self.__partial = ''
+        self.__is_chained = is_chained
+        self.__max_end = offset
+    #} End method __init__
+
+    def feed(self, data): #{
+        lines = (self.__partial + data).split('\n')
+        # The last item is whatever came after the last newline, which is kept until the rest of the line arrives:
+        self.__partial = lines.pop()
+        for line in lines:
+            self.feed_line(line)
+    #} End method feed
+
+    def feed_line(self, line): #{
+        match = REPORT_LINE.match(line.strip())
+        if match is None: return None
+
+        stream_id, start, end, kbytes, byte_unit, kbps, bit_unit, jitter, lost, total = match.groups()
+        stream = -1 if stream_id == 'SUM' else int(stream_id)
+        start = float(start) + self.__offset
+        end = float(end) + self.__offset
+        kbytes = float(kbytes) * BYTE_UNITS[byte_unit]
+        kbps = float(kbps) * BIT_UNITS[bit_unit]
+        if jitter is None:
+            jitter, lost, total = float('nan'), -1, -1
+        else:
+            jitter, lost, total = float(jitter), int(lost), int(total)
+
+        if self.__is_chained and end - start <= self.__interval * 1.5 and start < self.__max_end - self.__interval * 1.5:
+            # The first report of the next run of the chain:
+            self.__offset += self.__max_end - start
+            end += self.__max_end - start
+            start = self.__max_end
+            self.__last_end = {}
+
+        last_end = self.__last_end.get(stream, self.__offset)
+        if end - start > self.__interval * 1.5 or start < last_end - self.__interval * 0.5:
+            self.__series.append_summary(start, end, kbytes, kbps, jitter, lost, total, stream)
+        else:
+            self.__series.append(start, end, kbytes, kbps, jitter, lost, total, stream)
+            self.__last_end[stream] = end
+            self.__max_end = max(self.__max_end, end)
+        return match
+    #} End method feed_line
+#} End class IntervalParser
@@ -0,0 +1,243 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.LogAnalysis re-analyses the iperf logs of past runs: it walks a baselogdir tree, parses every log in a pool of
+processes, and writes one summary table per run, with the same statistics as the summary.csv written at the end of a
+test (plus the time taken to reach the target rate), so that logs from before summary.csv existed can be compared too.
+Run it as:
+    python -m loadtest.LogAnalysis <baselogdir> [--processes N] [--no-cache]
+
+LogAnalysis.py implements the analyse_log(), find_logs(), analyse_tree() and main() functions.
+'''
+
+import os
+import re
+import sys
+import json
+import math
+import hashlib
+import logging
+import multiprocessing
+from argparse import ArgumentParser
+
+from loadtest.IntervalParser import IntervalParser, parse_size
+from loadtest.ThroughputSeries import ThroughputSeries
+from loadtest.StreamCapture import read_log, zstandard
+
+# NumPy is optional. If it's installed the time to target is found with a vectorised search, otherwise in pure Python:
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Run directories, UE directories and log files as created by TestInstance.run_test and UEPhase (the optional part after
+# a run is the host and port block of a distributed agent, after the phase the new address of a phase restarted by the
+# interface watcher, and after the .log the extension of a compressed log, see StreamCapture.py):
+RUN_DIR = re.compile(r'^LoadTestLogs_\d{2}-\d{2}-\d{4}_\d{6}(?:_.+)?$')
+UE_DIR = re.compile(r'^(.+)_\d{2}-\d{2}-\d{4}_\d{6}$')
+LOG_FILE = re.compile(r'^(.*)_Phase(\d+)(?:_(.+?))?_(dl|ul)_(client|server)\.log(\.gz|\.zst)?$')
+# The -b option of the iperf command line in a log's header:
+TARGET_RATE = re.compile(r'^-----------Executing command - .*\s-b\s+(\d+(?:\.\d+)?[KMGkmg]?)\s')
+
+# Name of the cache file kept in the baselogdir, and of the table written to each run directory:
+CACHE_FILE = 'analysis_cache.json'
+RUN_TABLE = 'analysis.csv'
+# A phase has reached its target rate once an interval gets to this fraction of the iperf -b rate:
+TARGET_FRACTION = 0.95
+KEY_FIELDS = ('ue', 'phase', 'direction', 'role', 'log')
+EXTRA_FIELDS = ('target_kbps', 'time_to_target')
+# Bump this when the statistics are worked out differently, so that a cache written before is not used (a cache written
+# with different fields isn't used either):
+CACHE_VERSION = 3
+
+
+def analyse_log(job): #{
+    '''
+    Pool worker: parses one log and returns (path, sha1, stats).
+    job is a (path, ue, phase, direction, role, cached) tuple, where cached is the cache entry of the log from an earlier
+    analysis (or None). If the log's contents haven't changed since then, the cached stats are returned unparsed.
+    '''
+    path, ue, phase, direction, role, cached = job
+    data = read_log(path)
+    sha1 = hashlib.sha1(data).hexdigest()
+    if cached is not None and cached['sha1'] == sha1: return path, sha1, cached['stats']
+
+    series = ThroughputSeries(ue, phase, direction, role)
+    parser = IntervalParser(series)
+    for line in data.splitlines():
+        parser.feed_line(line)
+    stats = series.summary()
+
+    # The target rate is on the client's command line, so a server log takes it from the client log next to it:
+    target = get_target_kbps(data)
+    if math.isnan(target) and role == 'server':
+        client_path = re.sub(r'server(\.log(?:\.gz|\.zst)?)$', r'client\1', path)
+        if os.path.exists(client_path):
+            target = get_target_kbps(read_log(client_path)[:4096])
+    stats['target_kbps'] = target
+    stats['time_to_target'] = get_time_to_target(series, target)
+    return path, sha1, stats
+#} End method analyse_log
+
+
+def get_target_kbps(data): #{
+    '''
+    Returns the iperf -b rate (in Kbits/sec) from the header of a log, or NaN if there is none (e.g. TCP).
+    The rate is read as iperf 2 reads it (see parse_size), and the Kbits/sec of its reports are 1000 bits/sec.
+    '''
+    for line in data.splitlines()[:10]:
+        match = TARGET_RATE.match(line.strip() + ' ')
+        if match is not None: return parse_size(match.group(1)) / 1000
+    return float('nan')
+#} End method get_target_kbps
+
+
+def get_time_to_target(series, target): #{
+    '''
+    Returns the end time of the first interval of the series that reached TARGET_FRACTION of target, or NaN if none did
+    '''
+    if math.isnan(target) or not len(series): return float('nan')
+    # As in ThroughputSeries.summary(), the [SUM] lines are the aggregate if there are any:
+    if numpy is not None:
+        stream = series.get_column('stream')
+        kbps = series.get_column('kbps')
+        end = series.get_column('end')
+        if (stream == -1).any():
+            kbps, end = kbps[stream == -1], end[stream == -1]
+        hits = numpy.flatnonzero(kbps >= target * TARGET_FRACTION)
+        return float(end[hits[0]]) if len(hits) else float('nan')
+    stream = series.columns['stream']
+    rows = [i for i in xrange(len(stream)) if stream[i] == -1] if -1 in stream else xrange(len(stream))
+    for i in rows:
+        if series.columns['kbps'][i] >= target * TARGET_FRACTION: return float(series.columns['end'][i])
+    return float('nan')
+#} End method get_time_to_target
+
+
+def find_logs(baselogdir): #{
+    '''
+    Returns a dictionary of run directory to the list of (path, ue, phase, direction, role) tuples of its logs
+    '''
+    runs = {}
+    for run_name in sorted(os.listdir(baselogdir)):
+        run_dir = os.path.join(baselogdir, run_name)
+        if not RUN_DIR.match(run_name) or not os.path.isdir(run_dir): continue
+        logs = []
+        for ue_name in sorted(os.listdir(run_dir)):
+            ue_match = UE_DIR.match(ue_name)
+            ue_dir = os.path.join(run_dir, ue_name)
+            if ue_match is None or not os.path.isdir(ue_dir): continue
+            for log_name in sorted(os.listdir(ue_dir)):
+                log_match = LOG_FILE.match(log_name)
+                if log_match is None: continue
+                _, phase, _, direction, role, extension = log_match.groups()
+                if extension == '.zst' and zstandard is None:
+                    logging.warning('Skipping ' + log_name + ', the zstandard module is needed to read it')
+                    continue
+                logs.append((os.path.join(ue_dir, log_name), ue_match.group(1), int(phase), direction.upper(), role))
+        if logs: runs[run_dir] = logs
+    return runs
+#} End method find_logs
+
+
+def analyse_tree(baselogdir, processes=None, use_cache=True): #{
+    '''
+    Analyses every log under baselogdir that isn't already in the cache, and (re)writes the summary table of every run
+    that had a new or changed log, or doesn't have a table yet. Returns the list of run directories written.
+    '''
+    cache_path = os.path.join(baselogdir, CACHE_FILE)
+    fields = list(ThroughputSeries.SUMMARY_FIELDS + EXTRA_FIELDS)
+    cache = {}
+    if use_cache and os.path.exists(cache_path):
+        try:
+            saved = json.load(open(cache_path))
+            # The stats of a cache from another version (or with other fields) can't be used, so every log is parsed again:
+            if isinstance(saved, dict) and saved.get('version') == CACHE_VERSION and saved.get('fields') == fields:
+                cache = saved['logs']
+            else:
+                logging.warning('The analysis cache ' + cache_path + ' is from another version, analysing every log again')
+        except ValueError, e:
+            logging.warning('Ignoring the unreadable analysis cache ' + cache_path + ': ' + str(e))
+
+    runs = find_logs(baselogdir)
+    # Logs with the same size and mtime as last time are taken straight from the cache. Any others go to the pool, which
+    # hashes them and only parses those whose contents have actually changed:
+    jobs = []
+    job_runs = {}
+    changed_runs = set()
+    for run_dir, logs in runs.items():
+        if not os.path.exists(os.path.join(run_dir, RUN_TABLE)): changed_runs.add(run_dir)
+        for path, ue, phase, direction, role in logs:
+            key = os.path.relpath(path, baselogdir)
+            stat = os.stat(path)
+            cached = cache.get(key)
+            if cached is not None and cached['mtime'] == stat.st_mtime and cached['size'] == stat.st_size: continue
+            jobs.append((path, ue, phase, direction, role, cached))
+            job_runs[path] = run_dir
+
+    if jobs:
+        pool = multiprocessing.Pool(processes)
+        try:
+            for path, sha1, stats in pool.imap_unordered(analyse_log, jobs, 16):
+                stat = os.stat(path)
+                cached = cache.get(os.path.relpath(path, baselogdir))
+                # Only touched (same contents, so the table is still right) if the hash hasn't changed:
+                if cached is None or cached['sha1'] != sha1: changed_runs.add(job_runs[path])
+                cache[os.path.relpath(path, baselogdir)] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': sha1,
+                                                            'stats': stats}
+        finally:
+            pool.close()
+            pool.join()
+    logging.debug(str(len(jobs)) + ' logs analysed, ' + str(sum([len(logs) for logs in runs.values()]) - len(jobs)) +
+                  ' taken from the cache')
+
+    for run_dir in sorted(changed_runs):
+        write_run_table(run_dir, runs[run_dir], cache, baselogdir)
+    if use_cache:
+        cache_file = open(cache_path, 'w')
+        json.dump({'version': CACHE_VERSION, 'fields': fields, 'logs': cache}, cache_file)
+        cache_file.close()
+    return sorted(changed_runs)
+#} End method analyse_tree
+
+
+def write_run_table(run_dir, logs, cache, baselogdir): #{
+    '''
+    Writes the summary table of one run, with one line per log
+    '''
+    fields = ThroughputSeries.SUMMARY_FIELDS + EXTRA_FIELDS
+    table = open(os.path.join(run_dir, RUN_TABLE), 'w')
+    table.write(','.join(KEY_FIELDS + fields) + '\n')
+    for path, ue, phase, direction, role in sorted(logs, key=lambda log: log[1:] + log[:1]):
+        stats = cache[os.path.relpath(path, baselogdir)]['stats']
+        values = [ue, str(phase), direction, role, os.path.basename(path)]
+        values.extend([str(stats[field]) for field in fields])
+        table.write(','.join(values) + '\n')
+    table.close()
+#} End method write_run_table
+
+
+def main(): #{
+    parser = ArgumentParser(description='Re-analyses the iperf logs of past load test runs')
+    parser.add_argument('baselogdir', help='directory holding the LoadTestLogs_* run directories')
+    parser.add_argument('--processes', type=int, help='number of processes to parse the logs with (default one per core)')
+    parser.add_argument('--no-cache', action='store_true', help='ignore the cache and parse every log again')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.baselogdir):
+        sys.stderr.write(args.baselogdir + ' is not a directory\n')
+        return 1
+    written = analyse_tree(args.baselogdir, args.processes, not args.no_cache)
+    for run_dir in written:
+        print os.path.join(run_dir, RUN_TABLE)
+    print str(len(written)) + ' run tables written'
+    return 0
+#} End method main
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.MetricsExporter serves the live state of a running test over HTTP, in the Prometheus text format, so that a UE
+which is under-delivering can be spotted (and the run aborted) while the test is still going, rather than from the logs
+afterwards.
+
+MetricsExporter.py implements the MetricsExporter class and methods, the MetricsServer and MetricsHandler classes it serves
+the metrics with, and the format_labels() and format_value() functions.
+'''
+
+import math
+import logging
+from threading import Thread
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+SERIES_LABELS = ('ue', 'phase', 'direction', 'role')
+# Name, type and help text of each per-series metric:
+SERIES_METRICS = (('loadtest_throughput_kbps', 'gauge', 'Throughput of the last interval report, in Kbits/sec'),
+                  ('loadtest_jitter_ms', 'gauge', 'Jitter of the last interval report (UDP receiving side only)'),
+                  ('loadtest_loss_ratio', 'gauge', 'Datagrams lost in the last interval report (UDP receiving side only)'),
+                  ('loadtest_report_end_seconds', 'gauge', 'End time of the last interval report, from the phase start'),
+                  ('loadtest_reports_total', 'counter', 'Number of interval reports parsed'),
+                  ('loadtest_outage_seconds', 'gauge', 'Time the UE interface has been down or readdressed'))
+PHASE_STATES = ('pending', 'running', 'finished')
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer): #{
+    '''
+    HTTPServer handling each scrape on its own thread, which doesn't stop the process from exiting
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+#} End class MetricsServer
+
+
+class MetricsHandler(BaseHTTPRequestHandler): #{
+    '''
+    Request handler serving the exporter's metrics on /metrics
+    '''
+
+    def do_GET(self): #{
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.exporter.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    #} End method do_GET
+
+    def log_message(self, format, *args): #{
+        # Every scrape would otherwise be written to stderr:
+        logging.debug('Metrics request from ' + self.client_address[0] + ': ' + format % args)
+    #} End method log_message
+#} End class MetricsHandler
+
+
+class MetricsExporter(object): #{
+    '''
+    class MetricsExporter(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __series = SeriesStore of the running test
+        __get_phase_states = Function returning a list of (ue, phase, state) tuples, state being one of PHASE_STATES
+        __port = TCP port to serve the metrics on
+        __server = The MetricsServer (None until started)
+        __thread = The thread serving the requests
+
+    Overview:
+    Nothing is done while the test runs: the iperf output is parsed into the series by the capture stage as it always is,
+    and the metrics are only worked out when they are scraped, from the last complete interval of each series. So the cost
+    to the test is one short burst of work per scrape, however many UEs there are.
+    Each series gives one sample of each of SERIES_METRICS, labelled with its ue, phase, direction and role. Each phase
+    gives one loadtest_phase_state sample per state, 1 for the state it is in and 0 for the others.
+    The metrics are served on http://<this machine>:<port>/metrics
+
+    Public methods:
+    start(self):
+    Starts serving the metrics.
+
+    stop(self):
+    Stops serving the metrics.
+
+    get_port(self):
+    Returns the port the metrics are served on (the one picked by the system if the port was 0).
+
+    render(self):
+    Returns the current metrics in the Prometheus text format.
+
+    '''
+
+    def __init__(self, series, get_phase_states, port): #{
+        '''
+        Constructor:
+            series = SeriesStore of the test
+            get_phase_states = function returning a list of (ue, phase, state) tuples
+            port = TCP port to serve the metrics on
+        '''
+        self.__series = series
+        self.__get_phase_states = get_phase_states
+        self.__port = port
+        self.__server = None
+        self.__thread = None
+    #} End method __init__
+
+    def start(self): #{
+        self.__server = MetricsServer(('', self.__port), MetricsHandler)
+        self.__server.exporter = self
+        self.__thread = Thread(target=self.__server.serve_forever, args=[0.5])
+        self.__thread.setName('metrics')
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+        logging.debug('Serving metrics on port ' + str(self.get_port()))
+    #} End method start
+
+    def stop(self): #{
+        if self.__server is None: return
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__thread.join()
+        self.__server = None
+    #} End method stop
+
+    def get_port(self): #{
+        return self.__server.server_address[1]
+    #} End method get_port
+
+    def render(self): #{
+        samples = dict([(name, []) for name, _, _ in SERIES_METRICS])
+        for series in self.__series.get_all_series():
+            labels = format_labels(zip(SERIES_LABELS, (series.ue, series.phase, series.direction, series.role)))
+            # The capture threads append to the columns one at a time, and stream is always the last, so every column has
+            # at least this many entries:
+            count = len(series.columns['stream'])
+            samples['loadtest_reports_total'].append((labels, count))
+            samples['loadtest_outage_seconds'].append((labels, sum([end - start for start, end in series.outages])))
+            if not count: continue
+            end, kbps, jitter, lost, total = self.__last_report(series, count)
+            samples['loadtest_throughput_kbps'].append((labels, kbps))
+            samples['loadtest_report_end_seconds'].append((labels, end))
+            if not math.isnan(jitter):
+                samples['loadtest_jitter_ms'].append((labels, jitter))
+            if total > 0:
+                samples['loadtest_loss_ratio'].append((labels, float(lost) / total))
+
+        lines = []
+        for name, metric_type, help_text in SERIES_METRICS:
+            lines.append('# HELP ' + name + ' ' + help_text)
+            lines.append('# TYPE ' + name + ' ' + metric_type)
+            for labels, value in samples[name]:
+                lines.append(name + labels + ' ' + format_value(value))
+        lines.append('# HELP loadtest_phase_state State of each UE phase')
+        lines.append('# TYPE loadtest_phase_state gauge')
+        for ue, phase, state in self.__get_phase_states():
+            for each_state in PHASE_STATES:
+                labels = format_labels([('ue', ue), ('phase', phase), ('state', each_state)])
+                lines.append('loadtest_phase_state' + labels + ' ' + str(int(each_state == state)))
+        return '\n'.join(lines) + '\n'
+    #} End method render
+
+    def __last_report(self, series, count): #{
+        # Returns the (end, kbps, jitter, lost, total) of the last complete interval, aggregated the same way as
+        # ThroughputSeries.aggregate(): its [SUM] report if the series has them, otherwise the reports of its streams
+        # added together. The reports of an interval are parsed one at a time, so an interval isn't complete until its
+        # [SUM] report (or a report of every stream) is in, and until then the interval before it is used:
+        columns = series.columns
+        streams = set(columns['stream'][:count])
+        has_sum = -1 in streams
+        streams.discard(-1)
+        last = count
+        while last > 0:
+            first = last - 1
+            while first > 0 and round(columns['start'][first - 1], 1) == round(columns['start'][last - 1], 1):
+                first -= 1
+            rows = range(first, last)
+            for row in rows:
+                if columns['stream'][row] == -1:
+                    return (columns['end'][row], columns['kbps'][row], columns['jitter'][row], columns['lost'][row],
+                            columns['total'][row])
+            if not has_sum and len(rows) >= len(streams):
+                jitter = [columns['jitter'][row] for row in rows if not math.isnan(columns['jitter'][row])]
+                lost = [columns['lost'][row] for row in rows if columns['lost'][row] >= 0]
+                total = [columns['total'][row] for row in rows if columns['total'][row] >= 0]
+                return (max([columns['end'][row] for row in rows]), sum([columns['kbps'][row] for row in rows]),
+                        sum(jitter) / len(jitter) if jitter else float('nan'), sum(lost) if lost else -1,
+                        sum(total) if total else -1)
+            last = first
+        # No complete interval yet, so the last report on its own:
+        row = count - 1
+        return (columns['end'][row], columns['kbps'][row], columns['jitter'][row], columns['lost'][row],
+                columns['total'][row])
+    #} End method __last_report
+#} End class MetricsExporter
+
+
+def format_labels(labels): #{
+    '''
+    Returns the {name="value",...} part of a sample from a list of (name, value) tuples
+    '''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(name + '="' + value + '"')
+    return '{' + ','.join(pairs) + '}'
+#} End method format_labels
+
+
+def format_value(value): #{
+    '''
+    Returns a sample value as Prometheus expects it (NaN rather than Python's nan)
+    '''
+    if isinstance(value, float):
+        if math.isnan(value): return 'NaN'
+        if math.isinf(value): return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+#} End method format_value
@@ -0,0 +1,206 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.PortAllocator hands out the iperf server ports for every UE and phase of a test, so that no two servers share a
+port on the same host, whatever the number of UEs, and no server is given a port that is already in use.
+
+PortAllocator.py implements the PortAllocator class and methods, as well as the get_used_ports() and is_local_port_free()
+functions.
+'''
+
+import re
+import socket
+import logging
+from threading import Thread
+
+# Runs on the test server to list every port in use there (ss on modern Linux, netstat everywhere else):
+PORTS_COMMAND = 'ss -tuan 2>/dev/null || netstat -an'
+# The first address:port (or address.port for BSD netstat) field on each line is the local address:
+LOCAL_PORT = re.compile(r'(?:^|\s)\S*[:.](\d+)(?=\s)')
+
+
+class PortAllocator(object): #{
+    '''
+    class PortAllocator(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __pool = SSHPool used to list the ports in use on the test servers
+        __base = First port handed out on each host
+        __limit = Last port that may be handed out
+        __requests = List of (key, host) tuples waiting for allocate()
+        __ports = Dictionary of key to allocated port
+        __hosts = Dictionary of key to the host the port was allocated on
+
+    Overview:
+    Each port the test needs is requested with the host its iperf server listens on: 'local' for the DL servers on this
+    machine, or the ftpServer triplet of the test server for the UL servers. allocate() then works out which ports are
+    already in use: locally by trying to bind every candidate port (TCP and UDP), and on each test server by listing its
+    ports with one command over the SSH pool (all servers at the same time). Ports are then handed out in request order,
+    counting up from the base port separately on each host and skipping those in use.
+    The old fixed scheme (5000 + (phase + 1) * 30 + ueId etc.) collided as soon as the UE IDs went past 30. Here the only
+    limit is the number of free ports between base and limit on each host.
+
+    Public methods:
+    request(self, key, host):
+    Asks for a port on host ('local' or an ftpServer triplet), to be looked up by key after allocate() has been called.
+
+    allocate(self):
+    Probes the hosts and allocates a port to every outstanding request. Raises RuntimeError if a host runs out of ports.
+
+    restore(self, assignments, ftpservers):
+    Takes the allocations from an earlier get_assignments() (e.g. a cached test plan) instead of allocating, if all the
+    ports are still free. ftpservers is the list of test server ftpServer triplets. Returns False if any port isn't.
+
+    get_port(self, key):
+    Returns the port allocated to key.
+
+    get_assignments(self):
+    Returns a list of dicts with the key, host and port of every allocation, for the run metadata.
+
+    '''
+
+    def __init__(self, pool, base=5000, limit=65535): #{
+        '''
+        Constructor:
+            pool = SSHPool for the test servers
+            base = first port to hand out
+            limit = last port to hand out
+        '''
+        self.__pool = pool
+        self.__base = base
+        self.__limit = limit
+        self.__requests = []
+        self.__ports = {}
+        self.__hosts = {}
+    #} End method __init__
+
+    def request(self, key, host): #{
+        self.__requests.append((key, host))
+    #} End method request
+
+    def allocate(self): #{
+        hosts = {}
+        for key, host in self.__requests:
+            hosts[self.__host_key(host)] = host
+
+        used = self.__probe_all(hosts)
+        next_port = {}
+        for key, host in self.__requests:
+            host_key = self.__host_key(host)
+            port = next_port.get(host_key, self.__base)
+            while port <= self.__limit:
+                if host == 'local':
+                    if is_local_port_free(port): break
+                elif port not in used.get(host_key, ()):
+                    break
+                logging.debug('Port ' + str(port) + ' is in use on ' + host_key + ', skipping it')
+                port += 1
+            if port > self.__limit:
+                raise RuntimeError('No free ports left on ' + host_key + ' between ' + str(self.__base) + ' and ' +
+                                   str(self.__limit))
+            self.__ports[key] = port
+            self.__hosts[key] = host_key
+            next_port[host_key] = port + 1
+        self.__requests = []
+    #} End method allocate
+
+    def restore(self, assignments, ftpservers): #{
+        host_keys = set([assignment['host'] for assignment in assignments])
+        servers = dict([(ftpserver[0], ftpserver) for ftpserver in ftpservers if ftpserver[0] in host_keys])
+        used = self.__probe_all(servers)
+        for assignment in assignments:
+            host_key, port = assignment['host'], assignment['port']
+            if not self.__base <= port <= self.__limit:
+                logging.debug('Cached port ' + str(port) + ' is outside ' + str(self.__base) + '-' + str(self.__limit))
+                return False
+            if host_key == 'local':
+                if is_local_port_free(port): continue
+            elif host_key in used and port not in used[host_key]:
+                continue
+            # Taken since the plan was cached, or the server couldn't be checked:
+            logging.debug('Cached port ' + str(port) + ' on ' + host_key + ' is not free, allocating the ports again')
+            return False
+        for assignment in assignments:
+            key = assignment['key']
+            key = tuple(key) if isinstance(key, list) else key
+            self.__ports[key] = assignment['port']
+            self.__hosts[key] = assignment['host']
+        self.__requests = []
+        return True
+    #} End method restore
+
+    def get_port(self, key): #{
+        return self.__ports[key]
+    #} End method get_port
+
+    def get_assignments(self): #{
+        assignments = []
+        for key in sorted(self.__ports.keys()):
+            assignments.append({'key': list(key) if isinstance(key, tuple) else key,
+                                'host': self.__hosts[key], 'port': self.__ports[key]})
+        return assignments
+    #} End method get_assignments
+
+    def __host_key(self, host): #{
+        # host is either 'local' or the [ip, username, password] list from the UE config
+        if host == 'local': return host
+        return host[0]
+    #} End method __host_key
+
+    def __probe_all(self, hosts): #{
+        # List the used ports on all the test servers at the same time. hosts is a dictionary of host key to host:
+        used = {}
+        threads = []
+        for host_key, host in hosts.items():
+            if host == 'local': continue
+            t = Thread(target=self.__probe_remote, args=[host, used])
+            t.setName('port-probe-' + host_key)
+            threads.append(t)
+            t.start()
+        for t in threads:
+            t.join()
+        return used
+    #} End method __probe_all
+
+    def __probe_remote(self, ftpserver, used): #{
+        try:
+            _, output = self.__pool.read_command(ftpserver, PORTS_COMMAND)
+            used[ftpserver[0]] = get_used_ports(output)
+            logging.debug(str(len(used[ftpserver[0]])) + ' ports in use on ' + ftpserver[0])
+        except Exception, e:
+            # Carry on regardless, the ports just won't have been checked:
+            logging.warning('Could not list the ports in use on ' + ftpserver[0] + ': ' + str(e))
+    #} End method __probe_remote
+#} End class PortAllocator
+
+
+def get_used_ports(output): #{
+    '''
+    Returns the set of local ports in the output of ss -tuan or netstat -an
+    '''
+    ports = set()
+    for line in output.splitlines():
+        match = LOCAL_PORT.search(line + ' ')
+        if match is not None: ports.add(int(match.group(1)))
+    return ports
+#} End method get_used_ports
+
+
+def is_local_port_free(port): #{
+    '''
+    Returns True if nothing on this machine is bound to the port, TCP or UDP
+    '''
+    for sock_type in (socket.SOCK_STREAM, socket.SOCK_DGRAM):
+        sock = socket.socket(socket.AF_INET, sock_type)
+        try:
+            sock.bind(('', port))
+        except socket.error:
+            return False
+        finally:
+            sock.close()
+    return True
+#} End method is_local_port_free
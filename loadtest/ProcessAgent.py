@@ -0,0 +1,266 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.ProcessAgent runs every remote iperf of a test server through one small agent process on that server, started
+once over a single SSH channel, instead of opening a channel (and a shell) per iperf and per kill.
+
+ProcessAgent.py implements the ProcessAgent and AgentStream classes and methods.
+'''
+
+import os
+import json
+import logging
+from Queue import Queue
+from threading import Thread, Event, Lock
+
+# The agent program, sent over the channel and run by the server's Python (see ProcessAgentScript.py):
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ProcessAgentScript.py')
+# Runs the agent with python3, or python if there is no python3. The agent reads its own source from the start of stdin,
+# and its commands from the rest:
+BOOTSTRAP = 'P=`command -v python3 || command -v python` && exec $P -u -c "import sys; exec(sys.stdin.read(%d))"'
+# Seconds to wait for the agent to start, and for it to answer a status command:
+HELLO_TIMEOUT = 15.0
+STATUS_TIMEOUT = 5.0
+
+
+class AgentStream(object): #{
+    '''
+    class AgentStream(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __queue = Queue of the chunks of output received for the process, None at the end
+        __buffer = What is left of the last chunk after a short recv()
+        __status = Exit status of the process (None until it has exited)
+        __exited = threading.Event set once the process has exited
+
+    Overview:
+    The output of one process run by the agent. It stands in for the stdout file of an exec_command channel, so that
+    StreamCapture and UEPhase handle it as they do a channel: channel is the stream itself, and it has the recv(),
+    exit_status_ready() and close() methods of a paramiko Channel.
+
+    Public methods:
+    recv(self, size):
+    Returns up to size bytes of output, blocking until there is some. Returns '' at the end of the output.
+
+    exit_status_ready(self):
+    Returns True once the process has exited.
+
+    recv_exit_status(self):
+    Waits for the process to exit and returns its exit status.
+
+    close(self):
+    Ends the output (the process itself is killed through the agent).
+
+    feed(self, data):
+    Called by the ProcessAgent with every chunk of output.
+
+    finish(self, status):
+    Called by the ProcessAgent when the process has exited.
+
+    '''
+
+    def __init__(self): #{
+        '''
+        Constructor
+        '''
+        self.channel = self
+        self.__queue = Queue()
+        self.__buffer = ''
+        self.__status = None
+        self.__exited = Event()
+    #} End method __init__
+
+    def recv(self, size): #{
+        if not self.__buffer:
+            data = self.__queue.get()
+            if data is None:
+                # Leave the end marker for anyone else reading:
+                self.__queue.put(None)
+                return ''
+            self.__buffer = data
+        data, self.__buffer = self.__buffer[:size], self.__buffer[size:]
+        return data
+    #} End method recv
+
+    def exit_status_ready(self): #{
+        return self.__exited.is_set()
+    #} End method exit_status_ready
+
+    def recv_exit_status(self): #{
+        self.__exited.wait()
+        return self.__status
+    #} End method recv_exit_status
+
+    def close(self): #{
+        self.__queue.put(None)
+    #} End method close
+
+    def feed(self, data): #{
+        self.__queue.put(data)
+    #} End method feed
+
+    def finish(self, status): #{
+        self.__status = status
+        self.__exited.set()
+        self.__queue.put(None)
+    #} End method finish
+#} End class AgentStream
+
+
+class ProcessAgent(object): #{
+    '''
+    class ProcessAgent(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __pool = SSHPool the agent's channel is opened through
+        __ftpserver = ftpServer triplet of the server
+        __channel = The paramiko Channel the agent runs on
+        __lock = threading.Lock guarding __streams and the writes to the channel
+        __streams = Dictionary of handle to the AgentStream of every process that hasn't exited
+        __hello = threading.Event set when the agent has started (or its channel has closed without it starting)
+        __python = Version of the Python the agent is running on (None until it has started)
+        __status = Last status reply from the agent
+        __status_event = threading.Event set when a status reply arrives
+        __reader = Thread reading the agent's events
+
+    Overview:
+    start() opens one channel to the server and runs ProcessAgentScript.py there, with the server's own Python (2 or 3,
+    nothing needs installing). After that, starting or killing any number of processes is a line written to the channel,
+    with no new channel, shell or ps pipeline on the server. The agent spawns and reaps the processes itself, and sends
+    back their output, a line at a time and tagged with their handle, over the same channel. The reader thread hands
+    each line to the AgentStream of its process.
+    The agent writes each process's PID to the same PID file as RemoteProcesses would, so sweep() still finds anything
+    left over. It kills everything it started as soon as its channel closes, so a test machine that crashes or loses
+    its connection leaves nothing running.
+
+    Public methods:
+    start(self):
+    Starts the agent. Raises RuntimeError if it doesn't start (e.g. the server has no Python).
+
+    run(self, handle, commands, pid_file):
+    Runs the commands one after the other (as RemoteProcesses.start_chain) and returns their AgentStream.
+
+    kill(self, handles):
+    Kills the processes, without waiting.
+
+    get_status(self):
+    Returns a dictionary of handle to PID of every process the agent has running.
+
+    close(self):
+    Closes the channel, which kills anything still running and stops the agent.
+
+    '''
+
+    def __init__(self, pool, ftpserver): #{
+        '''
+        Constructor:
+            pool = SSHPool for the server
+            ftpserver = ftpServer triplet of the server
+        '''
+        self.__pool = pool
+        self.__ftpserver = ftpserver
+        self.__channel = None
+        self.__lock = Lock()
+        self.__streams = {}
+        self.__hello = Event()
+        self.__python = None
+        self.__status = None
+        self.__status_event = Event()
+        self.__reader = None
+    #} End method __init__
+
+    def start(self): #{
+        script_file = open(SCRIPT_PATH, 'rb')
+        script = script_file.read()
+        script_file.close()
+        self.__channel = self.__pool.open_channel(self.__ftpserver)
+        self.__channel.exec_command(BOOTSTRAP % len(script))
+        self.__channel.sendall(script)
+        self.__reader = Thread(target=self.__read_loop)
+        self.__reader.setName('agent-' + self.__ftpserver[0])
+        self.__reader.setDaemon(True)
+        self.__reader.start()
+        self.__hello.wait(HELLO_TIMEOUT)
+        if self.__python is None:
+            self.__channel.close()
+            raise RuntimeError('the process agent did not start on ' + self.__ftpserver[0])
+    #} End method start
+
+    def run(self, handle, commands, pid_file): #{
+        stream = AgentStream()
+        with self.__lock:
+            self.__streams[handle] = stream
+        self.__send({'op': 'start', 'id': handle, 'commands': commands, 'pidfile': pid_file})
+        return stream
+    #} End method run
+
+    def kill(self, handles): #{
+        self.__send({'op': 'kill', 'ids': handles})
+    #} End method kill
+
+    def get_status(self): #{
+        self.__status_event.clear()
+        self.__send({'op': 'status'})
+        if not self.__status_event.wait(STATUS_TIMEOUT):
+            raise RuntimeError('no status from the process agent on ' + self.__ftpserver[0])
+        return self.__status
+    #} End method get_status
+
+    def close(self): #{
+        if self.__channel is None: return
+        self.__channel.close()
+        self.__reader.join(5)
+    #} End method close
+
+    def __send(self, command): #{
+        data = json.dumps(command) + '\n'
+        with self.__lock:
+            self.__channel.sendall(data)
+    #} End method __send
+
+    def __read_loop(self): #{
+        reader = self.__channel.makefile('rb', -1)
+        try:
+            for line in reader:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    logging.warning('Unexpected output from the process agent on ' + self.__ftpserver[0] + ': ' + line)
+                    continue
+                handle = str(event.get('id'))
+                if event['ev'] == 'out':
+                    with self.__lock:
+                        stream = self.__streams.get(handle)
+                    if stream is not None: stream.feed(event['data'].encode('latin-1'))
+                elif event['ev'] == 'started':
+                    logging.debug('Process agent on ' + self.__ftpserver[0] + ' started ' + handle + ', pid ' +
+                                  str(event['pid']))
+                elif event['ev'] == 'exit':
+                    with self.__lock:
+                        stream = self.__streams.pop(handle, None)
+                    if stream is not None: stream.finish(event['status'])
+                elif event['ev'] == 'hello':
+                    self.__python = str(event['python'])
+                    logging.debug('Process agent started on ' + self.__ftpserver[0] + ' with Python ' + self.__python)
+                    self.__hello.set()
+                elif event['ev'] == 'status':
+                    self.__status = dict([(str(h), pid) for h, pid in event['running'].items()])
+                    self.__status_event.set()
+                elif event['ev'] == 'error':
+                    logging.warning('Process agent on ' + self.__ftpserver[0] + ': ' + event['message'])
+        except Exception, e:
+            logging.debug('Process agent channel to ' + self.__ftpserver[0] + ' closed: ' + str(e))
+        finally:
+            # The agent has gone, and took its processes with it:
+            with self.__lock:
+                streams = self.__streams.values()
+                self.__streams = {}
+            for stream in streams:
+                stream.finish(None)
+            self.__hello.set()
+    #} End method __read_loop
+#} End class ProcessAgent
@@ -0,0 +1,146 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.ProcessAgentScript is the program run on a test server by ProcessAgent: it is not imported by the load test,
+but sent as it is over the SSH channel and run by whichever Python the server has. So unlike the rest of the load test
+it has to run on Python 2 and 3 alike (hence 'except ... as e'), and may only use the standard library.
+
+It reads one JSON command per line on stdin:
+    {"op": "start", "id": <handle>, "commands": [<command>, ...], "pidfile": <path>}
+        Runs the commands one after the other (stopping at the first that fails or is killed), writing the PID of the
+        one running to pidfile.
+    {"op": "kill", "ids": [<handle>, ...]}
+        Kills the processes, and the rest of their commands with them.
+    {"op": "status"}
+        Reports the PID of every process running.
+and writes one JSON event per line on stdout:
+    {"ev": "hello", "version": <VERSION>, "python": <version>}   once it has started
+    {"ev": "started", "id": <handle>, "pid": <pid>}             for every process started
+    {"ev": "out", "id": <handle>, "data": <output>}             for every line of output (stderr included)
+    {"ev": "exit", "id": <handle>, "status": <exit status>}     once the last command of a handle has ended
+    {"ev": "status", "running": {<handle>: <pid>, ...}}         in reply to status
+    {"ev": "error", "message": <message>}                       for a command it couldn't run
+When stdin closes (the channel is closed, or the SSH connection lost) every process is killed and the agent exits, so
+nothing is ever left running on the server.
+
+ProcessAgentScript.py implements the main() function and its helpers.
+'''
+
+import os
+import sys
+import json
+import time
+import shlex
+import subprocess
+import threading
+
+VERSION = 1
+
+output_lock = threading.Lock()
+process_lock = threading.Lock()
+# Handle to the Popen of its running process, and the handles that have been killed:
+processes = {}
+killed = set()
+
+
+def emit(event): #{
+    data = json.dumps(event) + '\n'
+    with output_lock:
+        sys.stdout.write(data)
+        sys.stdout.flush()
+#} End method emit
+
+
+def run(handle, commands, pidfile): #{
+    '''
+    Thread target: runs the commands of one handle in turn
+    '''
+    status = None
+    pidfile = os.path.expanduser(pidfile)
+    for command in commands:
+        with process_lock:
+            if handle in killed: break
+            try:
+                process = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                           stdin=open(os.devnull), close_fds=True)
+            except OSError as e:
+                emit({'ev': 'out', 'id': handle, 'data': command.split()[0] + ': ' + str(e) + '\n'})
+                status = 127
+                break
+            processes[handle] = process
+        try:
+            pid_out = open(pidfile, 'w')
+            pid_out.write(str(process.pid) + '\n')
+            pid_out.close()
+        except (IOError, OSError):
+            pass
+        emit({'ev': 'started', 'id': handle, 'pid': process.pid})
+        for line in iter(process.stdout.readline, b''):
+            emit({'ev': 'out', 'id': handle, 'data': line.decode('latin-1')})
+        status = process.wait()
+        if status != 0: break
+    with process_lock:
+        processes.pop(handle, None)
+        killed.discard(handle)
+    try:
+        os.remove(pidfile)
+    except OSError:
+        pass
+    emit({'ev': 'exit', 'id': handle, 'status': status})
+#} End method run
+
+
+def kill(handles): #{
+    with process_lock:
+        for handle in handles:
+            killed.add(handle)
+            process = processes.get(handle)
+            if process is None: continue
+            try:
+                process.kill()
+            except OSError:
+                pass
+#} End method kill
+
+
+def main(): #{
+    pid_dir = None
+    emit({'ev': 'hello', 'version': VERSION, 'python': sys.version.split()[0]})
+    while True:
+        line = sys.stdin.readline()
+        if not line: break
+        try:
+            command = json.loads(line)
+            if command['op'] == 'start':
+                if pid_dir is None:
+                    pid_dir = os.path.dirname(os.path.expanduser(command['pidfile']))
+                    if not os.path.isdir(pid_dir): os.makedirs(pid_dir)
+                thread = threading.Thread(target=run, args=(command['id'], command['commands'], command['pidfile']))
+                thread.daemon = True
+                thread.start()
+            elif command['op'] == 'kill':
+                kill(command['ids'])
+            elif command['op'] == 'status':
+                with process_lock:
+                    running = dict([(handle, process.pid) for handle, process in processes.items()])
+                emit({'ev': 'status', 'running': running})
+        except Exception as e:
+            emit({'ev': 'error', 'message': str(e)})
+    # The load test has gone, so nothing it started should carry on:
+    with process_lock:
+        handles = list(processes.keys())
+    kill(handles)
+    # Give the threads a moment to reap them and remove their PID files:
+    deadline = time.time() + 2
+    while processes and time.time() < deadline:
+        time.sleep(0.05)
+    os._exit(0)
+#} End method main
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.RateProfile holds the UDP rate profile of one UE and direction: any number of (time, rate, length) points, held
+as steps or ramped between, in place of the fixed t0/t1/t2 phases.
+
+RateProfile.py implements the RateProfile class and methods, as well as the parse_profile() function.
+'''
+
+import math
+
+from loadtest.IntervalParser import parse_size
+
+# Ramps run by a chain of iperf clients (see get_steps) are split into steps of at most this many seconds:
+RAMP_STEP = 5
+
+
+class RateProfile(object): #{
+    '''
+    class RateProfile(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __points = List of (time, rate, length) tuples, in time order, time in seconds from the start of the test, rate
+            and length as iperf -b and -l strings (e.g. '32M' and '1200B')
+        __end = Time the profile ends, in seconds from the start of the test
+        __is_ramp = True if the rate is ramped linearly from each point to the next, False if it is held until the next
+
+    Overview:
+    A profile is written in the UE config as a comma-separated list of time/rate/length points, ending with the time the
+    profile ends, e.g. 0/2M/1200B, 40/8M/1200B, 100/16M/1200B, 200
+    The whole profile is run as a single phase. Where the sending side is this machine (UL), it is run by one native
+    sender which changes its rate on the fly (see TrafficEngine.UDPSender), so the steps cost nothing. Where the sending
+    side is the iperf on the test server (DL), the rate can't be changed once it's running, so the profile is run as a
+    chain of iperf clients, one per step, by one SSH command and against the same receiver (see get_steps).
+    Rates are in bits/sec, lengths in bytes, both parsed as iperf does (see IntervalParser.parse_size).
+
+    Public methods:
+    get_start(self):
+    Returns the time of the first point.
+
+    get_duration(self):
+    Returns the seconds from the first point to the end.
+
+    get_segment(self, elapsed):
+    Returns the (rate, length) elapsed seconds after the first point.
+
+    get_max_length(self):
+    Returns the longest datagram length of the profile.
+
+    get_steps(self):
+    Returns the profile as a list of (duration, rate, length) steps to run one after the other, with each ramp split
+    into steps of up to RAMP_STEP seconds at the ramp's mean rate over the step.
+
+    get_tail(self, elapsed):
+    Returns a new profile starting elapsed seconds after the first point, at time 0.
+
+    to_option(self):
+    Returns the profile as the value of the native engine's --profile option, with times from the first point.
+
+    '''
+
+    def __init__(self, points, end, is_ramp=False): #{
+        '''
+        Constructor:
+            points = list of (time, rate, length) tuples, see above
+            end = time the profile ends
+            is_ramp = True to ramp between the points
+        '''
+        if not points: raise ValueError('A rate profile needs at least one point')
+        times = [time for time, _, _ in points] + [end]
+        if times != sorted(times) or len(set(times)) != len(times):
+            raise ValueError('The times of a rate profile must increase, and the last one is the end time')
+        self.__points = points
+        self.__end = end
+        self.__is_ramp = is_ramp
+    #} End method __init__
+
+    def get_start(self): #{
+        return self.__points[0][0]
+    #} End method get_start
+
+    def get_duration(self): #{
+        return self.__end - self.__points[0][0]
+    #} End method get_duration
+
+    def get_segment(self, elapsed): #{
+        time = self.__points[0][0] + elapsed
+        index = 0
+        while index + 1 < len(self.__points) and self.__points[index + 1][0] <= time:
+            index += 1
+        start, rate, length = self.__points[index]
+        rate = parse_size(rate)
+        if self.__is_ramp and index + 1 < len(self.__points):
+            next_time, next_rate, _ = self.__points[index + 1]
+            rate += (parse_size(next_rate) - rate) * (time - start) / (next_time - start)
+        return rate, int(parse_size(length))
+    #} End method get_segment
+
+    def get_max_length(self): #{
+        return max([int(parse_size(length)) for _, _, length in self.__points])
+    #} End method get_max_length
+
+    def get_steps(self): #{
+        steps = []
+        times = [time for time, _, _ in self.__points] + [self.__end]
+        for index, (start, rate, length) in enumerate(self.__points):
+            duration = times[index + 1] - start
+            if not self.__is_ramp or index + 1 == len(self.__points):
+                steps.append((duration, int(parse_size(rate)), length))
+                continue
+            count = int(math.ceil(float(duration) / RAMP_STEP))
+            step_start = 0
+            for step in range(count):
+                step_end = int(round(duration * (step + 1) / float(count)))
+                # The mean rate of a linear ramp over the step is its rate half way through the step:
+                mean_rate, _ = self.get_segment(start - self.get_start() + (step_start + step_end) / 2.0)
+                steps.append((step_end - step_start, int(mean_rate), length))
+                step_start = step_end
+        return [step for step in steps if step[0] > 0]
+    #} End method get_steps
+
+    def get_tail(self, elapsed): #{
+        time = self.__points[0][0] + elapsed
+        rate, _ = self.get_segment(elapsed)
+        points = [(0, str(int(rate)), self.__points[0][2])]
+        for point_time, point_rate, length in self.__points:
+            if point_time <= time: points[0] = (0, str(int(rate)) if self.__is_ramp else point_rate, length)
+            else: points.append((point_time - time, point_rate, length))
+        return RateProfile(points, self.__end - time, self.__is_ramp)
+    #} End method get_tail
+
+    def to_option(self): #{
+        start = self.get_start()
+        return ','.join(['%g/%s/%s' % (time - start, rate, length) for time, rate, length in self.__points] +
+                        ['%g' % (self.__end - start)])
+    #} End method to_option
+#} End class RateProfile
+
+
+def parse_profile(value, is_ramp=False): #{
+    '''
+    Returns the RateProfile of a profile config item, e.g. '0/2M/1200B, 40/8M/1200B, 200'.
+    value is either the string, or the list of its comma-separated parts as returned by TestConfig.get_list.
+    '''
+    parts = value if isinstance(value, list) else value.split(',')
+    parts = [part.strip() for part in parts if part.strip()]
+    if len(parts) < 2: raise ValueError('A rate profile needs at least one time/rate/length point and an end time: ' +
+                                        str(value))
+    points = []
+    for part in parts[:-1]:
+        fields = part.split('/')
+        if len(fields) != 3: raise ValueError('Rate profile points must be time/rate/length: ' + part)
+        # Check the rate and length parse now, rather than when the test is running:
+        parse_size(fields[1])
+        parse_size(fields[2])
+        points.append((float(fields[0]), fields[1], fields[2]))
+    return RateProfile(points, float(parts[-1]), is_ramp)
+#} End method parse_profile
@@ -0,0 +1,260 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.RemoteProcesses starts the remote iperf processes and keeps track of their PIDs, so they can be killed by PID
+(a handful of kills in one command per server) instead of by grepping the output of ps for every UE.
+
+RemoteProcesses.py implements the RemoteProcesses class and methods only.
+'''
+
+import re
+import socket
+import logging
+import itertools
+from threading import Lock, Thread
+
+from loadtest.ProcessAgent import ProcessAgent
+from loadtest.SSHPool import get_server_name
+from loadtest import Tracing
+
+# Runs on the test server for each PID file in $files: kills the process if it is still an iperf (so a PID that has been
+# re-used since is left alone), then removes the file. Prints the PIDs it killed.
+# The stop file of a chain is written before its PID is read, so that the chain can't start another command after it,
+# and a chain's PID is killed while it is still the shell of one of its commands (it was written by the command itself,
+# which may not have reached its exec yet, see start_chain):
+KILL_SCRIPT = 'for f in $files; do [ -f "$f" ] || continue; case "$f" in *.chain) : > "$f.stop";; esac; p=`cat "$f"`; ' \
+              'c=`ps -p $p -o comm= 2>/dev/null`; case "$f:$c" in *.chain:sh|*.chain:dash|*.chain:bash) c=iperf;; esac; ' \
+              'case "$c" in *iperf*) kill -9 $p && echo $p;; esac; rm -f "$f"; done'
+
+
+class RemoteProcesses(object): #{
+    '''
+    class RemoteProcesses(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __pool = SSHPool the commands are run through
+        __pid_dir = Directory on the test servers holding the PID files of this machine's processes (of this scope)
+        __lock = threading.Lock guarding __running, __doomed and __killers
+        __running = Dictionary of server name (see SSHPool.get_server_name) to a dict of PID file name to ftpServer
+            triplet, for every process started and not yet killed
+        __doomed = Dictionary of server name to the list of PID file names waiting to be killed
+        __killers = Dictionary of server name to the thread currently killing processes on that server
+        __sequence = Counter used to give every process its own PID file
+        __agents = Dictionary of server name to the ProcessAgent running that server's processes (see start_agents)
+
+    Overview:
+    Every remote command is started as 'echo $$ > <pid file> && exec <command>', so the shell writes its PID to a file
+    and then becomes the command, with the same PID. The PID files live in ~/.loadtest_pids/<this machine's name> on the
+    server, so a run only ever touches its own processes even if several test machines share a server. If a scope is
+    given (e.g. the port block of a Distributed agent), the directory is <this machine's name>-<scope>, so that several
+    runs on the same machine (which sweep at their own start) don't touch each other's processes either.
+    kill() doesn't wait: it queues the processes, and one thread per server kills everything queued so far with a single
+    command. So when lots of phases stop at once (e.g. Ctrl-C), the kills go out in one or two commands per server
+    however many UEs there are. teardown() kills whatever is still running at the end of the test the same way.
+    sweep() is run at the start of a test, and kills any iperf left over from an earlier run that never got torn down
+    (e.g. the test machine crashed), so that they don't skew the new results.
+    If start_agents() has been called, the processes on each server are run by a ProcessAgent instead: one channel
+    per server for the whole test, and starts and kills are single lines written to it rather than a channel and a
+    shell each. A server the agent can't be started on (e.g. it has no Python) carries on as above.
+
+    Public methods:
+    sweep(self, ftpservers):
+    Kills the processes left over from earlier runs on every distinct server in the list. Returns the number killed.
+
+    start_agents(self, ftpservers):
+    Starts a ProcessAgent on every distinct server in the list, in parallel, to run that server's processes from now on.
+
+    start(self, ftpserver, name, command):
+    Runs command on the server, recording its PID. Returns a (handle, stdout) tuple: the handle is used to kill the
+    process, and stdout is the file object of the channel's output.
+
+    start_chain(self, ftpserver, name, commands):
+    As start(), but runs each of the commands in turn, in the one channel. The handle kills whichever is running, and
+    the rest of the chain with it.
+
+    kill(self, ftpserver, handles):
+    Queues the processes to be killed, and returns straight away.
+
+    flush(self):
+    Waits until every queued kill has been done.
+
+    teardown(self):
+    Kills every process still running with one command per server, and waits for it to be done.
+
+    get_pool(self):
+    Returns the SSHPool.
+
+    '''
+
+    def __init__(self, pool, scope=None): #{
+        '''
+        Constructor:
+            pool = SSHPool for the test servers
+            scope = name telling this run's PID files apart from those of other runs on this machine, or None
+        '''
+        self.__pool = pool
+        pid_dir = socket.gethostname() + ('-' + str(scope) if scope is not None else '')
+        self.__pid_dir = '~/.loadtest_pids/' + re.sub(r'[^A-Za-z0-9_.-]', '_', pid_dir)
+        self.__lock = Lock()
+        self.__running = {}
+        self.__doomed = {}
+        self.__killers = {}
+        self.__sequence = itertools.count()
+        self.__agents = {}
+    #} End method __init__
+
+    def sweep(self, ftpservers): #{
+        unique_servers = {}
+        for ftpserver in ftpservers:
+            unique_servers[get_server_name(ftpserver)] = ftpserver
+        killed = []
+        threads = []
+        for ftpserver in unique_servers.values():
+            t = Thread(target=self.__sweep_server, args=[ftpserver, killed])
+            t.setName('sweep-' + ftpserver[0])
+            threads.append(t)
+            t.start()
+        for t in threads:
+            t.join()
+        return len(killed)
+    #} End method sweep
+
+    def start_agents(self, ftpservers): #{
+        unique_servers = {}
+        for ftpserver in ftpservers:
+            unique_servers[get_server_name(ftpserver)] = ftpserver
+        threads = []
+        for ftpserver in unique_servers.values():
+            t = Thread(target=self.__start_agent, args=[ftpserver])
+            t.setName('agent-start-' + ftpserver[0])
+            threads.append(t)
+            t.start()
+        for t in threads:
+            t.join()
+    #} End method start_agents
+
+    def start(self, ftpserver, name, command): #{
+        handle = name + '_' + str(next(self.__sequence)) + '.pid'
+        server = get_server_name(ftpserver)
+        with self.__lock:
+            self.__running.setdefault(server, {})[handle] = ftpserver
+        agent = self.__agents.get(server)
+        if agent is not None: return handle, agent.run(handle, [command], self.__pid_dir + '/' + handle)
+        _, stdout, _ = self.__pool.exec_command(ftpserver, 'mkdir -p ' + self.__pid_dir + ' && echo $$ > ' +
+                                                self.__pid_dir + '/' + handle + ' && exec ' + command)
+        return handle, stdout
+    #} End method start
+
+    def start_chain(self, ftpserver, name, commands): #{
+        handle = name + '_' + str(next(self.__sequence)) + '.chain'
+        server = get_server_name(ftpserver)
+        with self.__lock:
+            self.__running.setdefault(server, {})[handle] = ftpserver
+        pid_file = self.__pid_dir + '/' + handle
+        agent = self.__agents.get(server)
+        if agent is not None: return handle, agent.run(handle, commands, pid_file)
+        # Each command writes its own PID over the last one's, so the handle always kills the one that is running. A
+        # killed command stops the chain. A kill also leaves a stop file, and each command only checks for it after it
+        # has written its PID, so either the kill reads that PID (and kills it, even before the exec) or the command sees
+        # the stop file and doesn't start:
+        stop_file = pid_file + '.stop'
+        steps = ['sh -c \'echo $$ > ' + pid_file + ' && [ ! -f ' + stop_file + ' ] && exec ' + command + '\''
+                 for command in commands]
+        _, stdout, _ = self.__pool.exec_command(ftpserver, 'mkdir -p ' + self.__pid_dir + ' && rm -f ' + stop_file +
+                                                ' && touch ' + pid_file + ' && ' + ' && '.join(steps) + '; rm -f ' +
+                                                pid_file + ' ' + stop_file)
+        return handle, stdout
+    #} End method start_chain
+
+    def kill(self, ftpserver, handles): #{
+        if not handles: return
+        server = get_server_name(ftpserver)
+        agent = self.__agents.get(server)
+        if agent is not None:
+            with self.__lock:
+                for handle in handles:
+                    self.__running.get(server, {}).pop(handle, None)
+            agent.kill(handles)
+            return
+        with self.__lock:
+            self.__doomed.setdefault(server, []).extend(handles)
+            # If there's already a killer for the server, it will pick these up when it's done with the last lot:
+            if server in self.__killers: return
+            killer = Thread(target=self.__kill_queued, args=[ftpserver])
+            killer.setName('kill-' + server)
+            killer.setDaemon(True)
+            self.__killers[server] = killer
+        killer.start()
+    #} End method kill
+
+    def flush(self): #{
+        while True:
+            with self.__lock:
+                killers = self.__killers.values()
+            if not killers: return
+            for killer in killers:
+                killer.join()
+    #} End method flush
+
+    def teardown(self): #{
+        with self.__lock:
+            running = [(handles.values()[0], handles.keys()) for handles in self.__running.values() if handles]
+        for ftpserver, handles in running:
+            self.kill(ftpserver, handles)
+        self.flush()
+        # Closing an agent's channel kills anything it still has running, and stops it:
+        for agent in self.__agents.values():
+            agent.close()
+        self.__agents = {}
+    #} End method teardown
+
+    def get_pool(self): #{
+        return self.__pool
+    #} End method get_pool
+
+    def __kill_queued(self, ftpserver): #{
+        server = get_server_name(ftpserver)
+        while True:
+            with self.__lock:
+                handles = self.__doomed.pop(server, [])
+                if not handles:
+                    # Nothing more was queued while the last command ran:
+                    del self.__killers[server]
+                    return
+                for handle in handles:
+                    self.__running.get(server, {}).pop(handle, None)
+            try:
+                with Tracing.span('remote.kill', server=server, processes=len(handles)):
+                    _, output = self.__pool.read_command(ftpserver, 'cd ' + self.__pid_dir + ' 2>/dev/null && files="' +
+                                                         ' '.join(handles) + '" && ' + KILL_SCRIPT)
+                logging.debug('Killed ' + str(len(output.split())) + ' of ' + str(len(handles)) +
+                              ' processes on ' + server)
+            except Exception, e:
+                logging.warning('Could not kill the processes on ' + server + ': ' + str(e))
+    #} End method __kill_queued
+
+    def __start_agent(self, ftpserver): #{
+        agent = ProcessAgent(self.__pool, ftpserver)
+        try:
+            agent.start()
+            self.__agents[get_server_name(ftpserver)] = agent
+        except Exception, e:
+            logging.warning('Could not start the process agent on ' + ftpserver[0] + ', using a channel per process: ' +
+                            str(e))
+    #} End method __start_agent
+
+    def __sweep_server(self, ftpserver, killed): #{
+        try:
+            _, output = self.__pool.read_command(ftpserver, 'cd ' + self.__pid_dir + ' 2>/dev/null && files=`ls` && ' +
+                                                 KILL_SCRIPT)
+            pids = output.split()
+            if pids: logging.warning('Killed ' + str(len(pids)) + ' iperf processes left over on ' + ftpserver[0])
+            killed.extend(pids)
+        except Exception, e:
+            logging.warning('Could not check for left over processes on ' + ftpserver[0] + ': ' + str(e))
+    #} End method __sweep_server
+#} End class RemoteProcesses
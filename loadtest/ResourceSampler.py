@@ -0,0 +1,340 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.ResourceSampler samples the test rig itself every second while a test runs: the CPU of each core, the CPU and
+memory of the iperf (and load test) processes and the traffic and drops of the UE adapters on this machine, and the same
+on each test server over its SSH connection. Any second in which the rig was saturated is flagged, so that a dip in
+throughput caused by the laptop or the server can be told apart from one caused by the radio link.
+
+ResourceSampler.py implements the ResourceSampler class and methods, as well as the /proc parsing functions it shares
+between this machine and the test servers.
+'''
+
+import os
+import logging
+from threading import Thread, Event, Lock
+
+from loadtest.RunEngine import monotonic
+from loadtest.SSHPool import get_server_name
+
+# psutil is optional. If it isn't installed this machine is sampled through /proc instead (so not at all on Windows):
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Run on each test server over one channel: prints the clock tick rate and page size, then every second the uptime,
+# /proc/stat, /proc/net/dev and the stat line of every iperf process, ending each sample with E. The loop ends at its
+# next write once the channel is closed (by SIGPIPE, or the echo failing), so nothing is left running on the server.
+REMOTE_SCRIPT = ('exec 2>/dev/null; echo H `getconf CLK_TCK` `getconf PAGESIZE`; '
+                 'while echo T `cat /proc/uptime`; do cat /proc/stat /proc/net/dev; '
+                 'for d in /proc/[0-9]*; do read c < $d/comm && case "$c" in iperf*) echo P `cat $d/stat`;; esac; done; '
+                 'echo E; sleep 1; done')
+SAMPLE_FIELDS = ('time', 'host', 'metric', 'instance', 'value')
+
+
+class ResourceSampler(object): #{
+    '''
+    class ResourceSampler(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __pool = SSHPool the test servers are sampled through
+        __ftpservers = List of the ftpServer triplets of the test servers (one per server)
+        __interfaces = List of the names of the UE adapters to sample on this machine
+        __log_path = Path of the CSV file the samples are written to (None = don't write them)
+        __threshold = CPU percentage (of one core) at which a core or process counts as saturated
+        __interval = Seconds between the samples of this machine
+        __lock = threading.Lock guarding __log and __busy, as every host is sampled on a thread of its own
+        __log = The open samples file (None if not writing one)
+        __busy = List of the (start, end) windows, in seconds from start(), in which the rig was saturated
+        __origin = monotonic() time start() was called
+        __stop = threading.Event set to stop the sampling
+        __channels = List of the open SSH channels of the test server samplers
+        __threads = List of the sampler threads
+
+    Overview:
+    One thread samples this machine, through psutil if it is installed or /proc otherwise, and one thread per test
+    server reads the samples that REMOTE_SCRIPT prints there. Each sample is compared with the one before it from the
+    same host to get the CPU percentage of each core and process and the rate and drops of each NIC, and written as one
+    line per value (time, host, metric, instance, value) to the samples file. Times are seconds from start(), which
+    TestInstance calls as the test starts, so they are on the same timeline as the phase delays and iperf intervals.
+    A second is flagged as busy (a 'saturated' line, with the reason as its instance) if any core or process was at
+    least threshold percent busy, or any sampled NIC dropped packets: the throughput of that second may have been
+    limited by the rig rather than the UE. Only the UE adapters are sampled on this machine, every NIC but lo on the
+    servers.
+
+    Public methods:
+    start(self):
+    Starts sampling. Returns straight away, the test servers are connected to on their sampler threads.
+
+    stop(self):
+    Stops sampling and closes the samples file.
+
+    get_busy(self):
+    Returns the sorted and merged (start, end) windows in which the rig was saturated.
+
+    '''
+
+    def __init__(self, pool, ftpservers, interfaces, log_path=None, threshold=90.0, interval=1.0): #{
+        '''
+        Constructor:
+            pool = SSHPool to reach the test servers through
+            ftpservers = ftpServer triplets of the test servers (duplicates are sampled once)
+            interfaces = names of the UE adapters on this machine
+            log_path = CSV file to write the samples to (None = don't write them)
+            threshold = CPU percentage of one core at which the rig counts as saturated
+            interval = seconds between samples of this machine
+        '''
+        self.__pool = pool
+        unique_servers = {}
+        for ftpserver in ftpservers:
+            unique_servers[get_server_name(ftpserver)] = ftpserver
+        self.__ftpservers = [unique_servers[name] for name in sorted(unique_servers.keys())]
+        self.__interfaces = sorted(set(interfaces))
+        self.__log_path = log_path
+        self.__threshold = threshold
+        self.__interval = interval
+        self.__lock = Lock()
+        self.__log = None
+        self.__busy = []
+        self.__origin = None
+        self.__stop = Event()
+        self.__channels = []
+        self.__threads = []
+    #} End method __init__
+
+    def start(self): #{
+        if self.__log_path is not None:
+            self.__log = open(self.__log_path, 'w')
+            self.__log.write(','.join(SAMPLE_FIELDS) + '\n')
+        self.__origin = monotonic()
+        targets = []
+        if psutil is not None or os.path.exists('/proc/stat'):
+            targets.append((self.__sample_local, (), 'resources-local'))
+        else:
+            logging.warning('psutil is not installed, only the test servers will be sampled')
+        for ftpserver in self.__ftpservers:
+            targets.append((self.__sample_remote, (ftpserver,), 'resources-' + get_server_name(ftpserver)))
+        for target, args, name in targets:
+            thread = Thread(target=target, args=args)
+            thread.setName(name)
+            thread.setDaemon(True)
+            self.__threads.append(thread)
+            thread.start()
+    #} End method start
+
+    def stop(self): #{
+        self.__stop.set()
+        with self.__lock:
+            channels = list(self.__channels)
+        for channel in channels:
+            channel.close()
+        for thread in self.__threads:
+            thread.join(5)
+        with self.__lock:
+            if self.__log is not None: self.__log.close()
+            self.__log = None
+    #} End method stop
+
+    def get_busy(self): #{
+        with self.__lock:
+            windows = sorted(self.__busy)
+        merged = []
+        for start, end in windows:
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+    #} End method get_busy
+
+    def __sample_local(self): #{
+        try:
+            previous = self.__read_local()
+            last = monotonic()
+            while not self.__stop.wait(self.__interval):
+                current = self.__read_local()
+                now = monotonic()
+                self.__record('local', now - self.__origin, now - last, previous, current)
+                previous, last = current, now
+        except Exception, e:
+            logging.warning('Stopped sampling this machine: ' + str(e))
+    #} End method __sample_local
+
+    def __read_local(self): #{
+        '''
+        Returns a sample of this machine: a dictionary of 'cores' (list of (busy, total) CPU times per core), 'procs'
+        (dictionary of pid to (name, CPU seconds, RSS bytes) for this process and all its children) and 'nics'
+        (dictionary of UE adapter name to (received bytes, sent bytes, dropped packets))
+        '''
+        sample = {'cores': [], 'procs': {}, 'nics': {}}
+        if psutil is not None:
+            for times in psutil.cpu_times(percpu=True):
+                total = sum(times)
+                sample['cores'].append((total - times.idle - getattr(times, 'iowait', 0.0), total))
+            me = psutil.Process(os.getpid())
+            for process in [me] + me.children(recursive=True):
+                try:
+                    cpu = process.cpu_times()
+                    sample['procs'][process.pid] = (process.name(), cpu.user + cpu.system, process.memory_info().rss)
+                except psutil.Error:
+                    # It exited while being sampled:
+                    continue
+            counters = psutil.net_io_counters(pernic=True)
+            for name in self.__interfaces:
+                if name in counters:
+                    nic = counters[name]
+                    sample['nics'][name] = (nic.bytes_recv, nic.bytes_sent, nic.dropin + nic.dropout)
+            return sample
+
+        stat_file = open('/proc/stat')
+        sample['cores'] = parse_cpu_lines(stat_file)
+        stat_file.close()
+        dev_file = open('/proc/net/dev')
+        nics = parse_net_dev(dev_file)
+        dev_file.close()
+        sample['nics'] = dict([(name, nics[name]) for name in self.__interfaces if name in nics])
+        ticks, page_size = os.sysconf('SC_CLK_TCK'), os.sysconf('SC_PAGE_SIZE')
+        # Every process on the machine, then only this process and the ones descended from it:
+        processes = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit(): continue
+            try:
+                proc_file = open('/proc/' + entry + '/stat')
+                line = proc_file.read()
+                proc_file.close()
+            except IOError:
+                continue
+            pid, name, ppid, cpu, rss = parse_proc_stat(line, ticks, page_size)
+            processes[pid] = (name, ppid, cpu, rss)
+        family = set([os.getpid()])
+        is_growing = True
+        while is_growing:
+            children = set([pid for pid in processes if processes[pid][1] in family]) - family
+            family |= children
+            is_growing = bool(children)
+        for pid in family:
+            if pid in processes:
+                name, _, cpu, rss = processes[pid]
+                sample['procs'][pid] = (name, cpu, rss)
+        return sample
+    #} End method __read_local
+
+    def __sample_remote(self, ftpserver): #{
+        host = get_server_name(ftpserver)
+        try:
+            _, stdout, _ = self.__pool.exec_command(ftpserver, REMOTE_SCRIPT)
+            with self.__lock:
+                self.__channels.append(stdout.channel)
+            # Stopped while connecting:
+            if self.__stop.is_set(): stdout.channel.close()
+            ticks, page_size = 100, 4096
+            previous = None
+            lines = []
+            for line in stdout:
+                if line.startswith('H '):
+                    ticks, page_size = [int(word) for word in line.split()[1:3]]
+                elif line.startswith('T '):
+                    lines = [line]
+                elif line.strip() == 'E' and lines:
+                    current = {'uptime': float(lines[0].split()[1]), 'cores': parse_cpu_lines(lines), 'procs': {},
+                               'nics': parse_net_dev(lines)}
+                    current['nics'].pop('lo', None)
+                    for proc_line in lines:
+                        if not proc_line.startswith('P '): continue
+                        pid, name, _, cpu, rss = parse_proc_stat(proc_line[2:], ticks, page_size)
+                        current['procs'][pid] = (name, cpu, rss)
+                    if previous is not None:
+                        self.__record(host, monotonic() - self.__origin, current['uptime'] - previous['uptime'],
+                                      previous, current)
+                    previous = current
+                    lines = []
+                else:
+                    lines.append(line)
+        except Exception, e:
+            if not self.__stop.is_set(): logging.warning('Stopped sampling ' + host + ': ' + str(e))
+    #} End method __sample_remote
+
+    def __record(self, host, when, elapsed, previous, current): #{
+        '''
+        Writes the values of the second between two samples of a host, and flags it if the host was saturated
+        '''
+        if elapsed <= 0: return
+        rows = []
+        reasons = []
+        for core, ((busy, total), (last_busy, last_total)) in enumerate(zip(current['cores'], previous['cores'])):
+            if total <= last_total: continue
+            percent = 100.0 * (busy - last_busy) / (total - last_total)
+            rows.append(('cpu_pct', 'core' + str(core), percent))
+            if percent >= self.__threshold: reasons.append('core' + str(core))
+        for pid in sorted(current['procs'].keys()):
+            if pid not in previous['procs']: continue
+            name, cpu, rss = current['procs'][pid]
+            instance = name + '[' + str(pid) + ']'
+            percent = 100.0 * (cpu - previous['procs'][pid][1]) / elapsed
+            rows.append(('proc_cpu_pct', instance, percent))
+            rows.append(('proc_rss_kb', instance, rss / 1024.0))
+            if percent >= self.__threshold: reasons.append(instance)
+        for name in sorted(current['nics'].keys()):
+            if name not in previous['nics']: continue
+            received, sent, dropped = current['nics'][name]
+            last_received, last_sent, last_dropped = previous['nics'][name]
+            rows.append(('nic_rx_kbps', name, (received - last_received) * 8 / 1000.0 / elapsed))
+            rows.append(('nic_tx_kbps', name, (sent - last_sent) * 8 / 1000.0 / elapsed))
+            rows.append(('nic_drops', name, dropped - last_dropped))
+            if dropped > last_dropped: reasons.append(name)
+        rows.extend([('saturated', reason, 1) for reason in reasons])
+
+        with self.__lock:
+            if reasons: self.__busy.append((when - elapsed, when))
+            if self.__log is not None:
+                self.__log.write(''.join(['%.2f,%s,%s,%s,%.1f\n' % (when, host, metric, instance, value)
+                                          for metric, instance, value in rows]))
+    #} End method __record
+#} End class ResourceSampler
+
+
+def parse_cpu_lines(lines): #{
+    '''
+    Returns a (busy, total) tuple of CPU times (in clock ticks) for each 'cpuN' line of /proc/stat, in core order
+    '''
+    cores = []
+    for line in lines:
+        if not line.startswith('cpu') or line.startswith('cpu '): continue
+        times = [int(value) for value in line.split()[1:]]
+        # idle and iowait are the 4th and 5th values:
+        total = sum(times[:8])
+        cores.append((total - sum(times[3:5]), total))
+    return cores
+#} End method parse_cpu_lines
+
+
+def parse_net_dev(lines): #{
+    '''
+    Returns a dictionary of interface name to (received bytes, sent bytes, dropped packets) from /proc/net/dev lines
+    '''
+    nics = {}
+    for line in lines:
+        if ':' not in line: continue
+        name, counters = line.split(':', 1)
+        counters = counters.split()
+        if len(counters) < 12 or not counters[0].isdigit(): continue
+        nics[name.strip()] = (int(counters[0]), int(counters[8]), int(counters[3]) + int(counters[11]))
+    return nics
+#} End method parse_net_dev
+
+
+def parse_proc_stat(line, ticks, page_size): #{
+    '''
+    Returns the (pid, name, parent pid, CPU seconds, RSS bytes) of a /proc/<pid>/stat line
+    '''
+    pid, rest = line.split(' (', 1)
+    name, rest = rest.rsplit(') ', 1)
+    # The values after the name start from the 3rd field (state), so utime/stime (14th/15th) are at 11 and 12:
+    values = rest.split()
+    return int(pid), name, int(values[1]), (int(values[11]) + int(values[12])) / float(ticks), int(values[21]) * page_size
+#} End method parse_proc_stat
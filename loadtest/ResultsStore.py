@@ -0,0 +1,302 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.ResultsStore keeps the per-second iperf reports of every run in one indexed SQLite database, so that results can
+be compared across runs (e.g. the p5 DL throughput of UE3 over the last 50 runs) without grepping thousands of logs.
+It can also be run on its own to query the database:
+    python -m loadtest.ResultsStore <database> <adapter> <DL|UL> <percentile> [--runs N] [--role client|server]
+
+ResultsStore.py implements the ResultsStore class and methods, as well as the main() function.
+'''
+
+import os
+import sys
+import math
+import sqlite3
+import logging
+from datetime import datetime
+from threading import Thread, Event
+from argparse import ArgumentParser
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started TEXT NOT NULL,
+    logprefix TEXT,
+    logdir TEXT,
+    config TEXT
+);
+CREATE TABLE IF NOT EXISTS series (
+    series_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    ue TEXT NOT NULL,
+    phase INTEGER NOT NULL,
+    direction TEXT NOT NULL,
+    role TEXT NOT NULL,
+    multi_stream INTEGER NOT NULL DEFAULT 0,
+    outage_secs REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS intervals (
+    series_id INTEGER NOT NULL REFERENCES series(series_id),
+    second INTEGER NOT NULL,
+    start REAL,
+    end REAL,
+    kbytes REAL,
+    kbps REAL,
+    jitter REAL,
+    lost INTEGER,
+    total INTEGER,
+    stream INTEGER
+);
+CREATE INDEX IF NOT EXISTS series_lookup ON series (ue, direction, role, run_id);
+CREATE INDEX IF NOT EXISTS intervals_series ON intervals (series_id, second);
+'''
+
+# The series columns written to the intervals table, in order:
+INTERVAL_COLUMNS = ('start', 'end', 'kbytes', 'kbps', 'jitter', 'lost', 'total', 'stream')
+
+
+class ResultsStore(object): #{
+    '''
+    class ResultsStore(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __path = Path of the SQLite database file
+        __interval = Seconds between the batched inserts while a run is active
+        __run_id = ID of the run being recorded (None if no run has been started)
+        __series = SeriesStore of the run being recorded
+        __series_ids = Dictionary of (ue, phase, direction, role) keys to the series_id of the series in the database
+        __written = Dictionary of the same keys to the number of interval reports of the series already written
+        __stop = threading.Event set to stop the writer thread
+        __thread = The writer thread
+
+    Overview:
+    Every run is a row in the runs table, every ThroughputSeries of the run a row in the series table (keyed by run, UE,
+    phase, direction and role), and every interval report a row in the intervals table (keyed by series and second).
+    While the run is active, the writer thread wakes up every few seconds and inserts whatever has been added to the
+    series since it last looked, all in one transaction, so the capture threads never wait on the database. finish()
+    writes the rest once the run is over.
+    The series table is indexed on (ue, direction, role, run_id), so a query over the last N runs of one UE only ever
+    reads the rows of those runs, however big the database gets. The database is in WAL mode, so it can be queried
+    while a run is being written.
+    Only the aggregate reports of a multi-stream series (stream -1) are used by the queries, as in
+    ThroughputSeries.summary(). If the series has no [SUM] reports, finish() writes the reports of its streams for each
+    interval added together (see ThroughputSeries.aggregate()) as its aggregate reports, so until then the queries only
+    see the single-stream and [SUM] reports of the run.
+
+    Public methods:
+    start_run(self, series, logprefix, logdir, config):
+    Records a new run, and starts writing the reports of the SeriesStore to the database in the background.
+
+    finish(self):
+    Stops the writer thread and writes everything that is left. Returns the run ID.
+
+    get_runs(self, limit):
+    Returns the last limit runs as a list of (run_id, started, logprefix, logdir, config) tuples, newest first.
+
+    get_percentile(self, ue, direction, pct, runs=50, role='server'):
+    Returns the pct percentile of the kbps of ue in direction ('DL' or 'UL') over its last runs runs, or NaN if there
+    are no reports.
+
+    get_run_summary(self, ue, direction, runs=50, role='server'):
+    Returns a list of (run_id, samples, mean_kbps, min_kbps, max_kbps) tuples, one per run, for the last runs runs of ue.
+
+    '''
+
+    def __init__(self, path, interval=5.0): #{
+        '''
+        Constructor:
+            path = path of the database file, created if it doesn't exist
+            interval = seconds between the batched inserts while a run is active
+        '''
+        self.__path = path
+        self.__interval = interval
+        self.__run_id = None
+        self.__series = None
+        self.__series_ids = {}
+        self.__written = {}
+        self.__stop = Event()
+        self.__thread = None
+        connection = self.__connect()
+        connection.executescript(SCHEMA)
+        connection.close()
+    #} End method __init__
+
+    def start_run(self, series, logprefix, logdir, config): #{
+        self.__series = series
+        self.__series_ids = {}
+        self.__written = {}
+        self.__stop.clear()
+        connection = self.__connect()
+        with connection:
+            cursor = connection.execute('INSERT INTO runs (started, logprefix, logdir, config) VALUES (?, ?, ?, ?)',
+                                        (datetime.now().isoformat(), logprefix, logdir, config))
+            self.__run_id = cursor.lastrowid
+        connection.close()
+        self.__thread = Thread(target=self.__write_loop)
+        self.__thread.setName('results-writer')
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+        return self.__run_id
+    #} End method start_run
+
+    def finish(self): #{
+        if self.__thread is None: return self.__run_id
+        self.__stop.set()
+        self.__thread.join()
+        self.__thread = None
+        connection = self.__connect()
+        try:
+            self.__write_batch(connection)
+            # Now the series are complete, record which are multi-stream and how long their outages were:
+            with connection:
+                for series in self.__series.get_all_series():
+                    key = (series.ue, series.phase, series.direction, series.role)
+                    streams = series.columns['stream']
+                    multi_stream = len(set(streams)) > 1
+                    if multi_stream and -1 not in streams:
+                        # No [SUM] reports, so the streams' reports added together are written as the aggregate:
+                        columns, rows = series.aggregate()
+                        self.__insert_rows(connection, self.__get_rows(self.__series_ids[key], columns, 0, len(rows)))
+                    connection.execute('UPDATE series SET multi_stream = ?, outage_secs = ? WHERE series_id = ?',
+                                       (int(multi_stream), sum([end - start for start, end in series.outages]),
+                                        self.__series_ids[key]))
+        finally:
+            connection.close()
+        logging.debug('Run ' + str(self.__run_id) + ' written to ' + self.__path)
+        return self.__run_id
+    #} End method finish
+
+    def get_runs(self, limit): #{
+        connection = self.__connect()
+        try:
+            return connection.execute('SELECT run_id, started, logprefix, logdir, config FROM runs '
+                                      'ORDER BY run_id DESC LIMIT ?', (limit,)).fetchall()
+        finally:
+            connection.close()
+    #} End method get_runs
+
+    def get_percentile(self, ue, direction, pct, runs=50, role='server'): #{
+        where, args = self.__select_rows(ue, direction, runs, role)
+        connection = self.__connect()
+        try:
+            count = connection.execute('SELECT count(*) FROM ' + where, args).fetchone()[0]
+            if not count: return float('nan')
+            # Same linear interpolation as ThroughputSeries.percentile(), but only the two values either side of the
+            # rank are fetched, the sorting is left to SQLite:
+            rank = (count - 1) * pct / 100.0
+            lower = int(math.floor(rank))
+            values = [row[0] for row in connection.execute('SELECT i.kbps FROM ' + where + ' ORDER BY i.kbps LIMIT 2 '
+                                                           'OFFSET ?', args + (lower,))]
+        finally:
+            connection.close()
+        if len(values) == 1: return values[0]
+        return values[0] + (values[1] - values[0]) * (rank - lower)
+    #} End method get_percentile
+
+    def get_run_summary(self, ue, direction, runs=50, role='server'): #{
+        where, args = self.__select_rows(ue, direction, runs, role)
+        connection = self.__connect()
+        try:
+            return connection.execute('SELECT s.run_id, count(*), avg(i.kbps), min(i.kbps), max(i.kbps) FROM ' + where +
+                                      ' GROUP BY s.run_id ORDER BY s.run_id DESC', args).fetchall()
+        finally:
+            connection.close()
+    #} End method get_run_summary
+
+    def __select_rows(self, ue, direction, runs, role): #{
+        # The FROM and WHERE clauses selecting the aggregate interval reports of ue over its last runs runs:
+        where = 'series s JOIN intervals i ON i.series_id = s.series_id ' \
+                'WHERE s.ue = ? AND s.direction = ? AND s.role = ? AND (i.stream = -1 OR s.multi_stream = 0) ' \
+                'AND s.run_id IN (SELECT DISTINCT run_id FROM series WHERE ue = ? AND direction = ? AND role = ? ' \
+                'ORDER BY run_id DESC LIMIT ?)'
+        return where, (ue, direction, role, ue, direction, role, runs)
+    #} End method __select_rows
+
+    def __connect(self): #{
+        # A connection can only be used on the thread that opened it, so each thread opens its own:
+        connection = sqlite3.connect(self.__path)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+    #} End method __connect
+
+    def __write_loop(self): #{
+        connection = self.__connect()
+        try:
+            while not self.__stop.wait(self.__interval):
+                self.__write_batch(connection)
+        except Exception, e:
+            logging.warning('Could not write the results to ' + self.__path + ': ' + str(e))
+        finally:
+            connection.close()
+    #} End method __write_loop
+
+    def __write_batch(self, connection): #{
+        rows = []
+        with connection:
+            for series in self.__series.get_all_series():
+                key = (series.ue, series.phase, series.direction, series.role)
+                if key not in self.__series_ids:
+                    cursor = connection.execute('INSERT INTO series (run_id, ue, phase, direction, role) '
+                                                'VALUES (?, ?, ?, ?, ?)', (self.__run_id,) + key)
+                    self.__series_ids[key] = cursor.lastrowid
+                    self.__written[key] = 0
+                # The capture threads append to the columns one at a time, and stream is always the last, so every
+                # column has at least this many entries:
+                count = len(series.columns['stream'])
+                rows.extend(self.__get_rows(self.__series_ids[key], series.columns, self.__written[key], count))
+                self.__written[key] = count
+            self.__insert_rows(connection, rows)
+        if rows: logging.debug(str(len(rows)) + ' interval reports written to ' + self.__path)
+    #} End method __write_batch
+
+    def __get_rows(self, series_id, columns, first, count): #{
+        # The intervals rows of the reports first to count - 1 of the columns, NaNs stored as NULL:
+        rows = []
+        for values in zip(*[columns[name][first:count] for name in INTERVAL_COLUMNS]):
+            rows.append((series_id, int(values[0])) + tuple([None if isinstance(value, float) and math.isnan(value)
+                                                             else value for value in values]))
+        return rows
+    #} End method __get_rows
+
+    def __insert_rows(self, connection, rows): #{
+        connection.executemany('INSERT INTO intervals (series_id, second, start, end, kbytes, kbps, jitter, lost, '
+                               'total, stream) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    #} End method __insert_rows
+#} End class ResultsStore
+
+
+def main(): #{
+    parser = ArgumentParser(description='Queries the load test results database')
+    parser.add_argument('database', help='path of the results database (the Globals resultsdb item)')
+    parser.add_argument('adapter', help='adapter name of the UE, e.g. UE3')
+    parser.add_argument('direction', choices=['DL', 'UL'])
+    parser.add_argument('percentile', type=float, help='percentile of the per-second throughput, e.g. 5')
+    parser.add_argument('--runs', type=int, default=50, help='number of most recent runs to include (default 50)')
+    parser.add_argument('--role', choices=['client', 'server'], default='server',
+                        help='side of the test the throughput was reported by (default server, the receiving side)')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database):
+        sys.stderr.write('No results database at ' + args.database + '\n')
+        return 1
+    store = ResultsStore(args.database)
+    for run_id, samples, mean_kbps, min_kbps, max_kbps in store.get_run_summary(args.adapter, args.direction,
+                                                                                 args.runs, args.role):
+        print 'Run %6d: %6d samples, mean %10.1f, min %10.1f, max %10.1f Kbits/sec' % (run_id, samples, mean_kbps,
+                                                                                         min_kbps, max_kbps)
+    print 'p%g %s %s over the last %d runs: %.1f Kbits/sec' % (args.percentile, args.adapter, args.direction, args.runs,
+                                                                store.get_percentile(args.adapter, args.direction,
+                                                                                     args.percentile, args.runs,
+                                                                                     args.role))
+    return 0
+#} End method main
+
+
+if __name__ == '__main__':
+    sys.exit(main())
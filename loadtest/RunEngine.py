@@ -0,0 +1,305 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.RunEngine drives all the UE phases of a test from a single thread. Phases are started at their scheduled time on
+a monotonic clock, and are torn down as soon as their traffic has finished, rather than after a fixed sleep.
+
+RunEngine.py implements the RunEngine class and methods, as well as the monotonic() clock function.
+'''
+
+import sys
+import time
+import heapq
+import logging
+import itertools
+from Queue import Queue, Empty
+from threading import Thread, Event
+
+
+def _get_monotonic(): #{
+    '''
+    Returns the best monotonic clock function available.
+    Python 2.7 has no time.monotonic, so use time.clock on Windows (which is QueryPerformanceCounter based) and
+    clock_gettime(CLOCK_MONOTONIC) through ctypes on Linux, falling back on time.time if neither is available.
+    '''
+    if hasattr(time, 'monotonic'): return time.monotonic
+    if sys.platform == 'win32': return time.clock
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure): #{
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        #} End class timespec
+
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1 # From <linux/time.h>
+
+        def monotonic():
+            t = timespec()
+            clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t))
+            return t.tv_sec + t.tv_nsec * 1e-9
+        monotonic()
+        return monotonic
+    except Exception:
+        return time.time
+#} End method _get_monotonic
+
+monotonic = _get_monotonic()
+
+
+class RunEngine(object): #{
+    '''
+    class RunEngine(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __interrupt = threading.Event set when the user hits Ctrl-C (the TestInstance interrupt event)
+        __pending = Heap of (start time, sequence, phase) tuples for the phases that haven't started yet
+        __tick = How often (in seconds) the running phases are polled for completion
+        __linger = How long (in seconds) the servers are left running after their client has finished, so that they can
+            print their final report
+        __grace = How long (in seconds) after its duration a phase is stopped, whether its clients have finished or not
+        __lead = How long (in seconds) before its start a phase is prepared
+        __preparers = Dictionary of every phase that has been (or is being) prepared but not started, to the Thread
+            preparing it
+        __sequence = Counter used to keep the heap in scheduling order for phases with the same start time
+        __replacements = Queue of (old phase, new phase) tuples passed to replace(), handled by the run() loop
+
+    Overview:
+    Every phase (a UEPhase, or anything with the same name/delay/duration/prepare/start/is_finished/stop/close interface)
+    is scheduled at its delay from the start of the test. run() then loops on one thread: it starts every phase that is
+    due, polls the running phases, and stops and closes each one once its clients have exited (plus the linger time).
+    Phases finishing on the same tick are all stopped first and then all closed, so their teardown overlaps.
+    Each phase is prepared (logs opened, servers started and listening) ahead of its start: the phases starting within
+    the lead time of the start of the test are all prepared before the clock starts (by prepare(), or by run() if it
+    hasn't been called), and later phases in the background, lead seconds before they are due. When phases are due,
+    they are released together: each is started on a short-lived starter thread, and all the starters wait on one
+    event, set once every one of them is ready to go, so that only starting the clients is left between the schedule
+    and the traffic, and one slow SSH channel doesn't hold up the start of the others. The test ends as soon as the
+    last phase has been closed.
+    If the user hits Ctrl-C, the interrupt event is set, phases that haven't started yet are dropped and all running
+    phases are stopped and closed as interrupted, the same as the old Timer thread/__interrupt_event handling. Phases
+    that have been prepared but not started are stopped and closed along with them.
+    The same happens if the interrupt event is set by someone else (e.g. the parent process of a worker, see WorkerPool.py),
+    so any object with set() and is_set() methods (threading.Event or multiprocessing.Event) can be used as the event.
+
+    Public methods:
+    schedule(self, phase):
+    Adds a phase to the test, to start phase.delay seconds after run() is called.
+
+    prepare(self):
+    Prepares the phases that start within the lead time of the start of the test, and returns once they are ready.
+    Lets the caller get everything ready before it starts the clock (e.g. before waiting for the other workers).
+
+    replace(self, old, new):
+    Swaps a phase for another one while the test runs (can be called from any thread). A running phase is stopped and
+    closed, and the new phase started straight away. A phase that hasn't started yet is swapped in the schedule.
+
+    run(self):
+    Runs the whole test and returns when every phase has finished (or the test was interrupted).
+    Returns True if the test ran to completion and False if it was interrupted.
+
+    '''
+
+    def __init__(self, interrupt, tick=0.1, linger=1.0, grace=3.0, lead=5.0): #{
+        '''
+        Constructor
+        '''
+        self.__interrupt = interrupt
+        self.__pending = []
+        self.__tick = tick
+        self.__linger = linger
+        self.__grace = grace
+        self.__lead = lead
+        self.__preparers = {}
+        self.__sequence = itertools.count()
+        self.__replacements = Queue()
+    #} End method __init__
+
+    def schedule(self, phase): #{
+        heapq.heappush(self.__pending, (phase.delay, next(self.__sequence), phase))
+    #} End method schedule
+
+    def prepare(self): #{
+        try:
+            self.__prepare_phases([phase for delay, _, phase in self.__pending if delay <= self.__lead])
+            self.__wait_prepared(self.__preparers.keys())
+        except KeyboardInterrupt:
+            # run() then tears down whatever has been prepared and returns straight away:
+            self.__interrupt.set()
+            logging.warning('Process interrupted by user.\n')
+    #} End method prepare
+
+    def replace(self, old, new): #{
+        self.__replacements.put((old, new))
+    #} End method replace
+
+    def run(self): #{
+        running = []  # list of [phase, deadline, stop time] lists
+        # Get the first phases ready before the clock starts (if the caller hasn't already):
+        self.prepare()
+        t0 = monotonic()
+        try:
+            while self.__pending or running:
+                if self.__interrupt.is_set():
+                    logging.warning('Test stopped.\n')
+                    self.__abort(running)
+                    return False
+                now = monotonic() - t0
+
+                # Prepare, in the background, the phases that are coming up:
+                self.__prepare_phases([phase for delay, _, phase in self.__pending if delay - self.__lead <= now])
+
+                # Start everything that is due:
+                due = []
+                while self.__pending and self.__pending[0][0] <= now:
+                    due.append(heapq.heappop(self.__pending)[2])
+                if due:
+                    # Add them to the running list first, so that they are torn down if Ctrl-C is hit while starting:
+                    entries = [[phase, None, None] for phase in due]
+                    running.extend(entries)
+                    self.__start_phases(due, t0)
+                    now = monotonic() - t0
+                    for entry in entries:
+                        entry[1] = now + entry[0].duration + self.__grace
+
+                # Swap any phases replaced since the last tick:
+                self.__replace_phases(running, t0)
+                now = monotonic() - t0
+
+                # Check the running phases, and tear down the ones that have finished:
+                finished = []
+                for entry in running[:]:
+                    phase, deadline, stop_time = entry
+                    if stop_time is None and phase.is_finished():
+                        logging.debug(phase.name + ': clients finished after ' + str(now) + ' seconds')
+                        stop_time = entry[2] = now + self.__linger
+                    if (stop_time is not None and now >= stop_time) or (deadline is not None and now >= deadline):
+                        finished.append(phase)
+                        running.remove(entry)
+                # Stop them all before closing any, so their remote kills can go out together:
+                for phase in finished:
+                    phase.stop(False)
+                for phase in finished:
+                    phase.close(False)
+
+                # Sleep until the next tick, or the next phase start if that is sooner:
+                if self.__pending or running:
+                    sleep_time = self.__tick
+                    if self.__pending: sleep_time = min(sleep_time, self.__pending[0][0] - (monotonic() - t0))
+                    if sleep_time > 0: time.sleep(sleep_time)
+            logging.debug('Test finished after ' + str(monotonic() - t0) + ' seconds')
+            return True
+        except KeyboardInterrupt:
+            # Inform everything else an interrupt was encountered:
+            self.__interrupt.set()
+            logging.warning('Process interrupted by user.\n')
+            self.__abort(running)
+            return False
+    #} End method run
+
+    def __abort(self, running): #{
+        # Drop any phases still waiting to start, and tear down the running ones (and any prepared) as interrupted:
+        self.__pending = []
+        logging.warning('Tearing down processes and closing logs...\n')
+        phases = [phase for phase, _, _ in running]
+        prepared = [phase for phase in self.__preparers.keys() if phase not in phases]
+        self.__wait_prepared(prepared)
+        self.__preparers = {}
+        phases.extend(prepared)
+        for phase in phases:
+            phase.stop(True)
+        for phase in phases:
+            phase.close(True)
+    #} End method __abort
+
+    def __replace_phases(self, running, t0): #{
+        while True:
+            try:
+                old, new = self.__replacements.get_nowait()
+            except Empty:
+                return
+            entries = [entry for entry in running if entry[0] is old]
+            pending = [item for item in self.__pending if item[2] is old]
+            if entries:
+                logging.debug(old.name + ': replaced while running')
+                entry = entries[0]
+                old.stop(True)
+                old.close(False)
+                entry[0], entry[1], entry[2] = new, None, None
+                self.__start_phases([new])
+                entry[1] = monotonic() - t0 + new.duration + self.__grace
+            elif pending:
+                logging.debug(old.name + ': replaced before starting')
+                self.__pending.remove(pending[0])
+                heapq.heapify(self.__pending)
+                if old in self.__preparers:
+                    self.__wait_prepared([old])
+                    del self.__preparers[old]
+                    old.stop(True)
+                    old.close(False)
+                self.schedule(new)
+            # Otherwise the old phase has already finished, so there's nothing left to replace
+    #} End method __replace_phases
+
+    def __prepare_phases(self, phases): #{
+        # Starts preparing each phase that isn't already, without waiting:
+        for phase in phases:
+            if phase in self.__preparers: continue
+            preparer = Thread(target=phase.prepare)
+            preparer.setName(phase.name + '-prepare')
+            preparer.setDaemon(True)
+            self.__preparers[phase] = preparer
+            preparer.start()
+    #} End method __prepare_phases
+
+    def __wait_prepared(self, phases): #{
+        for phase in phases:
+            preparer = self.__preparers[phase]
+            # join() with a timeout, so that Ctrl-C can still get through to this thread on Windows:
+            while preparer.isAlive(): preparer.join(0.1)
+    #} End method __wait_prepared
+
+    def __start_phases(self, phases, t0=None): #{
+        # Any phase that isn't ready yet (late, or a replacement) has to be prepared first:
+        self.__prepare_phases(phases)
+        self.__wait_prepared(phases)
+        release = Event()
+        starters = []
+        arrivals = []
+        for phase in phases:
+            del self.__preparers[phase]
+            # Each phase's skew is measured from its scheduled start (or from now, for a replacement):
+            scheduled = t0 + phase.delay if t0 is not None else monotonic()
+            arrived = Event()
+            starter = Thread(target=self.__release_phase, args=(phase, arrived, release, scheduled))
+            # Name the threads for debug purposes
+            starter.setName(phase.name)
+            starter.setDaemon(True)
+            starters.append(starter)
+            arrivals.append(arrived)
+            starter.start()
+        # Wait for every starter to be waiting on the release, then let them all go at once:
+        for arrived in arrivals:
+            # wait() with a timeout, so that Ctrl-C can still get through to this thread on Windows:
+            while not arrived.wait(0.1): pass
+        released_at = monotonic()
+        release.set()
+        for starter in starters:
+            # join() with a timeout, so that Ctrl-C can still get through to this thread on Windows:
+            while starter.isAlive(): starter.join(0.1)
+        logging.debug(str(len(phases)) + ' phases started within ' + str(int((monotonic() - released_at) * 1000)) + 'ms')
+    #} End method __start_phases
+
+    def __release_phase(self, phase, arrived, release, scheduled): #{
+        arrived.set()
+        release.wait()
+        phase.start(scheduled)
+    #} End method __release_phase
+#} End class RunEngine
@@ -0,0 +1,245 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.SSHPool holds one authenticated SSH connection per test server (keyed by IP address, port and username) and
+hands out exec channels on that connection to every UE phase, instead of each phase doing its own handshake and password
+auth.
+It also records how long each handshake and each channel open took, so start-up skew can be attributed to the server.
+
+SSHPool.py implements the SSHPool class and methods, as well as the get_ssh_port() and get_server_name() functions.
+'''
+
+import time
+import logging
+from threading import Lock
+from threading import Thread
+
+import paramiko
+
+from loadtest import Tracing
+
+
+class SSHPool(object): #{
+    '''
+    class SSHPool(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __lock = threading.Lock guarding the __servers, __key_locks and __stats structures
+        __key_locks = Dictionary of (ip, username) keys to a threading.Lock, so only one thread connects to a given server
+        __servers = Dictionary of (ip, username) keys to a list of connected paramiko.SSHClient objects
+        __stats = Dictionary of (ip, username) keys to a dict of handshake and channel-open latencies (in seconds)
+        __keepalive = SSH keepalive interval in seconds, so long tests don't have their connection dropped by a firewall
+
+    Overview:
+    The pool is keyed by (ip, username, port) as taken from the ftpServer triplet of the UE config (which can have the
+    SSH port as an optional fourth value, 22 if not), so servers behind the same address (e.g. port forwarded through
+    NAT) each get their own connection. The first request for a key connects and authenticates; every later request
+    re-uses that transport and only opens a new channel on it.
+    Servers normally limit the number of sessions per connection (OpenSSH MaxSessions defaults to 10). When the server
+    refuses a new channel, the pool transparently opens another connection to the same server and uses that instead.
+
+    Public methods:
+    warm(self, ftpservers):
+    Connects to every distinct server in the list of ftpServer triplets in parallel. Called before the first phase starts
+    so that no handshake happens at t0.
+
+    exec_command(self, ftpserver, command, bufsize=-1):
+    Drop-in replacement for paramiko.SSHClient.exec_command, running the command on a pooled connection.
+    Returns the (stdin, stdout, stderr) file objects of the new channel.
+
+    open_channel(self, ftpserver):
+    Opens a new session channel on a pooled connection to the server and returns it.
+
+    run_command(self, ftpserver, command):
+    Runs a short command on a pooled connection, waits for it to finish and closes the channel. Returns the exit status.
+
+    read_command(self, ftpserver, command):
+    Same as run_command, but returns an (exit status, output) tuple with everything the command wrote to stdout.
+
+    close_all(self):
+    Closes every pooled connection. Called once at the end of the test.
+
+    get_stats(self):
+    Returns the __stats dictionary.
+
+    get_report(self):
+    Returns a printable multi-line summary of the handshake and channel-open latencies per server.
+
+    '''
+
+    def __init__(self, keepalive=30): #{
+        '''
+        Constructor:
+            keepalive = SSH keepalive interval in seconds (0 = disabled)
+        '''
+        self.__lock = Lock()
+        self.__key_locks = {}
+        self.__servers = {}
+        self.__stats = {}
+        self.__keepalive = keepalive
+    #} End method __init__
+
+    def warm(self, ftpservers): #{
+        unique_servers = {}
+        for ftpserver in ftpservers:
+            unique_servers[self.__key_of(ftpserver)] = ftpserver
+
+        # Connect to all servers at the same time, so a slow server doesn't delay the others:
+        threads = []
+        for ftpserver in unique_servers.values():
+            t = Thread(target=self.__get_client, args=[ftpserver])
+            t.setName('ssh-warm-' + ftpserver[0])
+            threads.append(t)
+            t.start()
+        for t in threads:
+            t.join()
+    #} End method warm
+
+    def exec_command(self, ftpserver, command, bufsize=-1): #{
+        '''
+        Same as paramiko.SSHClient.exec_command, but on a pooled connection
+        '''
+        channel = self.open_channel(ftpserver)
+        channel.exec_command(command)
+        stdin = channel.makefile('wb', bufsize)
+        stdout = channel.makefile('rb', bufsize)
+        stderr = channel.makefile_stderr('rb', bufsize)
+        return stdin, stdout, stderr
+    #} End method exec_command
+
+    def run_command(self, ftpserver, command): #{
+        channel = self.open_channel(ftpserver)
+        channel.exec_command(command)
+        status = channel.recv_exit_status()
+        channel.close()
+        return status
+    #} End method run_command
+
+    def read_command(self, ftpserver, command): #{
+        channel = self.open_channel(ftpserver)
+        channel.exec_command(command)
+        output = channel.makefile('rb', -1).read()
+        status = channel.recv_exit_status()
+        channel.close()
+        return status, output
+    #} End method read_command
+
+    def open_channel(self, ftpserver): #{
+        '''
+        Opens a new session channel to the server, connecting first if there isn't a pooled connection yet
+        '''
+        key = self.__key_of(ftpserver)
+        client, is_new = self.__get_client(ftpserver)
+        while True:
+            start = time.time()
+            try:
+                channel = client.get_transport().open_session()
+                break
+            except paramiko.ChannelException:
+                # Even a fresh connection was refused a session, so there is nothing more the pool can do:
+                if is_new: raise
+                # The server won't allow any more sessions on this connection, so move on to a newer one:
+                logging.debug('Session limit reached on ' + str(key) + ', moving to another connection')
+                client, is_new = self.__get_client(ftpserver, exclude=client)
+        elapsed = time.time() - start
+        with self.__lock:
+            self.__stats[key]['channel_open'].append(elapsed)
+        return channel
+    #} End method open_channel
+
+    def close_all(self): #{
+        with self.__lock:
+            for key in self.__servers:
+                for client in self.__servers[key]:
+                    client.close()
+                self.__servers[key] = []
+        logging.debug('SSH pool closed')
+    #} End method close_all
+
+    def get_stats(self): #{
+        return self.__stats
+    #} End method get_stats
+
+    def get_report(self): #{
+        report = ''
+        for key, stats in sorted(self.__stats.items()):
+            opens = stats['channel_open']
+            report = report + key[1] + '@' + key[0] + (':' + str(key[2]) if key[2] != 22 else '') + \
+                ': connections = ' + str(len(stats['handshake'])) + \
+                ', handshake (s) = ' + ', '.join(['%.3f' % h for h in stats['handshake']]) + \
+                ', channels opened = ' + str(len(opens))
+            if opens:
+                report = report + \
+                    ', channel open mean (s) = %.3f' % (sum(opens) / len(opens)) + \
+                    ', channel open max (s) = %.3f' % max(opens)
+            report = report + '\n'
+        return report
+    #} End method get_report
+
+    def __key_of(self, ftpserver): #{
+        # ftpserver is the [ip, username, password(, port)] list from the UE config
+        return (ftpserver[0], ftpserver[1], get_ssh_port(ftpserver))
+    #} End method __key_of
+
+    def __get_client(self, ftpserver, exclude=None): #{
+        '''
+        Returns a (client, is_new) tuple for the server. If exclude is given, only a connection opened after that one
+        is returned (connecting a new one if needed).
+        '''
+        key = self.__key_of(ftpserver)
+        with self.__lock:
+            if key not in self.__key_locks:
+                self.__key_locks[key] = Lock()
+                self.__servers[key] = []
+                self.__stats[key] = {'handshake': [], 'channel_open': []}
+            key_lock = self.__key_locks[key]
+
+        # Only one thread connects to any given server, the others wait here and then use its connection:
+        with key_lock:
+            clients = [c for c in self.__servers[key] if c.get_transport() is not None and c.get_transport().is_active()]
+            if exclude is not None and exclude in clients:
+                # Connections are kept in the order they were opened, only consider those newer than the full one:
+                clients = clients[clients.index(exclude) + 1:]
+            if clients:
+                # The most recently opened connection is the one most likely to have free sessions:
+                return clients[-1], False
+
+            client = paramiko.SSHClient()
+            # Stop paramiko from halting the program if the local key is not authorised:
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.load_system_host_keys()
+            start = time.time()
+            # TODO: Only SSH support at the moment. Add Telnet support if needed.
+            with Tracing.span('ssh.connect', server=get_server_name(ftpserver), user=ftpserver[1]):
+                client.connect(ftpserver[0], port=key[2], username=ftpserver[1], password=ftpserver[2])
+            elapsed = time.time() - start
+            if self.__keepalive: client.get_transport().set_keepalive(self.__keepalive)
+            logging.debug('Connected to ' + str(key) + ' in ' + str(elapsed) + ' seconds')
+            with self.__lock:
+                self.__servers[key].append(client)
+                self.__stats[key]['handshake'].append(elapsed)
+            return client, True
+    #} End method __get_client
+#} End class SSHPool
+
+
+def get_ssh_port(ftpserver): #{
+    '''
+    Returns the SSH port of an ftpServer list: its optional fourth value, or 22
+    '''
+    return int(ftpserver[3]) if len(ftpserver) > 3 else 22
+#} End method get_ssh_port
+
+
+def get_server_name(ftpserver): #{
+    '''
+    Returns the name of the test server of an ftpServer list, its IP address with the SSH port if that isn't 22, which
+    tells apart servers behind the same address
+    '''
+    port = get_ssh_port(ftpserver)
+    return ftpserver[0] + (':' + str(port) if port != 22 else '')
+#} End method get_server_name
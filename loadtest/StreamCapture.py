@@ -0,0 +1,309 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.StreamCapture drains the output of every running iperf (local sub-processes and remote SSH channels alike) into
+its log file while the test is running, rather than leaving it to pile up in pipe and channel buffers until teardown.
+
+StreamCapture.py implements the StreamCapture and CompressedLog classes and methods, as well as the read_log() function.
+'''
+
+import os
+import zlib
+import logging
+from Queue import Queue, Empty
+from threading import Thread, Lock
+from threading import currentThread
+
+from loadtest.RunEngine import monotonic
+
+# zstandard is optional, and only needed for logcompress = zstd (gzip is used instead if it isn't installed):
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# File name extension of the logs for each compression:
+EXTENSIONS = {'off': '', 'gzip': '.gz', 'zstd': '.zst'}
+# Most queued items the writer takes in one batch:
+BATCH_ITEMS = 256
+
+
+class StreamCapture(object): #{
+    '''
+    class StreamCapture(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __queue = Bounded Queue.Queue of (log, data) items waiting to be written by the writer thread
+        __chunk_size = Maximum number of bytes read from a source in one go
+        __compression = 'off', 'gzip' or 'zstd' (see EXTENSIONS)
+        __flush_size = Bytes written to the logs since the last flush that trigger a flush
+        __flush_interval = Most seconds between flushes
+        __writer = The writer Thread, which is the only thread that ever writes to (or closes) a log file
+        __logs = Set of the logs opened and not yet closed, which the writer closes when it stops
+        __logs_lock = threading.Lock guarding __logs, as the logs are opened from the phase threads
+
+    Overview:
+    Each attached source (a paramiko file/channel or a sub-process pipe) gets a small reader thread which reads whatever
+    data is available and puts it on the shared queue. A single writer thread takes data off the queue and writes it to
+    the right log file.
+    The writer takes everything queued (up to BATCH_ITEMS) in one go, and writes each log's share of it in one write.
+    The logs have buffers of flush_size, and are only flushed once flush_size bytes have been written since the last
+    flush, or flush_interval seconds have passed. With dozens of UEs reporting every second, that is one flush per log
+    a second at most, rather than one per report.
+    The queue is bounded, so if the disk can't keep up the readers block on the queue and stop reading. This pushes back on
+    the pipe or the SSH channel window, and memory use stays flat however long the test runs. So the writer never stops
+    taking from the queue: a log that can't be written (e.g. the disk is full) is reported once and the rest of it is
+    dropped, and the other logs carry on.
+    Anything written to a log (headers, notes) must go through write() so that it lands in order with the captured data.
+    With compression, each log is compressed as it is written (see CompressedLog), and its name gets the extension of
+    the compression. stop() closes every log that is still open, so the logs are complete however the test ended
+    (e.g. Ctrl-C part way through starting a phase).
+
+    Public methods:
+    start(self):
+    Starts the writer thread.
+
+    open_log(self, path):
+    Opens a log file for writing and returns it. Use os.devnull for a log that isn't wanted.
+    With compression, the file opened is path plus the compression's extension.
+
+    attach(self, source, log, listener=None):
+    Starts a reader thread copying everything read from source into log, until end of file. Returns the reader Thread.
+    If a listener is given, it is also called with every chunk of data read (e.g. IntervalParser.feed).
+
+    write(self, log, data):
+    Queues data to be written to log.
+
+    close_log(self, log):
+    Queues the closing of log, after everything already queued for it has been written.
+
+    stop(self):
+    Writes out everything that's still queued and stops the writer thread.
+
+    '''
+
+    def __init__(self, max_chunks=1024, chunk_size=4096, compression='off', flush_size=65536, flush_interval=1.0): #{
+        '''
+        Constructor:
+            max_chunks = size of the queue. At most max_chunks * chunk_size bytes are held in memory at any time
+            chunk_size = maximum size of a single read from a source
+            compression = 'off', 'gzip' or 'zstd'
+            flush_size = bytes written that trigger a flush of the logs
+            flush_interval = most seconds between flushes of the logs
+        '''
+        if compression not in EXTENSIONS:
+            raise ValueError('logcompress must be off, gzip or zstd, not ' + str(compression))
+        if compression == 'zstd' and zstandard is None:
+            logging.warning('The zstandard module is not installed, compressing the logs with gzip instead')
+            compression = 'gzip'
+        self.__queue = Queue(max_chunks)
+        self.__chunk_size = chunk_size
+        self.__compression = compression
+        self.__flush_size = flush_size
+        self.__flush_interval = flush_interval
+        self.__writer = Thread(target=self.__write_loop)
+        self.__writer.setName('log-writer')
+        self.__writer.setDaemon(True)
+        self.__logs = set()
+        self.__logs_lock = Lock()
+    #} End method __init__
+
+    def start(self): #{
+        self.__writer.start()
+    #} End method start
+
+    def open_log(self, path): #{
+        if path == os.devnull:
+            log = open(path, 'w')
+        elif self.__compression != 'off':
+            log = CompressedLog(path + EXTENSIONS[self.__compression], self.__compression)
+        else:
+            log = open(path, 'w', self.__flush_size)
+        # Kept so that stop() closes it even if nothing is ever written to it:
+        with self.__logs_lock:
+            self.__logs.add(log)
+        return log
+    #} End method open_log
+
+    def attach(self, source, log, listener=None): #{
+        reader = Thread(target=self.__read_loop, args=[source, log, listener])
+        reader.setName(currentThread().getName() + '-reader')
+        reader.setDaemon(True)
+        reader.start()
+        return reader
+    #} End method attach
+
+    def write(self, log, data): #{
+        self.__queue.put((log, data))
+    #} End method write
+
+    def close_log(self, log): #{
+        self.__queue.put((log, None))
+    #} End method close_log
+
+    def stop(self): #{
+        self.__queue.put(None)
+        self.__writer.join()
+    #} End method stop
+
+    def __read_loop(self, source, log, listener): #{
+        # paramiko channels (and the files returned by exec_command) have recv(), pipes are read through their file descriptor:
+        if hasattr(source, 'channel'): source = source.channel
+        if hasattr(source, 'recv'):
+            read = source.recv
+        else:
+            fd = source.fileno()
+            read = lambda size: os.read(fd, size)
+        while True:
+            try:
+                data = read(self.__chunk_size)
+            except (IOError, OSError, EOFError), e:
+                logging.debug('Capture source closed with error: ' + str(e))
+                break
+            if not data: break
+            if listener is not None: listener(data)
+            # Blocks while the queue is full, which is what pushes back on the source:
+            self.__queue.put((log, data))
+        logging.debug('Capture source finished')
+    #} End method __read_loop
+
+    def __write_loop(self): #{
+        dirty_logs = set()
+        failed_logs = set()
+        unflushed = 0
+        next_flush = monotonic() + self.__flush_interval
+        is_stopping = False
+        while True:
+            items = []
+            try:
+                # Once stopping, only what is already queued is taken:
+                if not is_stopping: items.append(self.__queue.get(timeout=max(next_flush - monotonic(), 0.01)))
+                # Take whatever else is queued, so each log gets one write per batch:
+                while len(items) < BATCH_ITEMS:
+                    items.append(self.__queue.get_nowait())
+            except Empty:
+                pass
+            if is_stopping and not items: break
+            pending = {}
+            for item in items:
+                if item is None:
+                    # The rest of the batch (and of the queue) is still written before stopping:
+                    is_stopping = True
+                    continue
+                log, data = item
+                if data is None: # Closed, after what was queued for it before
+                    if log in pending: self.__call(failed_logs, log, 'write', ''.join(pending.pop(log)))
+                    self.__call(failed_logs, log, 'close')
+                    with self.__logs_lock:
+                        self.__logs.discard(log)
+                    dirty_logs.discard(log)
+                    failed_logs.discard(log)
+                elif log not in failed_logs:
+                    pending.setdefault(log, []).append(data)
+                    unflushed += len(data)
+            for log, chunks in pending.items():
+                self.__call(failed_logs, log, 'write', ''.join(chunks))
+                dirty_logs.add(log)
+            if unflushed >= self.__flush_size or monotonic() >= next_flush:
+                for dirty_log in dirty_logs: self.__call(failed_logs, dirty_log, 'flush')
+                dirty_logs.clear()
+                unflushed = 0
+                next_flush = monotonic() + self.__flush_interval
+        # Nothing more is coming, so close whatever is still open (which finishes the compressed logs), written to or not:
+        with self.__logs_lock:
+            logs, self.__logs = self.__logs, set()
+        for log in logs: self.__call(failed_logs, log, 'close')
+    #} End method __write_loop
+
+    def __call(self, failed_logs, log, method, *args): #{
+        # Writes to, flushes or closes log. An error (e.g. the disk is full) only costs that log: it is reported once, and
+        # anything else queued for it is dropped, so the writer carries on draining the queue and the readers and stop()
+        # never wait on it for ever:
+        if log in failed_logs and method != 'close': return
+        try:
+            getattr(log, method)(*args)
+        except Exception, e:
+            if log not in failed_logs:
+                logging.warning('Could not ' + method + ' the log ' + str(getattr(log, 'name', log)) + ', dropping the rest '
+                                'of it: ' + str(e))
+            failed_logs.add(log)
+    #} End method __call
+#} End class StreamCapture
+
+
+class CompressedLog(object): #{
+    '''
+    class CompressedLog(object):
+    Sub-class of:                    object
+    Public instance variables:
+        name = Path of the log file, as for a file
+    Private instance variables:
+        __file = The log file
+        __compressor = zlib compressobj (gzip format) or zstandard compressobj
+        __sync = Argument to the compressor's flush() that ends a block without ending the stream
+
+    Overview:
+    A log file that is gzip or zstd compressed as it is written, with the write(), flush() and close() methods of a file.
+    flush() ends the current compressed block, so everything written so far can be read back (see read_log) even if the
+    test never gets to close() it. The fastest compression levels are used, as the point is less disk I/O, not the
+    smallest files.
+
+    Public methods:
+    write(self, data), flush(self), close(self):
+    As for a file.
+
+    '''
+
+    def __init__(self, path, compression): #{
+        '''
+        Constructor:
+            path = path of the log file
+            compression = 'gzip' or 'zstd'
+        '''
+        self.name = path
+        self.__file = open(path, 'wb')
+        if compression == 'zstd':
+            self.__compressor = zstandard.ZstdCompressor(level=1).compressobj()
+            self.__sync = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            # wbits of 16 + MAX_WBITS writes a gzip header and trailer rather than a zlib one:
+            self.__compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.__sync = zlib.Z_SYNC_FLUSH
+    #} End method __init__
+
+    def write(self, data): #{
+        self.__file.write(self.__compressor.compress(data))
+    #} End method write
+
+    def flush(self): #{
+        self.__file.write(self.__compressor.flush(self.__sync))
+        self.__file.flush()
+    #} End method flush
+
+    def close(self): #{
+        try:
+            self.__file.write(self.__compressor.flush())
+        finally:
+            self.__file.close()
+    #} End method close
+#} End class CompressedLog
+
+
+def read_log(path): #{
+    '''
+    Returns the contents of a log, decompressed if its name ends in .gz or .zst.
+    A compressed log that was never closed (e.g. the test machine crashed) is read as far as its last flush.
+    '''
+    log_file = open(path, 'rb')
+    data = log_file.read()
+    log_file.close()
+    if path.endswith('.gz'): return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+    if path.endswith('.zst'):
+        if zstandard is None: raise ValueError('the zstandard module is needed to read ' + path)
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+#} End method read_log
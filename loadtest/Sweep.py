@@ -0,0 +1,241 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.Sweep runs a whole matrix of tests (e.g. packet length x rate x direction) from one base config, back to back,
+rather than an ini file being hand-edited and TestLauncher.py run again for every combination. It is run with
+TestLauncher.py --sweep <config file>, the axes being the items of the config's [Sweep] section.
+
+Sweep.py implements the Sweep class and methods.
+'''
+
+import os
+import json
+import hashlib
+import logging
+import itertools
+from datetime import datetime
+
+from loadtest.TestConfig import TestConfig
+from loadtest.TestInstance import TestInstance
+from loadtest.ThroughputSeries import ThroughputSeries
+from loadtest.SSHPool import SSHPool
+from loadtest.TestPlan import to_str
+from loadtest import Tracing
+
+# The UE config items each of the named axes sets (any other axis sets the UE config item of the same name):
+AXIS_ITEMS = {'length': ('t0dllen', 't1dllen', 't0ullen', 't1ullen'),
+              'rate': ('t0dlthroughput', 't1dlthroughput', 't0ulthroughput', 't1ulthroughput'),
+              'direction': ('testtype',)}
+SERIES_FIELDS = ('ue', 'phase', 'direction', 'role')
+# Bump this when the checkpoint format changes, so older checkpoints are not resumed:
+CHECKPOINT_VERSION = 1
+
+
+class Sweep(object): #{
+    '''
+    class Sweep(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __config_file = Path of the base config file
+        __env = SysEnvironment the UE addresses come from, for every cell
+        __axes = List of the (name, values) tuples of the [Sweep] section
+        __globals = Globals dict from the base config
+        __checkpoint_path = Path of the checkpoint file (the base config file with .sweep added)
+        __checkpoint = Dictionary of the checkpoint: the key of the base config, the sweep directory, and the results
+            rows of every completed cell
+        __logdir = The sweep directory, which the cell configs, the cells' logs and sweep_results.csv go in
+        __cells = List of the (cell name, dictionary of axis name to value) of every cell, in the order they are run
+
+    Overview:
+    Every combination of the values of the [Sweep] items is a cell, e.g.
+        [Sweep]
+        length: 200B, 600B, 1200B
+        rate: 2M, 4M, 8M, 16M, 32M, 64M
+        direction: DL, UL
+    is 36 cells. Each cell's config is the base config with the cell's values set in every UE section (length sets the
+    t0/t1 DL/UL packet lengths, rate the t0/t1 DL/UL throughputs, direction the testType, and any other name the UE
+    config item of that name), written to cell<n>.ini in the sweep directory, with the cell's logs going in there too.
+    The cells are run one after the other, each by a TestInstance of its own, but all with the same SysEnvironment
+    (the interfaces are only read once) and the same SSH pool (the test servers are only connected to once).
+    After each cell, the summary of every series (see ThroughputSeries.SUMMARY_FIELDS) is added to the checkpoint file
+    next to the config, and sweep_results.csv, one table of every completed cell, is written again. If the sweep is
+    interrupted (or a cell fails), running it again carries on from the first cell that didn't complete, in the same
+    sweep directory, as long as the config hasn't changed. The checkpoint is removed once every cell has completed.
+    With tracing on, each cell starts a new trace, so each cell's trace.json holds only that cell's run.
+
+    Public methods:
+    run(self):
+    Runs every cell that hasn't completed yet. Returns True if the whole sweep has completed, and False if it was
+    interrupted or a cell failed.
+
+    get_rows(self):
+    Returns the results rows (dictionaries) of every completed cell.
+
+    get_report(self):
+    Returns a table of the mean throughput and loss of every receiving side of every completed cell, for printing.
+
+    '''
+
+    def __init__(self, config_file, env): #{
+        '''
+        Constructor:
+            config_file = path of the base config file
+            env = SysEnvironment instance
+        '''
+        config = TestConfig(config_file)
+        self.__config_file = config_file
+        self.__env = env
+        self.__axes = config.get_sweep_axes()
+        if not self.__axes: raise ValueError('The config ' + config_file + ' has no [Sweep] section to sweep')
+        self.__globals = config.get_globals()
+        self.__checkpoint_path = config_file + '.sweep'
+        self.__checkpoint = None
+        self.__logdir = None
+        width = len(str(reduce(lambda count, axis: count * len(axis[1]), self.__axes, 1)))
+        self.__cells = []
+        for index, values in enumerate(itertools.product(*[values for _, values in self.__axes])):
+            self.__cells.append(('cell' + str(index + 1).zfill(width), dict(zip([name for name, _ in self.__axes], values))))
+    #} End method __init__
+
+    def run(self): #{
+        self.__load_checkpoint()
+        pending = [cell for cell in self.__cells if cell[0] not in self.__checkpoint['cells']]
+        if len(pending) < len(self.__cells):
+            logging.warning('Resuming the sweep in ' + self.__logdir + ', ' + str(len(pending)) + ' of ' +
+                            str(len(self.__cells)) + ' cells left')
+        pool = SSHPool()
+        completed = True
+        try:
+            for name, values in pending:
+                logging.warning('Sweep ' + name + ': ' + ', '.join([axis + ' = ' + values[axis] for axis, _ in self.__axes]))
+                try:
+                    if Tracing.is_enabled(): Tracing.enable()
+                    test = TestInstance(self.__write_cell_config(name, values), self.__env, pool=pool)
+                    if not test.run_test():
+                        # Interrupted by the user, so the cell is run again when the sweep is resumed:
+                        completed = False
+                        break
+                except KeyboardInterrupt:
+                    logging.warning('Process interrupted by user.\n')
+                    completed = False
+                    break
+                except Exception, e:
+                    logging.warning('Sweep ' + name + ' failed, skipped: ' + str(e))
+                    completed = False
+                    continue
+                self.__checkpoint['cells'][name] = self.__get_cell_rows(name, values, test.get_series_store())
+                self.__save_checkpoint()
+                self.__write_results()
+        finally:
+            pool.close_all()
+        if completed and os.path.exists(self.__checkpoint_path):
+            # Nothing left to resume, so the next run starts a new sweep:
+            os.remove(self.__checkpoint_path)
+        return completed
+    #} End method run
+
+    def get_rows(self): #{
+        if self.__checkpoint is None: return []
+        return [row for name, _ in self.__cells for row in self.__checkpoint['cells'].get(name, [])]
+    #} End method get_rows
+
+    def get_report(self): #{
+        header = ['Cell'] + [name.capitalize() for name, _ in self.__axes] + ['UE', 'Phase', 'Dir', 'Mean Kb/s', 'Loss %']
+        lines = []
+        for row in self.get_rows():
+            if row['role'] != 'server': continue
+            lines.append([row['cell']] + [row[name] for name, _ in self.__axes] +
+                         [row['ue'], str(row['phase']), row['direction'], '%.0f' % row['mean_kbps'],
+                          '%.2f' % row['loss_pct']])
+        widths = [max([len(line[column]) for line in [header] + lines]) for column in range(len(header))]
+        return '\n'.join(['  '.join([value.ljust(width) for value, width in zip(line, widths)])
+                          for line in [header] + lines])
+    #} End method get_report
+
+    def __load_checkpoint(self): #{
+        # Carry on from the checkpoint if it is of this config, otherwise start a new sweep:
+        key = self.__get_key()
+        if os.path.exists(self.__checkpoint_path):
+            try:
+                checkpoint_file = open(self.__checkpoint_path)
+                checkpoint = to_str(json.load(checkpoint_file))
+                checkpoint_file.close()
+                if checkpoint.get('key') == key and os.path.isdir(checkpoint['logdir']):
+                    self.__checkpoint = checkpoint
+                    self.__logdir = checkpoint['logdir']
+                    return
+                logging.warning('The config has changed since the sweep checkpoint was written, starting a new sweep')
+            except (IOError, ValueError, KeyError), e:
+                logging.warning('Could not read the sweep checkpoint ' + self.__checkpoint_path + ': ' + str(e))
+        if not os.path.exists(self.__globals['logdir']): os.mkdir(self.__globals['logdir'])
+        self.__logdir = os.path.join(self.__globals['logdir'], 'Sweep_' + str(datetime.now().strftime('%d-%m-%Y_%H%M%S')))
+        os.mkdir(self.__logdir)
+        self.__checkpoint = {'key': key, 'logdir': self.__logdir, 'cells': {}}
+        self.__save_checkpoint()
+    #} End method __load_checkpoint
+
+    def __save_checkpoint(self): #{
+        # Written to a new file and then renamed over the old one, so an interrupted write can't lose the checkpoint:
+        temp_path = self.__checkpoint_path + '.tmp'
+        checkpoint_file = open(temp_path, 'w')
+        json.dump(self.__checkpoint, checkpoint_file)
+        checkpoint_file.close()
+        if os.path.exists(self.__checkpoint_path): os.remove(self.__checkpoint_path)
+        os.rename(temp_path, self.__checkpoint_path)
+    #} End method __save_checkpoint
+
+    def __get_key(self): #{
+        config_file = open(self.__config_file, 'rb')
+        key = hashlib.sha1(config_file.read())
+        config_file.close()
+        key.update(str(CHECKPOINT_VERSION))
+        return key.hexdigest()
+    #} End method __get_key
+
+    def __write_cell_config(self, name, values): #{
+        '''
+        Writes the config of one cell to the sweep directory, and returns its path
+        '''
+        config = TestConfig(self.__config_file)
+        config.remove_section('Sweep')
+        if not config.has_section('Globals'): config.add_section('Globals')
+        # The cell's logs go in the sweep directory, and are marked with the cell:
+        config.set('Globals', 'baselogdir', self.__logdir)
+        config.set('Globals', 'logprefix', self.__globals['logprefix'] + name + '-')
+        if not config.has_option('Globals', 'logging'): config.set('Globals', 'logging', str(self.__globals['logging']))
+        for section in config.sections():
+            if section == 'Globals': continue
+            for axis, value in values.items():
+                for item in AXIS_ITEMS.get(axis, (axis,)):
+                    config.set(section, item, value)
+        path = os.path.join(self.__logdir, name + '.ini')
+        config_file = open(path, 'w')
+        config.write(config_file)
+        config_file.close()
+        return path
+    #} End method __write_cell_config
+
+    def __get_cell_rows(self, name, values, series_store): #{
+        rows = []
+        for series in series_store.get_all_series():
+            row = {'cell': name, 'ue': series.ue, 'phase': series.phase, 'direction': series.direction,
+                   'role': series.role}
+            row.update(values)
+            row.update(series.summary())
+            rows.append(row)
+        return rows
+    #} End method __get_cell_rows
+
+    def __write_results(self): #{
+        fields = ('cell',) + tuple([name for name, _ in self.__axes]) + SERIES_FIELDS + ThroughputSeries.SUMMARY_FIELDS
+        results_file = open(os.path.join(self.__logdir, 'sweep_results.csv'), 'w')
+        results_file.write(','.join(fields) + '\n')
+        for row in self.get_rows():
+            results_file.write(','.join([str(row.get(field, '')) for field in fields]) + '\n')
+        results_file.close()
+    #} End method __write_results
+#} End class Sweep
@@ -5,16 +5,20 @@ Change history:
 Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
 Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
 
-loadtest.SysEnvironment implements some functions of the Windows Management Instrumentation API (WMI) in order to query 
-information about the currently active interfaces. It also provides some methods for easy access to this information.
+loadtest.SysEnvironment queries information about the currently active interfaces, through the Windows Management 
+Instrumentation API (WMI) on Windows or netlink on Linux (see InterfaceBackends.py). It also provides some methods for easy 
+access to this information.
 
 SysEnvironment.py implements the SysEnvironment class and methods only.
 
 @author: Oliver Thomas
 '''
 
-import wmi
-import re
+import time
+import logging
+
+from loadtest.InterfaceBackends import get_default_backend
+from loadtest import Tracing
 
 class SysEnvironment(object): #{
     '''
@@ -24,14 +28,17 @@ class SysEnvironment(object): #{
 	Private instance variables:
 	    __sys_addr = Dictionary for holding a list of active interface names (as keys) and their IPv4 address
 	    __sys_id = Dictionary for holding a list of active interface names (as keys) and their Interface ID
-	    __c	= Instance of the WMI object
+	    __name_of_id = Dictionary of Interface IDs (as keys) and their interface name
+	    __name_of_addr = Dictionary of IPv4 addresses (as keys) and their interface name
+	    __backend = Platform-specific interface backend (WMIBackend on Windows, LinuxBackend on Linux)
 	Private instance methods:
-		__init_interfaces() = object initialisation method to populate __sys_addr and __sys_id structures with active 
-		interface info.
+		__init_interfaces() = object initialisation method to populate the dictionaries with active interface info.
 
 	Overview:
 	The SysEnvironment class holds data structures containing the active interface IDs, names, and IPv4 addresses, for all 
-	active interfaces on the Windows machine. It also provides some convenience methods for accessing that information.
+	active interfaces on the machine. It also provides some convenience methods for accessing that information.
+	All the interfaces are read from the backend in one pass at construction, and indexed by name, ID and address so 
+	every lookup is a dictionary lookup.
 	
 	Public methods:
 	get_interfaces_dict(self):
@@ -42,15 +49,35 @@ class SysEnvironment(object): #{
 	Returns the IPv4 address for the Network Interface name specified by searchStr. Returns 'Invalid Argument' if the key 
 	doesn't exist.
 	
+	get_id_of(self, searchStr)
+	Returns the Interface ID for the Network Interface name specified by searchStr, or None if the key doesn't exist.
+	
+	get_name_of_id(self, interface_id)
+	Returns the Network Interface name with the given Interface ID, or None if there isn't one.
+	
+	get_name_of_addr(self, addr)
+	Returns the Network Interface name with the given IPv4 address, or None if there isn't one.
+	
+	get_backend(self)
+	Returns the interface backend.
+	
+	update_interface(self, name, interface_id, addr)
+	Updates the dictionaries for a single interface (used by InterfaceWatcher when the system reports a change). addr = None 
+	removes the interface. Returns the previous IPv4 address of the interface, or None.
+	
     '''
 
-    def __init__(self): #{
+    def __init__(self, backend=None): #{
         '''
-        Constructor
+        Constructor:
+            backend = interface backend to use. Default is the backend for the current platform.
         '''
         self.__sys_addr = {}
         self.__sys_id = {}
-        self.__c = wmi.WMI()
+        self.__name_of_id = {}
+        self.__name_of_addr = {}
+        if backend is None: backend = get_default_backend()
+        self.__backend = backend
         
         '''
 		Initialize __sys_addr dict with current system adapters and IPs:
@@ -68,30 +95,15 @@ class SysEnvironment(object): #{
     #} End method __str__
         
     def __init_interfaces(self): #{
-        
-        '''
-		RegEx string to match valid IPv4 address:
-		'''
-        ipv4 = re.compile('^(?:[0-9]{1,3}\.){3}[0-9]{1,3}$')
-        '''
-		For all interfaces in the Network Adapter object, find the Adapter Configuration object 
-		with InterfaceIndex equal to the Network Adapter InterfaceIndex:
-		'''
-        for interface in self.__c.Win32_NetworkAdapter():
-            for interfaceConfig in self.__c.Win32_NetworkAdapterConfiguration(InterfaceIndex=interface.InterfaceIndex):
-                if not interface.NetConnectionID is None and not interfaceConfig.IPAddress is None:
-                    '''
-					Then this is a valid adapter with at least one address
-					'''
-                    addr_list = interfaceConfig.IPAddress
-                    for ip in addr_list:
-                        if ipv4.match(ip):
-                            '''
-						    Then this is a valid IPv4 address. If more than one IPv4 address is found, this function will only add the last found
-							'''
-                            ipv4_addr = ip
-                    self.__sys_addr[interface.NetConnectionID] = ipv4_addr
-                    self.__sys_id[interface.NetConnectionID] = interface.InterfaceIndex
+        start = time.time()
+        trace = Tracing.span('env.enumerate')
+        for name, interface_id, ipv4_addr in self.__backend.enumerate():
+            self.__sys_addr[name] = ipv4_addr
+            self.__sys_id[name] = interface_id
+            self.__name_of_id[interface_id] = name
+            self.__name_of_addr[ipv4_addr] = name
+        trace.end(interfaces=len(self.__sys_addr))
+        logging.debug('Found ' + str(len(self.__sys_addr)) + ' interfaces in ' + str(time.time() - start) + ' seconds')
     #} End method __init_interfaces
     
     def get_interfaces_dict(self): #{
@@ -111,5 +123,34 @@ class SysEnvironment(object): #{
         else:
             return self.__sys_addr[searchStr]
     #} End method get_addr_of
+    
+    def get_id_of(self, searchStr): #{
+        return self.__sys_id.get(searchStr)
+    #} End method get_id_of
+    
+    def get_name_of_id(self, interface_id): #{
+        return self.__name_of_id.get(interface_id)
+    #} End method get_name_of_id
+    
+    def get_name_of_addr(self, addr): #{
+        return self.__name_of_addr.get(addr)
+    #} End method get_name_of_addr
+    
+    def get_backend(self): #{
+        return self.__backend
+    #} End method get_backend
+    
+    def update_interface(self, name, interface_id, addr): #{
+        old_addr = self.__sys_addr.pop(name, None)
+        old_id = self.__sys_id.pop(name, None)
+        if self.__name_of_addr.get(old_addr) == name: del self.__name_of_addr[old_addr]
+        if self.__name_of_id.get(old_id) == name: del self.__name_of_id[old_id]
+        if addr is not None:
+            self.__sys_addr[name] = addr
+            self.__sys_id[name] = interface_id
+            self.__name_of_id[interface_id] = name
+            self.__name_of_addr[addr] = name
+        return old_addr
+    #} End method update_interface
 
 #} End class SysEnvironment
\ No newline at end of file
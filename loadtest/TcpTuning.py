@@ -0,0 +1,327 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.TcpTuning picks the TCP window size (iperf -w) and number of parallel streams (iperf -P) of each UE from a
+short probe of its link, rather than every TCP test being run with one stream and an 8M window whatever the link: one
+stream under-fills a high-latency bearer, and an 8M window only bloats the buffers of a low-latency one.
+It is switched on with the Globals (or UE) 'tcpTuning' item.
+
+TcpTuning.py implements the TcpTuner and TcpProbe classes and methods, as well as the measure_rtt() and choose_settings()
+module functions.
+'''
+
+import os
+import math
+import socket
+import logging
+from threading import Thread, Event
+
+from loadtest.StreamCapture import StreamCapture
+from loadtest.ThroughputSeries import ThroughputSeries
+from loadtest.IntervalParser import IntervalParser, parse_size
+from loadtest.UEPhase import spawn_local
+from loadtest.RunEngine import monotonic
+from loadtest.SSHPool import get_ssh_port
+
+# Window size and number of streams of a TCP test that isn't tuned (and of the probe):
+DEFAULT_WINDOW = '8M'
+DEFAULT_STREAMS = '1'
+# Length of the probe in seconds, and the number of connects the RTT is the median of:
+PROBE_TIME = 3
+RTT_SAMPLES = 5
+# Seconds to wait for each connect of the RTT measurement, and for the probe's server to start listening:
+CONNECT_TIMEOUT = 2.0
+LISTEN_TIMEOUT = 10.0
+# The windows add up to this many times the bandwidth-delay product, as the probe's single stream may not have filled
+# the link, and no window is smaller than MIN_WINDOW:
+HEADROOM = 2.0
+MIN_WINDOW = 64 * 1024
+
+
+class TcpProbe(object): #{
+    '''
+    class TcpProbe(object):
+    Sub-class of:                    object
+    Public instance variables:
+        name = Name of the probe for debug purposes, e.g. 'UE1-DL'
+        ue = Adapter name of the UE
+        direction = 'DL' or 'UL'
+    Private instance variables:
+        __remote = RemoteProcesses the remote iperfs are started and killed through
+        __capture = StreamCapture the logs and the iperf output go through
+        __ue_config = UE config dict from TestConfig
+        __ue_ip = Address of the UE
+        __port = Port of the iperf server (the port of the UE's test, which isn't running yet)
+        __settings = Globals dict, for tcpmaxwindow and tcpmaxstreams
+        __stop = threading.Event set to stop the probe
+        __series = ThroughputSeries the client's reports are parsed into
+        __listening = threading.Event set once the server has said it is listening
+        __client_log, __server_log = Log files of the client and the server
+        __readers = Capture reader threads of the server and the client
+        __server, __client = The local Popen, or the stdout of the remote channel, of the server and the client
+        __server_handle, __client_handle = RemoteProcesses handles of the remote server (UL) or client (DL)
+        __result = Dict of the probe's result (None until the probe has finished)
+
+    Overview:
+    The RTT from the UE's address to its test server is measured first, as the time a TCP connect to the server's SSH
+    port takes (see measure_rtt), so nothing needs to be installed and nothing needs raw sockets. A single-stream TCP
+    iperf with the untuned 8M window is then run for PROBE_TIME seconds in the probe's direction (the server is on this
+    machine for DL and on the test server for UL, as in the test), and the median of its interval reports after the
+    first (which is mostly slow start) is taken as the throughput the link achieves. The window size and number of
+    streams are chosen from the bandwidth-delay product of the two (see choose_settings).
+
+    Public methods:
+    run(self):
+    Thread target: runs the probe.
+
+    stop(self):
+    Kills the server (and the client, if it is still running) and closes the logs.
+
+    get_result(self):
+    Returns a dict of the RTT (seconds), throughput (Kbits/sec), window (iperf size) and streams chosen, or None if the
+    probe didn't finish.
+
+    '''
+
+    def __init__(self, remote, capture, ue_config, ue_ip, direction, port, settings, stop, log_prefix): #{
+        '''
+        Constructor:
+            remote = RemoteProcesses for the test servers
+            capture = StreamCapture for the logs
+            ue_config = UE config dict
+            ue_ip = address of the UE
+            direction = 'DL' or 'UL'
+            port = port of the iperf server
+            settings = Globals dict
+            stop = threading.Event set to stop the probe
+            log_prefix = path and name prefix of the log files, None to not keep logs
+        '''
+        self.name = ue_config['adaptername'] + '-' + direction
+        self.ue = ue_config['adaptername']
+        self.direction = direction
+        self.__remote = remote
+        self.__capture = capture
+        self.__ue_config = ue_config
+        self.__ue_ip = ue_ip
+        self.__port = port
+        self.__settings = settings
+        self.__stop = stop
+        self.__series = ThroughputSeries(self.ue, 0, direction, 'client')
+        self.__listening = Event()
+        self.__client_log = capture.open_log(log_prefix + '_client.log' if log_prefix else os.devnull)
+        self.__server_log = capture.open_log(log_prefix + '_server.log' if log_prefix else os.devnull)
+        self.__readers = []
+        self.__server = None
+        self.__client = None
+        self.__server_handle = None
+        self.__client_handle = None
+        self.__result = None
+    #} End method __init__
+
+    def run(self): #{
+        ftpserver = self.__ue_config['ftpserver']
+        rtt = measure_rtt(self.__ue_ip, ftpserver[0], get_ssh_port(ftpserver))
+        if rtt is None:
+            logging.warning(self.name + ': could not connect to ' + ftpserver[0] + ' to measure the RTT, not tuned')
+            return
+        port = str(self.__port)
+        if self.direction == 'DL':
+            server_str = 'iperf -s -p ' + port + ' -B ' + self.__ue_ip + ' -i 1 -P 0 -f k -w ' + DEFAULT_WINDOW
+            client_str = 'iperf -p ' + port + ' -c ' + self.__ue_ip + ' -t ' + str(PROBE_TIME) + ' -B ' + \
+                ftpserver[0] + ' -i 1 -P ' + DEFAULT_STREAMS + ' -f k -w ' + DEFAULT_WINDOW
+        else:
+            server_str = 'iperf -s -p ' + port + ' -i 1 -P 0 -f k -w ' + DEFAULT_WINDOW
+            client_str = 'iperf -p ' + port + ' -c ' + ftpserver[0] + ' -t ' + str(PROBE_TIME) + ' -B ' + \
+                self.__ue_ip + ' -i 1 -P ' + DEFAULT_STREAMS + ' -f k -w ' + DEFAULT_WINDOW
+
+        self.__capture.write(self.__server_log, '\n-----------Executing command - ' + server_str + '--------------\n\n')
+        if self.direction == 'DL':
+            self.__server = spawn_local(server_str)
+            source = self.__server.stdout
+        else:
+            self.__server_handle, self.__server = self.__remote.start(ftpserver, self.name + '_probe_server', server_str)
+            source = self.__server
+        self.__readers.append(self.__capture.attach(source, self.__server_log, self.__on_server_output))
+        if not self.__listening.wait(LISTEN_TIMEOUT):
+            logging.debug(self.name + ': the probe server has not said it is listening, starting anyway')
+        if self.__stop.is_set(): return
+
+        self.__capture.write(self.__client_log, '\n-----------Executing command - ' + client_str + '--------------\n\n')
+        if self.direction == 'DL':
+            self.__client_handle, self.__client = self.__remote.start(ftpserver, self.name + '_probe_client', client_str)
+            is_running = lambda: not self.__client.channel.exit_status_ready()
+            source = self.__client
+        else:
+            self.__client = spawn_local(client_str)
+            is_running = lambda: self.__client.poll() is None
+            source = self.__client.stdout
+        parser = IntervalParser(self.__series)
+        self.__readers.append(self.__capture.attach(source, self.__client_log, parser.feed))
+        while is_running() and not self.__stop.is_set():
+            self.__stop.wait(0.1)
+        if self.__stop.is_set(): return
+        for reader in self.__readers[1:]: reader.join(5)
+
+        # The first second is mostly slow start, so it only counts if it is all there is:
+        kbps = sorted(self.__series.columns['kbps'][1:] or self.__series.columns['kbps'])
+        if not kbps:
+            logging.warning(self.name + ': the probe has no throughput reports, see its log, not tuned')
+            return
+        kbps = kbps[len(kbps) // 2]
+        window, streams = choose_settings(kbps, rtt, parse_size(self.__settings['tcpmaxwindow']),
+                                          self.__settings['tcpmaxstreams'])
+        self.__result = {'rtt': rtt, 'kbps': kbps, 'window': window, 'streams': streams}
+        logging.warning(self.name + ': RTT ' + str(int(round(rtt * 1000))) + ' ms, ' + str(int(kbps)) +
+                        ' Kbits/sec with one stream, tuned to -w ' + window + ' -P ' + str(streams))
+    #} End method run
+
+    def stop(self): #{
+        # The server is local for DL and the client is local for UL, the other one is remote:
+        local, remote = (self.__server, self.__client) if self.direction == 'DL' else (self.__client, self.__server)
+        kills = [handle for handle in (self.__server_handle, self.__client_handle) if handle is not None]
+        if kills:
+            self.__remote.kill(self.__ue_config['ftpserver'], kills)
+            self.__remote.flush()
+        if local is not None and local.poll() is None: local.terminate()
+        for reader in self.__readers: reader.join(5)
+        if remote is not None: remote.channel.close()
+        for reader in self.__readers: reader.join()
+        for log in (self.__client_log, self.__server_log):
+            if self.__stop.is_set(): self.__capture.write(log, '\nProcess Interrupted by User.\n')
+            self.__capture.close_log(log)
+        logging.debug(self.name + ': probe stopped')
+    #} End method stop
+
+    def get_result(self): #{
+        return self.__result
+    #} End method get_result
+
+    def __on_server_output(self, data): #{
+        if 'listening' in data: self.__listening.set()
+    #} End method __on_server_output
+#} End class TcpProbe
+
+
+class TcpTuner(object): #{
+    '''
+    class TcpTuner(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __remote = RemoteProcesses the remote iperfs of the probes are run through
+        __settings = Globals dict
+        __stop = threading.Event set to stop the probes (the test's interrupt event)
+        __log_prefix = Path and name prefix of the probe logs, None to not keep logs
+        __capture = StreamCapture for the probe logs and iperf output
+        __probes = List of the TcpProbe of every UE and direction
+
+    Overview:
+    Every UE and direction is probed at the same time, each by its own TcpProbe on its own thread, so tuning takes a
+    few seconds however many UEs there are. A SIM UE has its DL and UL probed together, as they would be run in the
+    test. The probes are run before any of the test's phases, on the ports of the UEs' tests.
+    With logging, the client and server logs of each probe go in the test's log directory, as <prefix><UE>_TCPProbe_DL
+    _client.log etc.
+
+    Public methods:
+    add(self, ue_config, ue_ip, direction, port):
+    Adds a probe of one UE and direction.
+
+    run(self):
+    Runs the probes, and returns a dict of (ue, direction) to the result (see TcpProbe.get_result) of every probe that
+    finished. Returns early if the stop event is set, or the user hits Ctrl-C (which sets it).
+
+    '''
+
+    def __init__(self, remote, settings, stop, log_prefix=None): #{
+        '''
+        Constructor:
+            remote = RemoteProcesses for the test servers
+            settings = Globals dict
+            stop = threading.Event set to stop the probes
+            log_prefix = path and name prefix of the log files, None to not keep logs
+        '''
+        self.__remote = remote
+        self.__settings = settings
+        self.__stop = stop
+        self.__log_prefix = log_prefix
+        self.__capture = StreamCapture(compression=settings['logcompress'])
+        self.__probes = []
+    #} End method __init__
+
+    def add(self, ue_config, ue_ip, direction, port): #{
+        log_prefix = None
+        if self.__log_prefix is not None:
+            log_prefix = self.__log_prefix + ue_config['adaptername'] + '_TCPProbe_' + direction
+        self.__probes.append(TcpProbe(self.__remote, self.__capture, ue_config, ue_ip, direction, port,
+                                      self.__settings, self.__stop, log_prefix))
+    #} End method add
+
+    def run(self): #{
+        self.__capture.start()
+        threads = []
+        try:
+            for probe in self.__probes:
+                thread = Thread(target=probe.run, name=probe.name + '-probe')
+                thread.setDaemon(True)
+                thread.start()
+                threads.append(thread)
+            # Joined with a timeout, so that Ctrl-C still gets through to this thread:
+            for thread in threads:
+                while thread.isAlive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            self.__stop.set()
+            for thread in threads: thread.join()
+        finally:
+            for probe in self.__probes:
+                probe.stop()
+            self.__capture.stop()
+        results = {}
+        for probe in self.__probes:
+            if probe.get_result() is not None: results[(probe.ue, probe.direction)] = probe.get_result()
+        return results
+    #} End method run
+#} End class TcpTuner
+
+
+def measure_rtt(ue_ip, host, port): #{
+    '''
+    Returns the median time (in seconds) of RTT_SAMPLES TCP connects from ue_ip to host:port, or None if none of them
+    connected. A connect takes one round trip (the SYN and the SYN-ACK), and the connection is closed straight away.
+    '''
+    samples = []
+    for _ in xrange(RTT_SAMPLES):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.bind((ue_ip, 0))
+            start = monotonic()
+            sock.connect((host, port))
+            samples.append(monotonic() - start)
+        except socket.error:
+            pass
+        finally:
+            sock.close()
+    if not samples: return None
+    samples.sort()
+    return samples[len(samples) // 2]
+#} End method measure_rtt
+
+
+def choose_settings(kbps, rtt, max_window, max_streams): #{
+    '''
+    Returns the (window, streams) to run a TCP test with, window as an iperf size (e.g. '512K'), for a link that carries
+    kbps Kbits/sec with an RTT of rtt seconds. The windows of all the streams add up to HEADROOM times the
+    bandwidth-delay product. Each stream's window is at most max_window bytes (the largest window the OSs at both ends
+    will actually give a socket), so a link needing more than that gets more streams, up to max_streams.
+    '''
+    needed = kbps * 1000 / 8 * rtt * HEADROOM
+    streams = int(min(max_streams, max(1, math.ceil(needed / max_window))))
+    window = min(max_window, max(MIN_WINDOW, needed / streams))
+    # In whole KBytes, rounded up to a power of two (as the OSs do with socket buffers anyway):
+    kbytes = min(2 ** int(math.ceil(math.log(window / 1024, 2))), int(max_window // 1024))
+    return str(kbytes) + 'K', streams
+#} End method choose_settings
@@ -14,8 +14,13 @@ TestConfig.py implements the TestConfig class and methods
 '''
 
 import os
+import re
+import multiprocessing
 from ConfigParser import ConfigParser
 
+# A template section standing for a range of UEs, e.g. [UE1-64]:
+RANGE_SECTION = re.compile(r'^(.*?)(\d+)-(\d+)$')
+
 
 class TestConfig(ConfigParser): #{
     '''
@@ -29,9 +34,9 @@ class TestConfig(ConfigParser): #{
     TestInstance than it would be on the raw ConfigParser class.
 
     Public methods:
-    is_list(self, section, option):
+    is_list(self, section, option, value=None):
     Returns a boolean which determines if a config item is a comma-delimited list or not. 
-    Tests for the presence of ',' in the config item value
+    Tests for the presence of ',' in the config item value (or in value, if the caller already has it)
     
     get_list(self, section, option):
     Alternative to ConfigParser.get. Returns the item at section/option, but will return a list rather than a single value, 
@@ -43,11 +48,21 @@ class TestConfig(ConfigParser): #{
     get_full_ue_configs(self):
     Returns a list of all the dicts representing all the configured UEs. Each dict includes all the config items for each UE, 
     including list values if present.
+    A section named like [UE1-64] is a template for a range of UEs ([UE1] to [UE64]), and {n} in any of its values is
+    replaced by each UE's number (Python format specs can be used too, e.g. {n:02d}). A section of its own for one of
+    the UEs in the range (e.g. [UE5]) overrides the template's values for that UE.
     
     get_globals(self):
     Returns all the config items in the 'Globals' section of the config. If Globals is not present then it also defines and
     returns some default values.
     
+    get_default(self, section, option, default):
+    Alternative to ConfigParser.get. Returns default if the section or option is not present.
+
+    get_sweep_axes(self):
+    Returns the axes of the parameter sweep (the 'Sweep' section, see Sweep.py), as a list of (name, list of values)
+    tuples in the order they are in the config. Returns an empty list if there is no Sweep section.
+    
     '''
 
     def __init__(self, path): #{
@@ -64,8 +79,9 @@ class TestConfig(ConfigParser): #{
         self.read(path)
     #} End method __init__
 
-    def is_list(self, section, option): #{
-        if str(self.get(section, option)).count(',') == 0:
+    def is_list(self, section, option, value=None): #{
+        if value is None: value = self.get(section, option)
+        if str(value).count(',') == 0:
         ## Then this is not a comma-delimited list...
             return 0
         else:
@@ -75,7 +91,8 @@ class TestConfig(ConfigParser): #{
 
     def get_list(self, section, option): #{
         value = self.get(section, option)
-        if self.is_list(section, option):
+        # Pass the value in, so that get() (which does all the interpolation) isn't called twice:
+        if self.is_list(section, option, value):
         ## Then this is a comma-delimited list, return the list...
             value_list = str(value).split(',')
             return value_list
@@ -94,12 +111,40 @@ class TestConfig(ConfigParser): #{
     def get_full_ue_configs(self): #{
         ue_config = {}
         ue_configs = []
+        # The UE sections covered by a template, which are merged into it rather than added on their own:
+        covered = set()
         for section in self.sections():
-            if not section == 'Globals':
+            match = RANGE_SECTION.match(section)
+            if match is None: continue
+            for n in range(int(match.group(2)), int(match.group(3)) + 1):
+                covered.add(match.group(1) + str(n))
+        for section in self.sections():
+            if section in ('Globals', 'Sweep') or section in covered: continue
+            match = RANGE_SECTION.match(section)
+            if match is None:
                 ue_config = self.get_section_map(section)
                 ue_configs.append(ue_config)
+                continue
+            # Expand the template into one config per UE:
+            template = self.get_section_map(section)
+            for n in range(int(match.group(2)), int(match.group(3)) + 1):
+                ue_config = {}
+                for option, value in template.items():
+                    ue_config[option] = self.__substitute(value, n, section, option)
+                if self.has_section(match.group(1) + str(n)):
+                    ue_config.update(self.get_section_map(match.group(1) + str(n)))
+                ue_configs.append(ue_config)
         return ue_configs
     #} End method get_full_ue_configs
+
+    def __substitute(self, value, n, section, option): #{
+        # Replaces {n} in a template value (or in each item of a list value) with the UE number:
+        if isinstance(value, list): return [self.__substitute(item, n, section, option) for item in value]
+        try:
+            return value.format(n=n)
+        except (KeyError, IndexError, ValueError), e:
+            raise ValueError('[' + section + '] ' + option + ': only {n} can be substituted in a template, not ' + str(e))
+    #} End method __substitute
     
     def get_globals(self): #{
         globals_dict = {}
@@ -111,7 +156,65 @@ class TestConfig(ConfigParser): #{
             globals_dict['logdir'] = os.path.normpath('C:\\loadTestLogs\\')
             globals_dict['logging'] = 1 # Yes please!
             globals_dict['logprefix'] = 'Undefined-' # No prefix defined
+        # Optional items, which take their default if not present even when there is a Globals section:
+        # Local traffic engine, either 'iperf' or 'native' (UDP only, see TrafficEngine.py)
+        globals_dict['engine'] = self.get_default('Globals', 'engine', 'iperf')
+        # Number of worker processes to spread the UEs over (0 = run everything in this process, auto = one per core)
+        workers = self.get_default('Globals', 'workers', '0')
+        globals_dict['workers'] = multiprocessing.cpu_count() if workers == 'auto' else int(workers)
+        # Follow the UE interfaces during the test: off, mark (mark outages on the series) or restart (and restart phases)
+        globals_dict['ifwatch'] = self.get_default('Globals', 'ifwatch', 'off')
+        # SQLite database that every run's per-second reports are added to (empty = don't keep them, see ResultsStore.py)
+        resultsdb = self.get_default('Globals', 'resultsdb', '')
+        globals_dict['resultsdb'] = os.path.normpath(resultsdb) if resultsdb else ''
+        # Port to serve the live Prometheus metrics of the test on (0 = don't serve them, see MetricsExporter.py)
+        globals_dict['metricsport'] = int(self.get_default('Globals', 'metricsport', '0'))
+        # Run the remote processes of each test server through one agent process on it (1) rather than a channel each (0)
+        globals_dict['serveragent'] = int(self.get_default('Globals', 'serveragent', '0'))
+        # host:port of the agents to run the test on, controlled from here (empty = run it here, see Distributed.py)
+        agents = self.get_default('Globals', 'agents', '')
+        globals_dict['agents'] = [agent.strip() for agent in agents.split(',') if agent.strip()]
+        # Compress the iperf logs as they are written: off, gzip or zstd (see StreamCapture.py)
+        globals_dict['logcompress'] = self.get_default('Globals', 'logcompress', 'off')
+        # Sample the CPU, processes and NICs of this machine and the test servers every second (see ResourceSampler.py)
+        globals_dict['resources'] = int(self.get_default('Globals', 'resources', '0'))
+        # CPU percentage (of one core) at which a core or process of the rig counts as saturated
+        globals_dict['saturation'] = float(self.get_default('Globals', 'saturation', '90'))
+        # Tune the window size and parallel streams of each TCP UE from a probe of its link: off or auto (see TcpTuning.py)
+        globals_dict['tcptuning'] = self.get_default('Globals', 'tcptuning', 'off')
+        # Largest window a tuned TCP stream is given, as an iperf size, and the most parallel streams a tuned UE is given
+        globals_dict['tcpmaxwindow'] = self.get_default('Globals', 'tcpmaxwindow', '2M')
+        globals_dict['tcpmaxstreams'] = int(self.get_default('Globals', 'tcpmaxstreams', '8'))
+        # Settings of the maximum throughput search (TestLauncher --search, see ThroughputSearch.py):
+        # Highest packet loss in percent a trial can have and still pass
+        globals_dict['searchloss'] = float(self.get_default('Globals', 'searchloss', '1'))
+        # Length of each trial in seconds
+        globals_dict['searchtrial'] = int(self.get_default('Globals', 'searchtrial', '5'))
+        # The search stops once the highest passing and lowest failing rates are within this percentage of each other
+        globals_dict['searchprecision'] = float(self.get_default('Globals', 'searchprecision', '5'))
+        # Highest rate that is tried, as an iperf rate
+        globals_dict['searchmax'] = self.get_default('Globals', 'searchmax', '1000M')
+        # Packet lengths to search with (empty = the t0 length of each UE)
+        lengths = self.get_default('Globals', 'searchlengths', '')
+        globals_dict['searchlengths'] = [length.strip() for length in lengths.split(',') if length.strip()]
             
         return globals_dict
     #} End method get_globals
+    
+    def get_default(self, section, option, default): #{
+        if self.has_option(section, option):
+            return self.get(section, option)
+        else:
+            return default
+    #} End method get_default
+
+    def get_sweep_axes(self): #{
+        if not self.has_section('Sweep'): return []
+        axes = []
+        for option in self.options('Sweep'):
+            values = [value.strip() for value in self.get('Sweep', option).split(',') if value.strip()]
+            if not values: raise ValueError('[Sweep] ' + option + ': no values to sweep')
+            axes.append((option, values))
+        return axes
+    #} End method get_sweep_axes
 #} End class TestConfig
\ No newline at end of file
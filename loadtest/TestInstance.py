@@ -7,11 +7,11 @@ Version 1.0 - May 2014 - Full re-write of TestInstance, included support for log
 
 loadtest.TestInstance  instantiates the TestConfig class which reads the config file. 
 It also implements the run_test() method whereby the test is executed. 
-The run_test() method uses Timer threads to set up each test according to the configuration.
+The run_test() method uses the RunEngine to start and stop each UEPhase according to the configuration.
 Logging of iperf output on both client and server sides is supported.
 UDP and TCP tests are supported.
 
-TestInstance.py implements the TestInstance class and methods, as well as the run_ue_test thread target method.
+TestInstance.py implements the TestInstance class and methods.
 
 TODO: For future developers:
 - iperf is very CPU-hungary. Maybe use a different more integrated byte-slinging method??
@@ -22,17 +22,31 @@ TODO: For future developers:
 @author: Oliver Thomas
 '''
 
-import subprocess
-import time
 import os
+import json
+import socket
+import math
 import logging
 from datetime import datetime
-from threading import Timer
 from threading import Event
 
-import paramiko
-
 from loadtest.TestConfig import TestConfig
+from loadtest.SSHPool import SSHPool
+from loadtest.RemoteProcesses import RemoteProcesses
+from loadtest.StreamCapture import StreamCapture
+from loadtest.ThroughputSeries import SeriesStore
+from loadtest.UEPhase import UEPhase
+from loadtest.RunEngine import RunEngine, monotonic
+from loadtest.InterfaceWatcher import InterfaceWatcher
+from loadtest.PortAllocator import PortAllocator
+from loadtest.ResultsStore import ResultsStore
+from loadtest.MetricsExporter import MetricsExporter
+from loadtest.ResourceSampler import ResourceSampler
+from loadtest.TestPlan import TestPlan, get_phase_numbers, get_profiles
+from loadtest.WorkerPool import WorkerPool
+from loadtest.Distributed import Controller
+from loadtest.TcpTuning import TcpTuner, DEFAULT_WINDOW, DEFAULT_STREAMS
+from loadtest import Tracing
 
 # Change to logging.DEBUG for development:
 # Default (production) = WARNING
@@ -52,120 +66,572 @@ class TestInstance(object): #{
         __globals = Global config dict obtained from the __config (contains default values defined in TestConfig if no [Globals] element is present)
         __env = SysEnvironment instance passed to the constructor. Contains the UE IP addresses.
         __interrupt_event = threading.Event for signalling a Ctrl-C event to the child threads from the main thread.
+        __pool = SSHPool holding one SSH connection per test server, shared by all the UE phases.
+        __is_own_pool = False if the __pool was passed in (e.g. by a Sweep), in which case it is left open after the test.
+        __remote = RemoteProcesses starting, tracking and killing the remote iperf processes through the __pool.
+        __capture = StreamCapture which streams the output of every iperf into its log file while the test runs.
+        __series = SeriesStore holding the parsed per-second iperf reports of every UE, phase and direction.
+        __ue_specs = Dictionary of adapter name to (ue_config, is_dl, is_ul), for rebuilding a UE's phases on a new address.
+        __phases = Dictionary of adapter name to the list of that UE's current UEPhases.
+        __engine = The RunEngine running the test (None when not running in this process).
+        __is_logging = The Globals 'logging' item, as a convenience boolean.
+        __ports = PortAllocator holding the iperf server port of every UE, phase and direction.
+        __config_file = Path of the config file, recorded with the run in the results database.
+        __ues = Adapter names of the UEs to run, when running one agent's slice of a distributed test (None = all of them).
+        __port_base = First iperf server port to allocate.
+        __scope = Scope of the PID files on the test servers (see RemoteProcesses.py): the port base for a Distributed
+            agent, as several can share a machine, otherwise None.
+        __pool_report = SSH pool report of the last run.
+        __workers = WorkerPool running the phases, if the test is run by worker processes (None otherwise).
     
     Overview:
-    TestInstance instantiates the TestConfig. It then loops for each UE config in the config file.
-    In each loop it builds a test_config dict for use by the thread method.
-    It then creates the Threads and adds them to a list, starting them all at the same time.
-    The thread obnjects are Timers, with the 2nd phase test being delayed by t1 seconds (if needed)
+    TestInstance instantiates the TestConfig. Before anything else, the whole config is checked by the TestPlan, and any
+    problems with it are reported together. It then asks the PortAllocator for a free iperf server port for every UE,
+    phase and direction (checked on this machine and on the test servers in one go), and loops for each UE config in
+    the config file.
+    In each loop it builds a test_config dict for each phase, and schedules a UEPhase for it on the RunEngine,
+    with the 2nd phase test being delayed by t1 seconds (if needed).
+    The test_configs and ports are cached next to the config file (the .plan file, see TestPlan.py). When the same
+    config is run again and the cached ports are still free, they are used as they are, without validating or building
+    anything, which makes the start of a test with hundreds of UEs much quicker.
+    A UE with a rate profile (dlProfile/ulProfile, see RateProfile.py) has a single phase running the whole profile.
+    Before the RunEngine is started, the SSH pool is warmed up so that every test server is already connected at t0, and
+    any iperf left running on the test servers by an earlier run is killed. The first phases are then prepared (logs
+    opened and servers started and listening) before t0, so that at t0 the RunEngine only has to release their clients,
+    all together. How late each client actually started is reported as start_skew_ms in the summary.
+    Once the test is over, every remote iperf still running is killed with one command per server.
+    A Sweep (see Sweep.py) passes in its own SSH pool, which is then left connected at the end of the test, for the
+    next cell of the sweep.
+    The RunEngine then runs the whole test from the main thread, and returns as soon as the last phase has finished.
+    If the Globals 'workers' item is set, the phases are handed to a WorkerPool instead, which runs them in several
+    core-pinned processes, each with its own SSH pool, capture stage and RunEngine.
+    If the Globals 'ifwatch' item is set, an InterfaceWatcher follows the UE interfaces during the test. When a UE loses
+    its address, the outage is marked on its throughput series ('mark'), and with 'restart' each of its phases is also
+    restarted on the UE's new address for the rest of its duration.
+    If the Globals 'resultsdb' item is set, the per-second reports of the run are also added to that database while the
+    test runs (see ResultsStore.py), so they can be queried across runs.
+    If the Globals 'metricsport' item is set, the live state of every UE and phase is served on that port for Prometheus
+    while the test runs (see MetricsExporter.py).
+    If the Globals 'serveragent' item is set, the remote iperfs of each test server are all run through one process
+    agent on it, started once the server is connected (see ProcessAgent.py).
+    If the Globals 'resources' item is set, the CPU, processes and NICs of this machine and the test servers are
+    sampled every second from the start of the test (see ResourceSampler.py), written to resources.csv, and the seconds
+    in which the rig was saturated are marked on every series that they overlap.
+    If the Globals (or UE) 'tcpTuning' item is auto, the link of each TCP UE is probed once the plan is compiled (see
+    TcpTuning.py), and its phase is built again with the window size and number of parallel streams the probe chose.
+    With tracing on (TestLauncher.py --trace, see Tracing.py), the stages of the run are traced, and the trace is
+    written to trace.json in the run's log directory.
+    If the Globals 'agents' item is set, the test is run on those agents instead, each running its own UEs in a
+    TestInstance of its own, all started at the same time and with their results merged back here (see Distributed.py).
+    Only the results database and metrics of the whole test are kept here, the agents leave them to the controller.
 
     '''
 
 
-    def __init__(self, config_file, env): #{
+    def __init__(self, config_file, env, ues=None, port_base=5000, port_limit=65535, pool=None): #{
         '''
         Constructor:
             config_file = path string of the location and name of the config file to be parsed.
             env = SysEnvironment object containing computer network adapter current information
+            ues = adapter names of the UEs to run, for an agent's slice of a distributed test (None = all of them)
+            port_base, port_limit = range of the iperf server ports to allocate
+            pool = SSHPool to run the test through, and leave connected for the next test (None = one of its own)
         '''
-        self.__config = TestConfig(config_file)
-        self.__ue_configs = self.__config.get_full_ue_configs()
-        self.__globals = self.__config.get_globals()
+        with Tracing.span('config.parse', config=config_file):
+            self.__config = TestConfig(config_file)
+            self.__ue_configs = self.__config.get_full_ue_configs()
+            if ues is not None:
+                self.__ue_configs = [ue_config for ue_config in self.__ue_configs if ue_config.get('adaptername') in ues]
+            self.__globals = self.__config.get_globals()
         self.__env = env
         self.__interrupt_event = Event()
+        self.__pool = pool if pool is not None else SSHPool()
+        self.__is_own_pool = pool is None
+        # An agent's processes are scoped to its port block, as several agents can share a machine (and a server):
+        self.__scope = port_base if ues is not None else None
+        self.__remote = RemoteProcesses(self.__pool, self.__scope)
+        self.__capture = StreamCapture(compression=self.__globals['logcompress'])
+        self.__series = SeriesStore()
+        self.__ue_specs = {}
+        self.__phases = {}
+        self.__engine = None
+        self.__is_logging = False
+        self.__ports = PortAllocator(self.__pool, port_base, port_limit)
+        self.__config_file = config_file
+        self.__ues = ues
+        self.__port_base = port_base
+        self.__pool_report = ''
+        self.__workers = None
     #} End method __init__
 
-    def run_test(self): #{
-        ue_tests = []
-        max_duration = 0
+    def run_test(self, on_ready=None): #{
+        '''
+        Runs the test. Returns True if it ran to completion and False if it was interrupted.
+        on_ready is called once every test server is connected, and the phases are started as soon as it returns (used
+        by the Distributed agents to wait for the controller's start time).
+        '''
         is_logging = self.__globals['logging']
+        # The controller of a distributed test only coordinates the agents, which do everything else:
+        is_controller = bool(self.__globals['agents']) and self.__ues is None
         
         # Set up test-specific log directories, if user indicated logging was needed:
         if is_logging: # User wants logging
             if not os.path.exists(self.__globals['logdir']): os.mkdir(self.__globals['logdir'])
             test_logs = 'LoadTestLogs_' + str(datetime.now().strftime('%d-%m-%Y_%H%M%S'))
+            # An agent's logs are marked with its host and port block, as several agents can share a log directory:
+            if self.__ues is not None: test_logs += '_' + socket.gethostname() + '-' + str(self.__port_base)
             test_logs_abs = os.path.join(self.__globals['logdir'], test_logs)
             os.mkdir(test_logs_abs)
         
-        # Now loop through each UE config
-        for ue_config in self.__ue_configs:
-            ue_ip = self.__env.get_addr_of(ue_config['adaptername'])
-            
-            # Set up ue-specific log directories, if user indicated logging was needed:
-            if is_logging: # User wants logging
-                ue_logs = ue_config['adaptername'] + '_' + str(datetime.now().strftime('%d-%m-%Y_%H%M%S'))
-                ue_logs_abs = os.path.join(test_logs_abs, ue_logs)
-                os.mkdir(ue_logs_abs)
-                
-            # Convenience booleans for test_config and run_ue_test methods
-            is_dl = False
-            is_ul = False
-            if ue_config['testtype'] == 'DL' or ue_config['testtype'] == 'SIM': is_dl = True
-            if ue_config['testtype'] == 'UL' or ue_config['testtype'] == 'SIM': is_ul = True
-            
-            # Now get the test configs
-            phase0_ue_test_config = self.get_test_config(ue_config, ue_ip, 0, is_dl, is_ul)
-            phase1_ue_test_config = self.get_test_config(ue_config, ue_ip, 1, is_dl, is_ul)
-            
-            # Set up UE-specific log file path and file name prefix attributes, if user indicated logging was needed:
-            if is_logging: # User wants logging
-                phase0_ue_test_config['logpath'] = ue_logs_abs
-                phase0_ue_test_config['logname'] = self.__globals['logprefix'] + ue_config['adaptername'] + '_Phase0'
-                phase1_ue_test_config['logpath'] = ue_logs_abs
-                phase1_ue_test_config['logname'] = self.__globals['logprefix'] + ue_config['adaptername'] + '_Phase1'
-            
-            # max_duration should contain the highest duration value from all UE tests
-            # If the UE test is TCP then the total test duration is t1
-            # If the UE test is UDP then the total test duration is t2
-            if ue_config['traffictype'] == 'UDP':
-                if int(ue_config['t2']) > max_duration: max_duration = int(ue_config['t2'])
+        phase_specs = []
+        if is_controller:
+            controller = Controller(self.__globals['agents'], self.__config_file, self.__ue_configs, self.__series)
+        else:
+            # Compile the test plan, the test_config of every phase (see TestPlan.py):
+            with Tracing.span('plan.compile', ues=len(self.__ue_configs)):
+                phase_specs = self.__compile_plan()
+            # Get rid of anything left over from an earlier run before the new one starts:
+            with Tracing.span('remote.sweep'):
+                self.__remote.sweep([ue_config['ftpserver'] for ue_config in self.__ue_configs])
+            # Probe the links of the TCP UEs being tuned, and build their phases again with what suits them:
+            with Tracing.span('tcp.tune'):
+                phase_specs = self.__tune_tcp(phase_specs, os.path.join(test_logs_abs, '') if is_logging else None)
+            if self.__interrupt_event.is_set():
+                logging.warning('Process interrupted by user.\n')
+                self.__close_pool()
+                return False
+        
+        # Set up ue-specific log directories, log file paths and file name prefixes, if user indicated logging was needed:
+        if is_logging: # User wants logging
+            ue_logs_abs = {}
+            for ue_test_config, _, _ in phase_specs:
+                name = ue_test_config['ue']
+                if name not in ue_logs_abs:
+                    ue_logs = name + '_' + str(datetime.now().strftime('%d-%m-%Y_%H%M%S'))
+                    ue_logs_abs[name] = os.path.join(test_logs_abs, ue_logs)
+                    os.mkdir(ue_logs_abs[name])
+                ue_test_config['logpath'] = ue_logs_abs[name]
+                ue_test_config['logname'] = self.__globals['logprefix'] + name + '_Phase' + str(ue_test_config['phase'])
+
+        if is_logging:
+            # Record what the test was run with:
+            metadata_file = open(os.path.join(test_logs_abs, 'run_metadata.json'), 'w')
+            json.dump({'started': datetime.now().isoformat(), 'ports': self.__ports.get_assignments()},
+                      metadata_file, indent=2, sort_keys=True)
+            metadata_file.close()
+
+        # An agent leaves the results database and metrics to its controller, which has the results of the whole test:
+        results = None
+        if self.__globals['resultsdb'] and self.__ues is None:
+            # Add the reports of this run to the results database as they come in (see ResultsStore.py):
+            results = ResultsStore(self.__globals['resultsdb'])
+            results.start_run(self.__series, self.__globals['logprefix'], test_logs_abs if is_logging else None,
+                              self.__config_file)
+        metrics = None
+        if self.__globals['metricsport'] and self.__ues is None:
+            metrics = MetricsExporter(self.__series, self.__get_phase_states, self.__globals['metricsport'])
+            metrics.start()
+        # The agents of a distributed test sample their own rigs:
+        sampler = None
+        if self.__globals['resources'] and not is_controller:
+            sampler = ResourceSampler(self.__pool, [test_config['ftpserver'] for test_config, _, _ in phase_specs],
+                                      [test_config['ue'] for test_config, _, _ in phase_specs],
+                                      os.path.join(test_logs_abs, 'resources.csv') if is_logging else None,
+                                      self.__globals['saturation'])
+            # Sample from the moment the phases are released, so the samples are on the test's timeline:
+            on_ready = self.__start_sampler(sampler, on_ready)
+
+        try:
+            if is_controller:
+                completed = controller.run()
+                pool_report = controller.get_report()
+            elif self.__globals['workers'] > 0:
+                if self.__globals['ifwatch'] != 'off':
+                    logging.warning('The interface watcher is not supported with workers, ifwatch ignored')
+                # The workers connect to the servers themselves, this pool was only needed for the port allocation
+                # (and the sampler, which reconnects):
+                self.__close_pool()
+                # Hand the phases to the worker processes, which do everything else:
+                self.__workers = WorkerPool(self.__globals['workers'], use_agents=self.__globals['serveragent'],
+                                            compression=self.__globals['logcompress'], is_tracing=Tracing.is_enabled(),
+                                            scope=self.__scope)
+                with Tracing.span('workers.run', workers=self.__globals['workers']):
+                    completed = self.__workers.run(phase_specs, is_logging, self.__series, on_ready)
+                pool_report = self.__workers.get_report()
             else:
-                if int(ue_config['t1']) > max_duration: max_duration = int(ue_config['t1'])
-            # Create Timer threads for each phase, delayed by the phase delay, passing in test_config and the interrupt event:
-            phase0Process = Timer(phase0_ue_test_config['delay'], run_ue_test, [self.__interrupt_event, phase0_ue_test_config, is_dl, is_ul, is_logging])
-            # Name the threads for debug purposes
-            phase0Process.setName(ue_config['adaptername'] + '-phase0')
-            phase1Process = Timer(phase1_ue_test_config['delay'], run_ue_test, [self.__interrupt_event, phase1_ue_test_config, is_dl, is_ul, is_logging])
-            phase1Process.setName(ue_config['adaptername'] + '-phase1')
-            # And add it to the list of threads:
-            # All the tests are started at the same time, but are timed to start when needed using Timer threads:
-            ue_tests.append(phase0Process)
-            # Only add Phase 1 if testing UDP:
-            if ue_config['traffictype'] == 'UDP': ue_tests.append(phase1Process)
-
-        # Now run all the threads together:
-        for t in ue_tests:
-            t.start()
+                completed, pool_report = self.__run_phases(phase_specs, is_logging, on_ready)
+        finally:
+            if sampler is not None:
+                sampler.stop()
+                self.__close_pool()
+            if metrics is not None: metrics.stop()
+            if results is not None: results.finish()
+
+        if sampler is not None:
+            busy = sampler.get_busy()
+            self.__mark_busy(phase_specs, busy)
+            if busy:
+                busy_secs = sum([end - start for start, end in busy])
+                logging.warning('The test rig was saturated for ' + str(int(round(busy_secs))) +
+                                ' seconds of the test, see rig_busy_secs in the summary')
+
+        logging.debug('SSH pool statistics:\n' + pool_report)
+        if is_logging:
+            pool_log = open(os.path.join(test_logs_abs, 'ssh_pool.log'), 'w')
+            pool_log.write(pool_report)
+            pool_log.close()
+            self.__series.write_summary(os.path.join(test_logs_abs, 'summary.csv'))
+        if Tracing.is_enabled():
+            # Next to the rest of the run's logs, or in the log directory if there aren't any:
+            if is_logging:
+                trace_path = os.path.join(test_logs_abs, 'trace.json')
+            else:
+                if not os.path.exists(self.__globals['logdir']): os.mkdir(self.__globals['logdir'])
+                trace_path = os.path.join(self.__globals['logdir'],
+                                          'LoadTestTrace_' + str(datetime.now().strftime('%d-%m-%Y_%H%M%S')) + '.json')
+            Tracing.write(trace_path)
+        self.__pool_report = pool_report
+        return completed
+    #} End method run_test
+
+    def __start_sampler(self, sampler, on_ready): #{
+        '''
+        Returns the on_ready function to run the test with: calls on_ready (if any), then starts the sampler
+        '''
+        def start(): #{
+            if on_ready is not None: on_ready()
+            sampler.start()
+        #} End method start
+        return start
+    #} End method __start_sampler
+
+    def __mark_busy(self, phase_specs, busy): #{
+        '''
+        Marks the windows in which the rig was saturated (in seconds from the start of the test) on every series,
+        moved onto the timeline of the series' phase
+        '''
+        starts = {}
+        for test_config, _, _ in phase_specs:
+            starts[(test_config['ue'], test_config['phase'])] = test_config['delay'] - test_config['offset']
+        for series in self.__series.get_all_series():
+            start = starts.get((series.ue, series.phase))
+            if start is None: continue
+            for busy_start, busy_end in busy:
+                series.mark_busy(busy_start - start, busy_end - start)
+    #} End method __mark_busy
+
+    def __close_pool(self): #{
+        '''
+        Closes the SSH connections, unless the pool was passed in, to be used again by the next test
+        '''
+        if self.__is_own_pool: self.__pool.close_all()
+    #} End method __close_pool
+
+    def __tune_tcp(self, phase_specs, log_dir): #{
+        '''
+        Returns the phase_specs with the phases of every TCP UE whose tcpTuning is auto built again, with the window size
+        and number of parallel streams its probe chose (see TcpTuning.py). The UEs that couldn't be probed keep theirs.
+        '''
+        tuned = []
+        for ue_config, is_dl, is_ul in self.__ue_specs.values():
+            if ue_config['traffictype'] != 'TCP' or get_profiles(ue_config, is_dl, is_ul): continue
+            if ue_config.get('tcptuning', self.__globals['tcptuning']) == 'auto': tuned.append(ue_config['adaptername'])
+        if not tuned: return phase_specs
+        tuner = TcpTuner(self.__remote, self.__globals, self.__interrupt_event,
+                         log_dir + self.__globals['logprefix'] if log_dir is not None else None)
+        for test_config, is_dl, is_ul in phase_specs:
+            if test_config['ue'] not in tuned: continue
+            # A TCP test has only the one phase, whose ports the probes use before it starts:
+            for direction, is_direction in (('DL', is_dl), ('UL', is_ul)):
+                if not is_direction: continue
+                port = self.__ports.get_port((test_config['ue'], test_config['phase'], direction))
+                tuner.add(self.__ue_specs[test_config['ue']][0], test_config['ue_ip'], direction, port)
+        results = tuner.run()
+        if not results: return phase_specs
+
+        for name in tuned:
+            ue_config, is_dl, is_ul = self.__ue_specs[name]
+            ue_config = dict(ue_config)
+            for direction in ('DL', 'UL'):
+                result = results.get((name, direction))
+                if result is None: continue
+                ue_config['tcp' + direction.lower() + 'window'] = result['window']
+                ue_config['tcp' + direction.lower() + 'streams'] = str(result['streams'])
+                ue_config['tcp' + direction.lower() + 'rtt'] = result['rtt']
+            # Kept, so that a phase restarted on a new address is run with the same settings:
+            self.__ue_specs[name] = (ue_config, is_dl, is_ul)
+        return [(self.get_test_config(self.__ue_specs[test_config['ue']][0], test_config['ue_ip'], test_config['phase'],
+                                      is_dl, is_ul), is_dl, is_ul)
+                if test_config['ue'] in tuned else (test_config, is_dl, is_ul)
+                for test_config, is_dl, is_ul in phase_specs]
+    #} End method __tune_tcp
+
+    def __compile_plan(self): #{
+        '''
+        Returns the list of (test_config, is_dl, is_ul) of every phase of the test. They come from the cached plan if
+        there is one for this config and its ports are all still free, otherwise the config is validated, the ports are
+        allocated and the test_configs are built, and the plan is cached for the next run.
+        '''
+        plan = TestPlan(self.__config_file, self.__ue_configs, self.__env)
+        cached = plan.load()
+        if cached is not None and \
+                not self.__ports.restore(cached['ports'], [ue_config['ftpserver'] for ue_config in self.__ue_configs]):
+            cached = None
+        # Everything wrong with the config is reported in one go, before anything is started:
+        if cached is None: plan.validate()
+        for ue_config, is_dl, is_ul in plan.get_ue_specs():
+            self.__ue_specs[ue_config['adaptername']] = (ue_config, is_dl, is_ul)
+        if cached is not None:
+            logging.debug('Using the cached test plan, ' + str(len(cached['phase_specs'])) + ' phases')
+            return cached['phase_specs']
+        
+        # Work out which phases each UE has, and get the ports for all of them:
+        for ue_config, is_dl, is_ul in plan.get_ue_specs():
+            for phase in get_phase_numbers(ue_config):
+                # The DL iperf server runs on this machine, the UL server on the test server:
+                if is_dl: self.__ports.request((ue_config['adaptername'], phase, 'DL'), 'local')
+                if is_ul: self.__ports.request((ue_config['adaptername'], phase, 'UL'), ue_config['ftpserver'])
+        self.__ports.allocate()
+        
+        # Now loop through each UE config, and get the test configs (only Phase 1 if testing UDP without a rate profile):
+        phase_specs = []
+        for ue_config, is_dl, is_ul in plan.get_ue_specs():
+            ue_ip = self.__env.get_addr_of(ue_config['adaptername'])
+            for phase in get_phase_numbers(ue_config):
+                phase_specs.append((self.get_test_config(ue_config, ue_ip, phase, is_dl, is_ul), is_dl, is_ul))
+        plan.save(phase_specs, self.__ports.get_assignments())
+        return phase_specs
+    #} End method __compile_plan
+
+    def __run_phases(self, phase_specs, is_logging, on_ready): #{
+        '''
+        Runs all the phases in this process. Returns a (completed, SSH pool report) tuple.
+        '''
+        engine = RunEngine(self.__interrupt_event)
+        self.__engine = engine
+        self.__is_logging = is_logging
+        # Schedule each phase on the run engine, to start after the phase delay:
+        for test_config, is_dl, is_ul in phase_specs:
+            phase = UEPhase(self.__remote, self.__capture, self.__series, test_config, is_dl, is_ul, is_logging)
+            self.__phases.setdefault(phase.ue, []).append(phase)
+            engine.schedule(phase)
+
+        # Connect to all the test servers before any of the phases start, so no handshake happens at t0:
+        with Tracing.span('ssh.warm'):
+            self.__pool.warm([test_config['ftpserver'] for test_config, _, _ in phase_specs])
+        if self.__globals['serveragent']:
+            with Tracing.span('agents.start'):
+                self.__remote.start_agents([test_config['ftpserver'] for test_config, _, _ in phase_specs])
+
+        # Now run the test, until the last phase finishes or the user hits Ctrl-C (handled by the engine):
+        self.__capture.start()
+        watcher = None
+        if self.__globals['ifwatch'] != 'off':
+            watcher = InterfaceWatcher(self.__env)
+            watcher.add_listener(self.__on_interface_change)
+            watcher.start()
         try:
-            # Wait for end of test, or until user hits Ctrl-C
-            time.sleep(max_duration + 5)
-            logging.debug('Total test waiting finished after ' + str(max_duration + 5) + ' seconds')
-        except KeyboardInterrupt:
-            # Inform all the threads an interrupt was encountered:
-            self.__interrupt_event.set()
-            # And cancel any Timer threads still waiting:
-            for t in ue_tests: t.cancel()
-            logging.warning('Process interrupted by user.\n')
-            logging.warning('Tearing down processes and closing logs...\n')
+            # Open the logs and start the servers of the first phases, so that only their clients are left to start:
+            with Tracing.span('phases.prepare'):
+                engine.prepare()
+            try:
+                if on_ready is not None:
+                    with Tracing.span('ready.wait'):
+                        on_ready()
+            except KeyboardInterrupt:
+                # The engine tears down the prepared phases as interrupted:
+                self.__interrupt_event.set()
+            except Exception:
+                self.__interrupt_event.set()
+                engine.run()
+                raise
+            with Tracing.span('engine.run', phases=len(phase_specs)):
+                completed = engine.run()
+        finally:
+            # Every phase has been torn down by now:
+            if watcher is not None: watcher.stop()
+            self.__engine = None
+            # Kill any remote process that is still running, then the logs and SSH connections can go:
+            with Tracing.span('remote.teardown'):
+                self.__remote.teardown()
+            with Tracing.span('capture.stop'):
+                self.__capture.stop()
+            self.__close_pool()
+        return completed, self.__pool.get_report()
+    #} End method __run_phases
+
+    def __on_interface_change(self, name, addr): #{
+        '''
+        InterfaceWatcher listener (called on the watcher thread)
+        '''
+        now = monotonic()
+        phases = self.__phases.get(name, [])
+        for index, phase in enumerate(phases):
+            if not phase.interface_changed(addr, now): continue
+            if self.__globals['ifwatch'] != 'restart' or self.__engine is None: continue
+            # The UE has a new address, so build the phase again on it:
+            ue_config, is_dl, is_ul = self.__ue_specs[name]
+            old_config = phase.get_test_config()
+            elapsed = phase.get_elapsed(now)
+            if elapsed is None: # Not started yet, so it just needs the new address
+                test_config = self.get_test_config(ue_config, addr, old_config['phase'], is_dl, is_ul)
+            else:
+                remaining = int(math.ceil(old_config['duration'] - (elapsed - old_config['offset'])))
+                if remaining < 1: continue
+                test_config = self.get_test_config(ue_config, addr, old_config['phase'], is_dl, is_ul, remaining, elapsed)
+            if 'logname' in old_config:
+                test_config['logpath'] = old_config['logpath']
+                test_config['logname'] = old_config['logname'] + '_' + addr
+            new_phase = UEPhase(self.__remote, self.__capture, self.__series, test_config, is_dl, is_ul, self.__is_logging)
+            phases[index] = new_phase
+            logging.warning(phase.name + ': restarting on new address ' + addr)
+            self.__engine.replace(phase, new_phase)
+    #} End method __on_interface_change
+
+    def __get_phase_states(self): #{
+        '''
+        Returns a (ue, phase, state) tuple for every phase of the test, for the MetricsExporter (called on its threads)
+        '''
+        # The phases of a test run by workers are in the worker processes, which send their states:
+        if self.__workers is not None: return self.__workers.get_phase_states()
+        states = []
+        for ue, phases in sorted(self.__phases.items()):
+            for phase in list(phases):
+                states.append((ue, phase.get_test_config()['phase'], phase.get_state()))
+        return states
+    #} End method __get_phase_states
+
+    def get_series_store(self): #{
+        '''
+        Getter for the SeriesStore holding the parsed iperf reports of the test
+        '''
+        return self.__series
+    #} End method get_series_store
+
+    def get_pool_report(self): #{
+        '''
+        Getter for the SSH pool report of the last run (with workers or agents, the reports of all of them)
+        '''
+        return self.__pool_report
+    #} End method get_pool_report
+
+    def interrupt(self): #{
+        '''
+        Stops the test as Ctrl-C would (e.g. when the controller of a distributed test says so)
+        '''
+        self.__interrupt_event.set()
+    #} End method interrupt
+
+    def is_interrupted(self): #{
+        '''
+        Returns True if the test has been interrupted
+        '''
+        return self.__interrupt_event.is_set()
+    #} End method is_interrupted
+
+    def get_pool_stats(self): #{
+        '''
+        Getter for the SSH pool statistics (see SSHPool.get_stats), when the test was not run with workers
+        '''
+        return self.__pool.get_stats()
+    #} End method get_pool_stats
     
-    def get_test_config(self, ue_config, ue_ip, phase, is_dl, is_ul):
+    def get_test_config(self, ue_config, ue_ip, phase, is_dl, is_ul, duration=None, offset=0.0): #{
+        '''
+        Builds the test_config dict of one phase of a UE.
+        If duration is given, the phase is a restart: it starts straight away, runs for duration seconds, and reports
+        its times offset seconds from the start of the original phase.
+        '''
         test_config = {}
         # Copy some needed attributes straight into test config:
         test_config['test_type'] = ue_config['testtype']
+        test_config['traffic_type'] = ue_config['traffictype']
         test_config['ftpserver'] = ue_config['ftpserver']
+        test_config['ue'] = ue_config['adaptername']
+        test_config['phase'] = phase
+        test_config['ue_ip'] = ue_ip
+        test_config['offset'] = offset
         # phase_str is used to form parts of the iperf strings:
         phase_str = 't' + str(phase)
+        profiles = get_profiles(ue_config, is_dl, is_ul)
         
-        if phase == 0: # First phase of UDP test, or total test duration if TCP
+        if profiles: # The whole rate profile, from its first point to its end
+            test_config['delay'] = profiles.values()[0].get_start()
+            test_config['duration'] = profiles.values()[0].get_duration()
+        elif phase == 0: # First phase of UDP test, or total test duration if TCP
             test_config['delay'] = int(ue_config['t0'])
             test_config['duration'] = int(ue_config['t1'])
         else:
             test_config['delay'] = int(ue_config['t1'])
             test_config['duration'] = int(ue_config['t2']) - int(ue_config['t1'])
+        if duration is not None:
+            test_config['delay'] = 0
+            test_config['duration'] = duration
+            # A restarted profile carries on from where it had got to:
+            for direction in profiles.keys():
+                profiles[direction] = profiles[direction].get_tail(offset)
+        
+        # The local iperf can be replaced by the native traffic engine for UDP tests (see TrafficEngine.py).
+        # The native engine takes the same command line options, so only the program name changes:
+        local_iperf = 'iperf'
+        if ue_config.get('engine', self.__globals['engine']) == 'native':
+            if ue_config['traffictype'] == 'UDP':
+                local_iperf = 'native'
+            else:
+                logging.warning(ue_config['adaptername'] + ': the native traffic engine only supports UDP, using iperf')
         
-        # Calculate port numbers in a way that avoids conflict between UEs, phases etc.:
-        dl_port = str(5000 + ((phase + 1) * 30) + int(ue_config['ueid']))
-        ul_port = str(5000 + ((phase + 1) * 90) + int(ue_config['ueid']))
+        # Port numbers were allocated by run_test (see PortAllocator.py), so they don't conflict between UEs, phases etc.:
+        if is_dl: dl_port = str(self.__ports.get_port((ue_config['adaptername'], phase, 'DL')))
+        if is_ul: ul_port = str(self.__ports.get_port((ue_config['adaptername'], phase, 'UL')))
+
+        if profiles:
+            if 'dl' in profiles:
+                # The remote iperf client can't change its rate, so it is run once per step, by one chained command and
+                # against the same local server (see RateProfile.get_steps):
+                dl_profile = profiles['dl']
+                test_config['dl_client_steps'] = ['iperf' + \
+                    ' -p ' + dl_port + \
+                    ' -c ' + ue_ip + \
+                    ' -t %g' % step_duration + \
+                    ' -b ' + str(rate) + \
+                    ' -l ' + length + \
+                    ' -B ' + ue_config['ftpserver'][0] + \
+                    ' -u -i 1 -P 1 -f k -w 8M' for step_duration, rate, length in dl_profile.get_steps()]
+                test_config['dl_client_str'] = ' ; '.join(test_config['dl_client_steps'])
+                test_config['dl_server_str'] = local_iperf + ' -s' + \
+                    ' -p ' + dl_port + \
+                    ' -B ' + ue_ip + \
+                    ' -l ' + str(dl_profile.get_max_length()) + \
+                    ' -u -U -i 1 -P 0 -f k -w 8M'
+            if 'ul' in profiles:
+                # The UL client is always the native engine, as it can follow the profile in one stream:
+                ul_profile = profiles['ul']
+                first_rate, first_length = ul_profile.get_segment(0)
+                test_config['ul_server_str'] = 'iperf -s' + \
+                    ' -p ' + ul_port + \
+                    ' -l ' + str(ul_profile.get_max_length()) + \
+                    ' -u -U -i 1 -P 0 -f k -w 8M'
+                test_config['ul_client_str'] = 'native' + \
+                    ' -B ' + ue_ip + \
+                    ' -c ' + ue_config['ftpserver'][0] + \
+                    ' -t %g' % test_config['duration'] + \
+                    ' -b ' + str(int(first_rate)) + \
+                    ' -p ' + ul_port + \
+                    ' -l ' + str(first_length) + \
+                    ' -u -i 1 -P 1 -f k -w 8M' + \
+                    ' --profile ' + ul_profile.to_option() + \
+                    (' --ramp' if ue_config.get('profilemode', 'step') == 'ramp' else '')
+            return test_config
+
+        # A TCP test is run with the window size and number of parallel streams of the UE config (set by the TcpTuner if
+        # the UE was tuned, see TcpTuning.py), 8M and one stream by default:
+        if ue_config['traffictype'] == 'TCP':
+            test_config['tcp'] = {}
+            for direction in ('DL', 'UL'):
+                test_config['tcp'][direction] = {
+                    'window': ue_config.get('tcp' + direction.lower() + 'window', DEFAULT_WINDOW),
+                    'streams': int(ue_config.get('tcp' + direction.lower() + 'streams', DEFAULT_STREAMS)),
+                    'rtt': ue_config.get('tcp' + direction.lower() + 'rtt')}
 
         # Create the iperf strings:
         if is_dl:
@@ -178,7 +644,7 @@ class TestInstance(object): #{
                     ' -l ' + ue_config[phase_str+'dllen'] + \
                     ' -B ' + ue_config['ftpserver'][0] + \
                     ' -u -i 1 -P 1 -f k -w 8M'
-                test_config['dl_server_str'] = 'iperf -s' + \
+                test_config['dl_server_str'] = local_iperf + ' -s' + \
                     ' -p ' + dl_port + \
                     ' -B ' + ue_ip + \
                     ' -l ' + ue_config[phase_str+'dllen'] + \
@@ -189,21 +655,18 @@ class TestInstance(object): #{
                     ' -c ' + ue_ip + \
                     ' -t ' + str(test_config['duration']) + \
                     ' -B ' + ue_config['ftpserver'][0] + \
-                    ' -i 1 -P 1 -f k -w 8M'
+                    ' -i 1 -P ' + str(test_config['tcp']['DL']['streams']) + ' -f k -w ' + test_config['tcp']['DL']['window']
                 test_config['dl_server_str'] = 'iperf -s' + \
                     ' -p ' + dl_port + \
                     ' -B ' + ue_ip + \
-                    ' -i 1 -P 0 -f k -w 8M'
-            # String needed to kill the client process in case user hits Ctrl-C
-            test_config['dl_client_kill_str'] = \
-                "kill -9 `ps -ef | grep 'iperf -p " + dl_port + "' | grep -v grep | awk '{print $2}'`"
+                    ' -i 1 -P 0 -f k -w ' + test_config['tcp']['DL']['window']
         if is_ul:
             if ue_config['traffictype'] == 'UDP':
                 test_config['ul_server_str'] = 'iperf -s' + \
                     ' -p ' + ul_port + \
-                    ' -l ' + ue_config[phase_str+'dllen'] + \
+                    ' -l ' + ue_config[phase_str+'ullen'] + \
                     ' -u -U -i 1 -P 0 -f k -w 8M'
-                test_config['ul_client_str'] = 'iperf' + \
+                test_config['ul_client_str'] = local_iperf + \
                     ' -B ' + ue_ip + \
                     ' -c ' + ue_config['ftpserver'][0] + \
                     ' -t ' + str(test_config['duration']) + \
@@ -214,115 +677,14 @@ class TestInstance(object): #{
             if ue_config['traffictype'] == 'TCP':
                 test_config['ul_server_str'] = 'iperf -s' + \
                     ' -p ' + ul_port + \
-                    ' -i 1 -P 0 -f k -w 8M' # ' -B ' + ue_config['ftpserver'][0] + \
+                    ' -i 1 -P 0 -f k -w ' + test_config['tcp']['UL']['window'] # ' -B ' + ue_config['ftpserver'][0] + \
                 test_config['ul_client_str'] = 'iperf' + \
                     ' -p ' + ul_port + \
                     ' -c ' + ue_config['ftpserver'][0] + \
                     ' -t ' + str(test_config['duration']) + \
                     ' -B ' + ue_ip + \
-                    ' -i 1 -P 1 -f k -w 8M'
-            # String needed to kill the server process before exiting (to avoid leaving orphaned process)
-            test_config['ul_server_kill_str'] = \
-                "kill -9 `ps -ef | grep 'iperf -s -p " + ul_port + "' | grep -v grep | awk '{print $2}'`"
+                    ' -i 1 -P ' + str(test_config['tcp']['UL']['streams']) + ' -f k -w ' + test_config['tcp']['UL']['window']
         
         return test_config
-
-    #} End method run_test
+    #} End method get_test_config
 #} End class TestInstance
-
-def run_ue_test(interrupt, test_config, is_dl, is_ul, is_logging): #{
-    
-    # the ftpServer item of the UE config contains a list of three values specifying the IP, Username and Password of the FTP server
-    server_ip = test_config['ftpserver'][0]
-    server_uname = test_config['ftpserver'][1]
-    server_passw = test_config['ftpserver'][2]
-    server = paramiko.SSHClient()
-    # Stop paramiko from halting the program if the local key is not authorised:
-    server.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    server.load_system_host_keys()
-
-    # And then connect to the server.
-    # TODO: Only SSH support at the moment. Add Telnet support if needed.
-    server.connect(server_ip, username=server_uname, password=server_passw)
-    
-    if is_dl:    
-        if is_logging: # Set up the DL logs:
-            dl_client_log_path = test_config['logpath'] + os.path.sep + test_config['logname'] + '_dl_client.log'
-            dl_server_log_path = test_config['logpath'] + os.path.sep + test_config['logname'] + '_dl_server.log'
-            dl_client_log = open(dl_client_log_path, 'w', 1) # Open for writing and line-buffered
-            dl_server_log = open(dl_server_log_path, 'w', 1) # Open for writing and line-buffered
-            logging.debug('dl logs created')
-        if not is_logging: # Set logs to write to null device:
-            dl_client_log = open(os.devnull, 'w')
-            dl_server_log = open(os.devnull, 'w')
-        # Start the local server:
-        dl_server_log.write('\n-----------Executing command - ' + test_config['dl_server_str'] + '--------------\n\n')
-        dl_server_log.flush() # Have to flush to make sure the header line appears at the head!
-        dl_local_pid = subprocess.Popen \
-            (test_config['dl_server_str'],stdout=dl_server_log,stderr=subprocess.STDOUT,bufsize=0)
-        logging.debug('dl server started (local) with pid = ' + str(dl_local_pid.pid))
-        # And start the remote client:
-        dl_client_log.write('\n-----------Executing command - ' + test_config['dl_client_str'] + '--------------\n\n')
-        dl_client_log.flush() # Have to flush to make sure the header line appears at the head!
-        dl_client_input, dl_client_output, _ = server.exec_command(test_config['dl_client_str'])
-        logging.debug('dl client started (remote)')
-    if is_ul:
-        if is_logging: # Set up the DL logs:
-            ul_client_log_path = test_config['logpath'] + os.path.sep + test_config['logname'] + '_ul_client.log'
-            ul_server_log_path = test_config['logpath'] + os.path.sep + test_config['logname'] + '_ul_server.log'
-            ul_client_log = open(ul_client_log_path, 'w', 1) # Open for writing and line-buffered
-            ul_server_log = open(ul_server_log_path, 'w', 1) # Open for writing and line-buffered
-            logging.debug('ul logs created')
-        if not is_logging: # Set logs to write to null device:
-            ul_client_log = open(os.devnull, 'w')
-            ul_server_log = open(os.devnull, 'w')
-        # Start the remote server:
-        ul_server_log.write('\n-----------Executing command - ' + test_config['ul_server_str'] + '--------------\n\n')
-        ul_server_log.write('\n-----------NOTE: IF RUNNING UPLINK TCP TEST, VALUES MAY BE ZERO DUE TO SERVER PERMISSIONS--------------\n\n')
-        ul_server_log.flush() # Have to flush to make sure the header line appears at the head!
-        ul_server_input, ul_server_output, _ = server.exec_command(test_config['ul_server_str'])
-        logging.debug('ul server started (remote)')
-        # And start the local client:
-        ul_client_log.write('\n-----------Executing command - ' + test_config['ul_client_str'] + '--------------\n\n')
-        ul_client_log.flush() # Have to flush to make sure the header line appears at the head!
-        ul_local_pid = subprocess.Popen(test_config['ul_client_str'],stdout=ul_client_log,stderr=subprocess.STDOUT,bufsize=0)
-        logging.debug('ul client started (local) with pid = ' + str(ul_local_pid.pid))
-    
-    # Wait for duration of test but break if there is a keyboard interrupt detected in the main thread (interrupt event is set)
-    is_interrupted = interrupt.wait(test_config['duration'] + 3)
-    logging.debug('interrupt waiting ended with status ' + str(is_interrupted) + ' after ' + str(test_config['duration'] + 3) + ' seconds')
-
-    # If an interrupt is signalled from the main thread then kill the client processes early:
-    if is_interrupted and is_ul: ul_local_pid.kill() # Kill the UL client process
-    if is_interrupted and is_dl: server.exec_command(test_config['dl_client_kill_str']) # Kill the DL client process
-    
-    if is_ul:
-        # kill the UL server process using the kill string (nasty, but it works)
-        server.exec_command(test_config['ul_server_kill_str'])
-        logging.debug('UL Server process killed')
-        # and write the UL server log (no flush required as file closed next)
-        for line in ul_server_output: ul_server_log.write(line)
-        logging.debug('UL Server Log finished writing')
-    if is_dl:
-        # kill the DL server process
-        dl_local_pid.terminate()
-        logging.debug('Local DL server process killed')    
-        # and write the DL client log (no flush required as file closed next)
-        for line in dl_client_output: dl_client_log.write(line)
-        logging.debug('DL Client Log finished writing')
-        
-    # Kill the SSH connection
-    server.close()
-    logging.debug('Server closed')
-    # if interrupt then write a final note to the logs:   
-    if is_interrupted and is_dl: dl_server_log.write('\nProcess Interrupted by User.\n')
-    if is_interrupted and is_dl: dl_client_log.write('\nProcess Interrupted by User.\n')
-    if is_interrupted and is_ul: ul_client_log.write('\nProcess Interrupted by User.\n')
-    if is_interrupted and is_ul: ul_server_log.write('\nProcess Interrupted by User.\n')
-    # and close the files before you go!
-    if is_ul: ul_client_log.close()
-    if is_ul: ul_server_log.close()
-    if is_dl: dl_client_log.close()
-    if is_dl: dl_server_log.close()
-    logging.debug('Log files closed')
-#} End method run_ue_test
\ No newline at end of file
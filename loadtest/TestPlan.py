@@ -0,0 +1,235 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.TestPlan checks the whole of a test config before anything is started, and keeps the compiled plan (the
+test_config of every phase, with its iperf command lines and ports) in a cache file next to the config, so that running
+the same config again doesn't need it all working out again.
+
+TestPlan.py implements the TestPlan class and methods, as well as the get_phase_numbers() and get_profiles() functions.
+'''
+
+import os
+import json
+import hashlib
+import logging
+
+from loadtest.RateProfile import parse_profile
+from loadtest.IntervalParser import parse_size
+
+# Bump this whenever the test_config dicts change, so that older cached plans aren't used:
+PLAN_VERSION = 2
+REQUIRED_ITEMS = ('adaptername', 'testtype', 'traffictype', 'ftpserver')
+
+
+class TestPlan(object): #{
+    '''
+    class TestPlan(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __config_file = Path of the config file
+        __ue_configs = List of the UE config dicts (see TestConfig.get_full_ue_configs)
+        __env = SysEnvironment the adapter names are checked against and the UE addresses come from
+        __cache_path = Path of the cache file, the config file's path + '.plan'
+
+    Overview:
+    validate() goes through every UE config and collects everything wrong with them (missing or malformed items, adapters
+    this machine doesn't have, the same adapter used twice etc.), and raises one ValueError listing the lot, so that a
+    64 UE config is fixed in one go rather than one error per launch, and always before any traffic is sent.
+    The cache is keyed by the SHA-1 of the config file, the addresses of the UE adapters (which are in the iperf command
+    lines) and PLAN_VERSION. If it matches, load() returns the phase specs and port assignments of the last run with the
+    same config. The ports still have to be checked, as something else could be using them now (see
+    PortAllocator.restore). Anything that goes wrong reading or writing the cache just means the plan is compiled again.
+
+    Public methods:
+    get_ue_specs(self):
+    Returns a list of (ue_config, is_dl, is_ul) tuples, one per UE, in config order.
+
+    validate(self):
+    Raises a ValueError listing every problem with the UE configs, if there are any.
+
+    load(self):
+    Returns the cached plan, a dict of 'phase_specs' (list of (test_config, is_dl, is_ul) tuples) and 'ports' (the
+    PortAllocator assignments), or None if there is no cached plan for this config.
+
+    save(self, phase_specs, ports):
+    Writes the plan to the cache.
+
+    '''
+
+    def __init__(self, config_file, ue_configs, env): #{
+        '''
+        Constructor:
+            config_file = path of the config file
+            ue_configs = list of UE config dicts from TestConfig
+            env = SysEnvironment instance
+        '''
+        self.__config_file = config_file
+        self.__ue_configs = ue_configs
+        self.__env = env
+        self.__cache_path = config_file + '.plan'
+    #} End method __init__
+
+    def get_ue_specs(self): #{
+        ue_specs = []
+        for ue_config in self.__ue_configs:
+            # Convenience booleans for test_config and UEPhase
+            is_dl = ue_config.get('testtype') in ('DL', 'SIM')
+            is_ul = ue_config.get('testtype') in ('UL', 'SIM')
+            ue_specs.append((ue_config, is_dl, is_ul))
+        return ue_specs
+    #} End method get_ue_specs
+
+    def validate(self): #{
+        errors = []
+        names = set()
+        for ue_config, is_dl, is_ul in self.get_ue_specs():
+            name = ue_config.get('adaptername', '(no adapterName)')
+            missing = [item for item in REQUIRED_ITEMS if item not in ue_config]
+            if missing:
+                errors.append(name + ': missing ' + ', '.join(missing))
+                continue
+            if name in names: errors.append(name + ': the adapter is used by more than one UE')
+            names.add(name)
+            if self.__env.get_addr_of(name) == 'Invalid Argument':
+                errors.append(name + ': there is no adapter of that name with an IPv4 address on this machine')
+            if ue_config['testtype'] not in ('DL', 'UL', 'SIM'):
+                errors.append(name + ': testType must be DL, UL or SIM, not ' + str(ue_config['testtype']))
+            if ue_config['traffictype'] not in ('UDP', 'TCP'):
+                errors.append(name + ': trafficType must be UDP or TCP, not ' + str(ue_config['traffictype']))
+                continue
+            ftpserver = ue_config['ftpserver']
+            if not isinstance(ftpserver, list) or len(ftpserver) not in (3, 4) or \
+                    (len(ftpserver) == 4 and not ftpserver[3].strip().isdigit()):
+                errors.append(name + ': ftpServer must be IP address, username, password (and optionally the SSH port)')
+            if ue_config.get('engine', 'iperf') not in ('iperf', 'native'):
+                errors.append(name + ': engine must be iperf or native, not ' + str(ue_config['engine']))
+            if ue_config.get('tcptuning', 'off') not in ('off', 'auto'):
+                errors.append(name + ': tcpTuning must be off or auto, not ' + str(ue_config['tcptuning']))
+            for direction in ('DL', 'UL'):
+                window = ue_config.get('tcp' + direction.lower() + 'window', '8M')
+                streams = ue_config.get('tcp' + direction.lower() + 'streams', '1')
+                try:
+                    if parse_size(window) <= 0: raise ValueError(window)
+                except ValueError:
+                    errors.append(name + ': tcp' + direction + 'Window must be an iperf size, e.g. 512K, not ' + window)
+                if not streams.strip().isdigit() or int(streams) < 1:
+                    errors.append(name + ': tcp' + direction + 'Streams must be a number of streams, not ' + streams)
+            try:
+                if get_profiles(ue_config, is_dl, is_ul): continue
+            except ValueError, e:
+                errors.append(str(e) if str(e).startswith(name) else name + ': ' + str(e))
+                continue
+            errors.extend([name + ': ' + error for error in self.__check_timings(ue_config, is_dl, is_ul)])
+        if errors:
+            raise ValueError('The test config ' + self.__config_file + ' has ' + str(len(errors)) + ' problem(s):\n  ' +
+                             '\n  '.join(errors))
+    #} End method validate
+
+    def load(self): #{
+        if not os.path.exists(self.__cache_path): return None
+        try:
+            cache_file = open(self.__cache_path)
+            plan = to_str(json.load(cache_file))
+            cache_file.close()
+        except (IOError, ValueError), e:
+            logging.warning('Could not read the cached test plan ' + self.__cache_path + ': ' + str(e))
+            return None
+        if plan.get('key') != self.__get_key(): return None
+        return {'phase_specs': [tuple(phase_spec) for phase_spec in plan['phase_specs']], 'ports': plan['ports']}
+    #} End method load
+
+    def save(self, phase_specs, ports): #{
+        try:
+            cache_file = open(self.__cache_path, 'w')
+            json.dump({'key': self.__get_key(), 'phase_specs': phase_specs, 'ports': ports}, cache_file)
+            cache_file.close()
+        except IOError, e:
+            logging.warning('Could not write the test plan cache ' + self.__cache_path + ': ' + str(e))
+    #} End method save
+
+    def __get_key(self): #{
+        config_file = open(self.__config_file, 'rb')
+        key = hashlib.sha1(config_file.read())
+        config_file.close()
+        key.update(str(PLAN_VERSION))
+        for ue_config in self.__ue_configs:
+            name = ue_config.get('adaptername', '')
+            key.update('\n' + name + '=' + str(self.__env.get_addr_of(name)))
+        return key.hexdigest()
+    #} End method __get_key
+
+    def __check_timings(self, ue_config, is_dl, is_ul): #{
+        # Returns the problems with the t0/t1/t2 items, and with the throughputs and lengths of each phase:
+        errors = []
+        phases = get_phase_numbers(ue_config)
+        timings = {}
+        for item in ['t0', 't1'] + (['t2'] if 1 in phases else []):
+            try:
+                timings[item] = int(ue_config[item])
+            except KeyError:
+                errors.append('missing ' + item)
+            except ValueError:
+                errors.append(item + ' must be a whole number of seconds, not ' + str(ue_config[item]))
+        if 't1' in timings and timings['t1'] <= 0: errors.append('t1 must be more than 0')
+        if 't1' in timings and 't2' in timings and timings['t2'] <= timings['t1']: errors.append('t2 must be after t1')
+        if ue_config['traffictype'] != 'UDP': return errors
+        for phase in phases:
+            for direction, is_used in (('dl', is_dl), ('ul', is_ul)):
+                if not is_used: continue
+                for item in ('t' + str(phase) + direction + 'throughput', 't' + str(phase) + direction + 'len'):
+                    if item not in ue_config:
+                        errors.append('missing ' + item)
+                        continue
+                    try:
+                        parse_size(ue_config[item])
+                    except ValueError:
+                        errors.append(item + ' is not a valid iperf size: ' + str(ue_config[item]))
+        return errors
+    #} End method __check_timings
+#} End class TestPlan
+
+
+def get_phase_numbers(ue_config): #{
+    '''
+    Returns the list of phase numbers of a UE: phases 0 and 1 for a UDP test, only phase 0 for a TCP test, or for a rate
+    profile (which runs as one phase however many steps it has)
+    '''
+    if ue_config['traffictype'] != 'UDP' or 'dlprofile' in ue_config or 'ulprofile' in ue_config: return [0]
+    return [0, 1]
+#} End method get_phase_numbers
+
+
+def get_profiles(ue_config, is_dl, is_ul): #{
+    '''
+    Returns a dictionary of 'dl' and/or 'ul' to the RateProfile of that direction, empty if the UE has no profiles
+    '''
+    profiles = {}
+    is_ramp = ue_config.get('profilemode', 'step') == 'ramp'
+    for direction, is_used in (('dl', is_dl), ('ul', is_ul)):
+        if is_used and direction + 'profile' in ue_config:
+            profiles[direction] = parse_profile(ue_config[direction + 'profile'], is_ramp)
+    if not profiles: return profiles
+    name = ue_config['adaptername']
+    if ue_config['traffictype'] != 'UDP':
+        raise ValueError(name + ': rate profiles are only supported for UDP tests')
+    if len(profiles) != int(is_dl) + int(is_ul):
+        raise ValueError(name + ': a SIM test with a rate profile needs one for both DL and UL')
+    if len(set([(profile.get_start(), profile.get_duration()) for profile in profiles.values()])) > 1:
+        raise ValueError(name + ': the DL and UL rate profiles must start and end at the same times')
+    return profiles
+#} End method get_profiles
+
+
+def to_str(value): #{
+    '''
+    Converts the unicode strings json.load returns back to str, all the way down
+    '''
+    if isinstance(value, unicode): return str(value)
+    if isinstance(value, list): return [to_str(item) for item in value]
+    if isinstance(value, dict): return dict([(to_str(key), to_str(item)) for key, item in value.items()])
+    return value
+#} End method to_str
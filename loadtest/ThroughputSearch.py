@@ -0,0 +1,469 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.ThroughputSearch finds the highest UDP rate each UE can sustain, in DL and/or UL as its testType says, rather
+than the t0/t1 throughputs being guessed and the test run again and again until the modem's saturation point is found.
+It is run with TestLauncher.py --search <config file>.
+
+ThroughputSearch.py implements the ThroughputSearch and RateSearch classes and methods.
+'''
+
+import os
+import logging
+from datetime import datetime
+from threading import Thread, Event
+
+from loadtest.TestConfig import TestConfig
+from loadtest.SSHPool import SSHPool
+from loadtest.RemoteProcesses import RemoteProcesses
+from loadtest.StreamCapture import StreamCapture
+from loadtest.ThroughputSeries import SeriesStore
+from loadtest.IntervalParser import IntervalParser, parse_size
+from loadtest.PortAllocator import PortAllocator
+from loadtest.TestPlan import TestPlan
+from loadtest.UEPhase import spawn_local
+from loadtest.RunEngine import monotonic
+from loadtest import Tracing
+
+# A UE that can't carry this many bits/s at any length is taken to carry nothing:
+SEARCH_FLOOR = 64000.0
+# Seconds to wait for the server's report of a trial once its client has exited, and for the server to start listening:
+REPORT_TIMEOUT = 3.0
+LISTEN_TIMEOUT = 10.0
+# Factor the rate is raised by after a passing trial, for the first length and for the lengths after it (which start
+# from the best rate found so far, so are probably close already):
+FIRST_STEP = 2.0
+NEXT_STEP = 1.25
+# Columns of the trial history and results files:
+HISTORY_FIELDS = ('ue', 'direction', 'trial', 'length', 'offered_kbps', 'received_kbps', 'lost', 'total', 'loss_pct',
+                  'passed')
+RESULT_FIELDS = ('ue', 'direction', 'length', 'offered_kbps', 'received_kbps', 'loss_pct', 'trials')
+
+
+class RateSearch(object): #{
+    '''
+    class RateSearch(object):
+    Sub-class of:                    object
+    Public instance variables:
+        name = Name of the search for debug purposes, e.g. 'UE1-DL'
+    Private instance variables:
+        __remote = RemoteProcesses the remote iperfs are started and killed through
+        __capture = StreamCapture the logs and the iperf output go through
+        __series = ThroughputSeries the server's reports are parsed into
+        __ue_config = UE config dict from TestConfig
+        __ue_ip = Address of the UE
+        __direction = 'DL' or 'UL'
+        __port = Port of the iperf server
+        __settings = Globals dict, for the search settings
+        __stop = threading.Event set to stop the search
+        __lengths = Packet lengths to search with
+        __client_str = iperf client command line, with %(time)s, %(rate)s and %(length)s left to fill in per trial
+        __server = The local server Popen or NativeStream (DL), or the stdout of the remote server's channel (UL)
+        __server_handle = RemoteProcesses handle of the remote server (UL only)
+        __parser = IntervalParser of the server's output
+        __listening = threading.Event set once the server has said it is listening
+        __client_log, __server_log = Log files of the clients and the server
+        __readers = Capture reader threads of the server and of the client running
+        __history = List of dicts of every trial, with the HISTORY_FIELDS
+        __result = Dict of the RESULT_FIELDS of the best length (None until a trial has passed)
+
+    Overview:
+    One direction of one UE. The server (local for DL, on the test server for UL) is started once and stays up for the
+    whole search, and only the client is run again for each trial, through the same SSH connection (or process agent)
+    for DL, and locally for UL. The server's report of each trial, which it prints when the client finishes, gives the
+    loss. If the report gets lost (e.g. the client's final datagram never arrives), the trial's interval reports are
+    used instead.
+    For each packet length, the rate starts from the UE's t0 throughput and is doubled after every trial that passes (its
+    loss is no more than the Globals 'searchloss'), up to 'searchmax'. Once a trial has failed, the rate is bisected
+    between the highest rate that passed and the lowest that failed, until they are within 'searchprecision' percent of
+    each other. So a rate is found to within 5% in 5 to 8 trials where the starting guess is within a factor of 4.
+    Each length after the first starts from the best rate found so far, and is raised by a quarter at a time rather than
+    doubled. The result is that of the length with the highest received throughput.
+
+    Public methods:
+    start(self):
+    Opens the logs and starts the server.
+
+    run(self):
+    Thread target: runs the trials until the search has finished or been stopped.
+
+    stop(self):
+    Kills the server (and any client still running) and closes the logs.
+
+    get_history(self):
+    Returns the list of trial dicts.
+
+    get_result(self):
+    Returns the result dict, or None if no trial passed.
+
+    '''
+
+    def __init__(self, remote, capture, series, ue_config, ue_ip, direction, port, settings, stop, log_prefix): #{
+        '''
+        Constructor:
+            remote = RemoteProcesses for the test servers
+            capture = StreamCapture for the logs
+            series = ThroughputSeries to parse the server's reports into
+            ue_config = UE config dict
+            ue_ip = address of the UE
+            direction = 'DL' or 'UL'
+            port = port of the iperf server
+            settings = Globals dict
+            stop = threading.Event set to stop the search
+            log_prefix = path and name prefix of the log files, None to not keep logs
+        '''
+        self.name = ue_config['adaptername'] + '-' + direction
+        self.__remote = remote
+        self.__capture = capture
+        self.__series = series
+        self.__ue_config = ue_config
+        self.__ue_ip = ue_ip
+        self.__direction = direction
+        self.__port = port
+        self.__settings = settings
+        self.__stop = stop
+        self.__lengths = settings['searchlengths'] or [ue_config['t0' + direction.lower() + 'len']]
+        self.__client_str = None
+        self.__server = None
+        self.__server_handle = None
+        self.__parser = IntervalParser(series, is_chained=True)
+        self.__listening = Event()
+        self.__client_log = capture.open_log(log_prefix + '_client.log' if log_prefix else os.devnull)
+        self.__server_log = capture.open_log(log_prefix + '_server.log' if log_prefix else os.devnull)
+        self.__readers = []
+        self.__history = []
+        self.__result = None
+    #} End method __init__
+
+    def start(self): #{
+        ue_config = self.__ue_config
+        port = str(self.__port)
+        # The server has to take the longest of the lengths:
+        max_length = str(int(max([parse_size(length) for length in self.__lengths])))
+        local_iperf = 'native' if ue_config.get('engine', self.__settings['engine']) == 'native' else 'iperf'
+        if self.__direction == 'DL':
+            server_str = local_iperf + ' -s -p ' + port + ' -B ' + self.__ue_ip + ' -l ' + max_length + \
+                ' -u -U -i 1 -P 0 -f k -w 8M'
+            self.__client_str = 'iperf -p ' + port + ' -c ' + self.__ue_ip + ' -t %(time)s -b %(rate)s' + \
+                ' -l %(length)s -B ' + ue_config['ftpserver'][0] + ' -u -i 1 -P 1 -f k -w 8M'
+        else:
+            server_str = 'iperf -s -p ' + port + ' -l ' + max_length + ' -u -U -i 1 -P 0 -f k -w 8M'
+            self.__client_str = local_iperf + ' -B ' + self.__ue_ip + ' -c ' + ue_config['ftpserver'][0] + \
+                ' -t %(time)s -b %(rate)s -p ' + port + ' -l %(length)s -u -i 1 -P 1 -f k -w 8M'
+        self.__capture.write(self.__server_log, '\n-----------Executing command - ' + server_str + '--------------\n\n')
+        if self.__direction == 'DL':
+            self.__server = spawn_local(server_str)
+            source = self.__server.stdout
+        else:
+            self.__server_handle, self.__server = self.__remote.start(ue_config['ftpserver'], self.name + '_server',
+                                                                      server_str)
+            source = self.__server
+        self.__readers.append(self.__capture.attach(source, self.__server_log, self.__on_server_output))
+        logging.debug(self.name + ': search server started')
+    #} End method start
+
+    def run(self): #{
+        settings = self.__settings
+        rate = parse_size(self.__ue_config.get('t0' + self.__direction.lower() + 'throughput', '1M')) or 1e6
+        results = []
+        # A remote server is started over SSH, so it may not be listening yet, and the first trial would lose packets:
+        if not self.__listening.wait(LISTEN_TIMEOUT):
+            logging.debug(self.name + ': the search server has not said it is listening, starting anyway')
+        for length in self.__lengths:
+            if self.__stop.is_set(): break
+            step = NEXT_STEP if results else FIRST_STEP
+            best = self.__search(min(rate, parse_size(settings['searchmax'])), length, step)
+            if best is None: continue
+            rate = best['offered_kbps'] * 1000
+            results.append({'ue': self.__ue_config['adaptername'], 'direction': self.__direction, 'length': length,
+                            'offered_kbps': best['offered_kbps'], 'received_kbps': best['received_kbps'],
+                            'loss_pct': best['loss_pct']})
+        if results:
+            self.__result = max(results, key=lambda result: result['received_kbps'])
+            self.__result['trials'] = len(self.__history)
+            logging.warning(self.name + ': sustains ' + str(int(self.__result['received_kbps'])) + ' Kbits/sec with ' +
+                            self.__result['length'] + ' packets')
+        else:
+            logging.warning(self.name + ': no trial passed')
+    #} End method run
+
+    def stop(self): #{
+        if self.__server_handle is not None:
+            self.__remote.kill(self.__ue_config['ftpserver'], [self.__server_handle])
+            self.__remote.flush()
+        elif self.__server is not None and self.__server.poll() is None:
+            self.__server.terminate()
+        for reader in self.__readers: reader.join(5)
+        if self.__server_handle is not None: self.__server.channel.close()
+        for reader in self.__readers: reader.join()
+        for log in (self.__client_log, self.__server_log):
+            if self.__stop.is_set(): self.__capture.write(log, '\nProcess Interrupted by User.\n')
+            self.__capture.close_log(log)
+        logging.debug(self.name + ': search server stopped')
+    #} End method stop
+
+    def get_history(self): #{
+        return self.__history
+    #} End method get_history
+
+    def get_result(self): #{
+        return self.__result
+    #} End method get_result
+
+    def __on_server_output(self, data): #{
+        # Each trial's client starts the server's report times from 0 again, as in a DL rate profile, hence is_chained:
+        self.__parser.feed(data)
+        if 'listening' in data: self.__listening.set()
+    #} End method __on_server_output
+
+    def __search(self, rate, length, step): #{
+        # Returns the trial dict of the highest rate that passed, or None if none did:
+        max_rate = parse_size(self.__settings['searchmax'])
+        precision = self.__settings['searchprecision'] / 100.0
+        passed, failed, best = 0.0, None, None
+        while not self.__stop.is_set():
+            trial = self.__trial(rate, length)
+            if trial is None: break
+            if trial['passed']:
+                passed, best = rate, trial
+            else:
+                failed = rate
+            if failed is None: # Still looking for a rate that fails
+                if rate >= max_rate: break
+                rate = min(rate * step, max_rate)
+            elif failed < SEARCH_FLOOR or failed - passed <= failed * precision:
+                break
+            else:
+                rate = (passed + failed) / 2
+        return best
+    #} End method __search
+
+    def __trial(self, rate, length): #{
+        # Runs one trial, and returns its dict (None if the search was stopped part way through):
+        if self.__server.channel.exit_status_ready() if self.__server_handle is not None else \
+                self.__server.poll() is not None:
+            logging.warning(self.name + ': the search server has exited, see its log')
+            return None
+        series = self.__series
+        rows, reports = len(series), len(series.summary_records)
+        client_str = self.__client_str % {'time': self.__settings['searchtrial'], 'rate': int(rate), 'length': length}
+        self.__capture.write(self.__client_log, '\n-----------Executing command - ' + client_str + '--------------\n\n')
+        if self.__direction == 'DL':
+            handle, client = self.__remote.start(self.__ue_config['ftpserver'], self.name + '_client', client_str)
+            is_running = lambda: not client.channel.exit_status_ready()
+        else:
+            handle, client = None, spawn_local(client_str)
+            is_running = lambda: client.poll() is None
+        reader = self.__capture.attach(client if handle is not None else client.stdout, self.__client_log)
+        while is_running() and not self.__stop.is_set():
+            self.__stop.wait(0.1)
+        if self.__stop.is_set():
+            if handle is not None:
+                self.__remote.kill(self.__ue_config['ftpserver'], [handle])
+            elif client.poll() is None:
+                client.kill()
+        reader.join(5)
+        if handle is not None: client.channel.close()
+        reader.join()
+        if self.__stop.is_set(): return None
+
+        # The server prints its report of the trial as soon as the client's final datagram arrives:
+        deadline = monotonic() + REPORT_TIMEOUT
+        while len(series.summary_records) == reports and monotonic() < deadline:
+            self.__stop.wait(0.1)
+        if len(series.summary_records) > reports:
+            _, _, _, kbps, _, lost, total, _ = series.summary_records[reports]
+        else:
+            logging.debug(self.name + ': no server report for the trial, using its interval reports')
+            kbps = sum(series.columns['kbps'][rows:]) / max(len(series) - rows, 1)
+            lost = sum([value for value in series.columns['lost'][rows:] if value >= 0])
+            total = sum([value for value in series.columns['total'][rows:] if value >= 0])
+        loss_pct = 100.0 * max(lost, 0) / total if total > 0 else 100.0
+        trial = {'ue': self.__ue_config['adaptername'], 'direction': self.__direction, 'trial': len(self.__history) + 1,
+                 'length': length, 'offered_kbps': rate / 1000.0, 'received_kbps': kbps, 'lost': lost, 'total': total,
+                 'loss_pct': loss_pct, 'passed': int(loss_pct <= self.__settings['searchloss'])}
+        self.__history.append(trial)
+        logging.debug(self.name + ': trial ' + str(trial['trial']) + ' at ' + str(int(rate)) + ' bits/sec: ' +
+                      '%.2f%% loss' % loss_pct)
+        return trial
+    #} End method __trial
+#} End class RateSearch
+
+
+class ThroughputSearch(object): #{
+    '''
+    class ThroughputSearch(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __config_file = Path of the config file
+        __ue_configs = UE config dicts from the TestConfig
+        __globals = Globals dict from the TestConfig
+        __env = SysEnvironment the UE addresses come from
+        __stop = threading.Event set to stop the search (Ctrl-C)
+        __pool = SSHPool holding one SSH connection per test server, for the whole search
+        __remote = RemoteProcesses starting and killing the remote iperfs through the __pool
+        __capture = StreamCapture for the logs and the iperf output
+        __series = SeriesStore holding the parsed server reports
+        __ports = PortAllocator holding the iperf server port of every UE and direction
+        __searches = List of the RateSearch of every UE and direction
+
+    Overview:
+    The config is checked as for a test (see TestPlan.py), and only its UDP UEs are searched. Every UE and direction is
+    searched at the same time, each by its own RateSearch on its own thread, so the whole search takes about as long as
+    the slowest UE's. A SIM UE has its DL and UL searched together, as they would be run in a test.
+    With logging, the server and client logs of each UE and direction, search_history.csv (every trial) and
+    search_results.csv (the best rate of each UE and direction) are written to a ThroughputSearch_<date> directory in
+    the log directory.
+    With tracing on, the stages of the search are traced, and the trace is written to trace.json with the logs (or to a
+    ThroughputSearchTrace_<date>.json file in the log directory, without logging).
+    The 'workers' and 'agents' Globals items don't apply to a search, which always runs in this process.
+
+    Public methods:
+    run(self):
+    Runs the search. Returns True if it ran to completion and False if it was interrupted.
+
+    get_results(self):
+    Returns the result dicts (see RateSearch.get_result) of every UE and direction that had a trial pass.
+
+    get_report(self):
+    Returns a table of the results, for printing.
+
+    '''
+
+    def __init__(self, config_file, env): #{
+        '''
+        Constructor:
+            config_file = path of the config file
+            env = SysEnvironment instance
+        '''
+        with Tracing.span('config.parse', config=config_file):
+            config = TestConfig(config_file)
+        self.__config_file = config_file
+        self.__ue_configs = config.get_full_ue_configs()
+        self.__globals = config.get_globals()
+        self.__env = env
+        self.__stop = Event()
+        self.__pool = SSHPool()
+        self.__remote = RemoteProcesses(self.__pool)
+        self.__capture = StreamCapture(compression=self.__globals['logcompress'])
+        self.__series = SeriesStore()
+        self.__ports = PortAllocator(self.__pool)
+        self.__searches = []
+    #} End method __init__
+
+    def run(self): #{
+        settings = self.__globals
+        plan = TestPlan(self.__config_file, self.__ue_configs, self.__env)
+        plan.validate()
+        ue_specs = []
+        for ue_config, is_dl, is_ul in plan.get_ue_specs():
+            if ue_config['traffictype'] != 'UDP':
+                logging.warning(ue_config['adaptername'] + ': only UDP UEs can be searched, skipped')
+                continue
+            ue_specs.append((ue_config, is_dl, is_ul))
+        if settings['workers'] or settings['agents']:
+            logging.warning('The search always runs in this process, workers and agents ignored')
+
+        # The servers stay up for the whole search, so each UE and direction needs only one port:
+        for ue_config, is_dl, is_ul in ue_specs:
+            if is_dl: self.__ports.request((ue_config['adaptername'], 'search', 'DL'), 'local')
+            if is_ul: self.__ports.request((ue_config['adaptername'], 'search', 'UL'), ue_config['ftpserver'])
+        self.__ports.allocate()
+
+        logdir = None
+        if settings['logging']:
+            if not os.path.exists(settings['logdir']): os.mkdir(settings['logdir'])
+            logdir = os.path.join(settings['logdir'], 'ThroughputSearch_' + str(datetime.now().strftime('%d-%m-%Y_%H%M%S')))
+            os.mkdir(logdir)
+
+        ftpservers = [ue_config['ftpserver'] for ue_config, _, _ in ue_specs]
+        with Tracing.span('ssh.warm'):
+            self.__pool.warm(ftpservers)
+        with Tracing.span('remote.sweep'):
+            self.__remote.sweep(ftpservers)
+        if settings['serveragent']:
+            with Tracing.span('agents.start'):
+                self.__remote.start_agents(ftpservers)
+        self.__capture.start()
+        for ue_config, is_dl, is_ul in ue_specs:
+            name = ue_config['adaptername']
+            ue_ip = self.__env.get_addr_of(name)
+            for direction, is_used in (('DL', is_dl), ('UL', is_ul)):
+                if not is_used: continue
+                log_prefix = None
+                if logdir is not None:
+                    log_prefix = os.path.join(logdir, settings['logprefix'] + name + '_search_' + direction.lower())
+                self.__searches.append(RateSearch(self.__remote, self.__capture,
+                                                  self.__series.get_series(name, 0, direction, 'server'), ue_config,
+                                                  ue_ip, direction, self.__ports.get_port((name, 'search', direction)),
+                                                  settings, self.__stop, log_prefix))
+
+        threads = []
+        search_span = Tracing.span('search.run', searches=len(self.__searches))
+        try:
+            for search in self.__searches:
+                search.start()
+            for search in self.__searches:
+                t = Thread(target=search.run)
+                t.setName('search-' + search.name)
+                t.setDaemon(True)
+                threads.append(t)
+                t.start()
+            # Join with a timeout, so that Ctrl-C still reaches this thread:
+            while [t for t in threads if t.is_alive()]:
+                for t in threads: t.join(0.5)
+        except KeyboardInterrupt:
+            self.__stop.set()
+            logging.warning('Process interrupted by user.\n')
+            for t in threads: t.join()
+        finally:
+            search_span.end()
+            for search in self.__searches:
+                search.stop()
+            with Tracing.span('remote.teardown'):
+                self.__remote.teardown()
+            with Tracing.span('capture.stop'):
+                self.__capture.stop()
+            self.__pool.close_all()
+
+        if logdir is not None:
+            self.__write_csv(os.path.join(logdir, 'search_history.csv'), HISTORY_FIELDS,
+                             [trial for search in self.__searches for trial in search.get_history()])
+            self.__write_csv(os.path.join(logdir, 'search_results.csv'), RESULT_FIELDS, self.get_results())
+        if Tracing.is_enabled():
+            if logdir is not None:
+                trace_path = os.path.join(logdir, 'trace.json')
+            else:
+                if not os.path.exists(settings['logdir']): os.mkdir(settings['logdir'])
+                trace_path = os.path.join(settings['logdir'], 'ThroughputSearchTrace_' +
+                                          str(datetime.now().strftime('%d-%m-%Y_%H%M%S')) + '.json')
+            Tracing.write(trace_path)
+        return not self.__stop.is_set()
+    #} End method run
+
+    def get_results(self): #{
+        return [search.get_result() for search in self.__searches if search.get_result() is not None]
+    #} End method get_results
+
+    def get_report(self): #{
+        lines = ['%-12s %-4s %-8s %14s %14s %8s %7s' % ('UE', 'Dir', 'Length', 'Offered Kb/s', 'Received Kb/s',
+                                                          'Loss %', 'Trials')]
+        for result in self.get_results():
+            lines.append('%-12s %-4s %-8s %14.0f %14.0f %8.2f %7d' % (result['ue'], result['direction'], result['length'],
+                                                                      result['offered_kbps'], result['received_kbps'],
+                                                                      result['loss_pct'], result['trials']))
+        return '\n'.join(lines)
+    #} End method get_report
+
+    def __write_csv(self, path, fields, rows): #{
+        csv_file = open(path, 'w')
+        csv_file.write(','.join(fields) + '\n')
+        for row in rows:
+            csv_file.write(','.join([str(row[field]) for field in fields]) + '\n')
+        csv_file.close()
+    #} End method __write_csv
+#} End class ThroughputSearch
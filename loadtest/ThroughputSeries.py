@@ -0,0 +1,301 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.ThroughputSeries holds the per-second iperf interval reports of a test as compact typed columns, one series per
+UE, phase, direction and side (client or server), so that even very long tests with many UEs can be kept in memory and
+summarised as soon as the test ends.
+
+ThroughputSeries.py implements the ThroughputSeries and SeriesStore classes and methods.
+'''
+
+import math
+from array import array
+from threading import Lock
+
+from loadtest.IntervalParser import parse_size
+
+# NumPy is optional. If it's installed the columns are summarised through zero-copy NumPy views, otherwise in pure Python:
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ThroughputSeries(object): #{
+    '''
+    class ThroughputSeries(object):
+    Sub-class of:                    object
+    Public instance variables:
+        ue = Adapter name of the UE
+        phase = Test phase number (0 or 1)
+        direction = 'DL' or 'UL'
+        role = 'client' (sending side) or 'server' (receiving side)
+        columns = Dictionary of column name to array.array (see COLUMNS)
+        summary_records = List of the summary (whole test) report lines, as tuples in COLUMNS order
+        outages = List of (start, end) tuples, in seconds from the start of the phase, when the UE's interface was down
+            or had lost the address the test was bound to (see InterfaceWatcher.py)
+        start_skew = Seconds from the scheduled start of the phase to its client actually being started (None until it
+            has started)
+        busy = List of (start, end) tuples, in seconds from the start of the phase, when the test rig (this machine or
+            the test server) was saturated (see ResourceSampler.py)
+        tcp = Dictionary of the TCP settings the series was run with: window (iperf size), streams, and rtt (seconds,
+            None unless they were tuned, see TcpTuning.py). None for a UDP series.
+
+    Overview:
+    Each interval report is stored as one entry in each of the typed arrays in columns. Single precision floats and
+    32-bit integers are used throughout, so one record costs 30 bytes: a 3600 second run of 256 UEs with all four logs
+    parsed is well under 150MB.
+    Columns without a value for a given report (e.g. jitter for a TCP test) hold NaN, or -1 for the integer columns.
+    The stream column holds the iperf stream ID from the report ([  3] etc.), or -1 for the [SUM] lines of a multi-stream
+    test. The summary is of the [SUM] lines if there are any. If there are several streams but no [SUM] lines (as from
+    some iperf servers), the reports of the streams for each interval are added together instead.
+
+    Public methods:
+    append(self, start, end, kbytes, kbps, jitter, lost, total, stream):
+    Adds an interval report to the series.
+
+    append_summary(self, start, end, kbytes, kbps, jitter, lost, total, stream):
+    Adds a summary report to the series.
+
+    mark_outage(self, start, end):
+    Records an interface outage window, in seconds from the start of the phase.
+
+    mark_busy(self, start, end):
+    Records a window in which the test rig was saturated, in seconds from the start of the phase.
+
+    get_column(self, name):
+    Returns the named column, as a NumPy array if NumPy is installed, otherwise as the underlying array.array.
+
+    summary(self):
+    Returns a dict of summary statistics for the series (see SUMMARY_FIELDS).
+
+    aggregate(self):
+    Returns the (columns, rows) of the aggregate of all the streams, one row per interval: columns is a dictionary like
+    columns, and rows the list of the indexes of the aggregate reports in it.
+
+    '''
+
+    # Column names and their array type codes:
+    COLUMNS = (('start', 'f'), ('end', 'f'), ('kbytes', 'f'), ('kbps', 'f'), ('jitter', 'f'),
+               ('lost', 'i'), ('total', 'i'), ('stream', 'h'))
+    SUMMARY_FIELDS = ('samples', 'mean_kbps', 'min_kbps', 'max_kbps', 'p5_kbps', 'p50_kbps', 'p95_kbps',
+                      'total_kbytes', 'mean_jitter', 'lost', 'total', 'loss_pct', 'outage_secs', 'rig_busy_secs',
+                      'start_skew_ms', 'tcp_window_kbytes', 'tcp_streams', 'tcp_rtt_ms')
+
+    def __init__(self, ue, phase, direction, role): #{
+        '''
+        Constructor
+        '''
+        self.ue = ue
+        self.phase = phase
+        self.direction = direction
+        self.role = role
+        self.columns = {}
+        for name, typecode in self.COLUMNS:
+            self.columns[name] = array(typecode)
+        self.summary_records = []
+        self.outages = []
+        self.busy = []
+        self.start_skew = None
+        self.tcp = None
+    #} End method __init__
+
+    def __len__(self): #{
+        return len(self.columns['start'])
+    #} End method __len__
+
+    def append(self, start, end, kbytes, kbps, jitter, lost, total, stream): #{
+        columns = self.columns
+        columns['start'].append(start)
+        columns['end'].append(end)
+        columns['kbytes'].append(kbytes)
+        columns['kbps'].append(kbps)
+        columns['jitter'].append(jitter)
+        columns['lost'].append(lost)
+        columns['total'].append(total)
+        columns['stream'].append(stream)
+    #} End method append
+
+    def append_summary(self, start, end, kbytes, kbps, jitter, lost, total, stream): #{
+        self.summary_records.append((start, end, kbytes, kbps, jitter, lost, total, stream))
+    #} End method append_summary
+
+    def mark_outage(self, start, end): #{
+        self.outages.append((start, end))
+    #} End method mark_outage
+
+    def mark_busy(self, start, end): #{
+        self.busy.append((start, end))
+    #} End method mark_busy
+
+    def get_column(self, name): #{
+        if numpy is not None:
+            # frombuffer shares memory with the array, nothing is copied:
+            column = self.columns[name]
+            return numpy.frombuffer(column, dtype=column.typecode) if len(column) else numpy.zeros(0, column.typecode)
+        return self.columns[name]
+    #} End method get_column
+
+    def summary(self): #{
+        summary = dict.fromkeys(self.SUMMARY_FIELDS, float('nan'))
+        # The aggregate of all the streams, one row per interval:
+        columns, rows = self.aggregate()
+        summary['samples'] = len(rows)
+        summary['outage_secs'] = sum([end - start for start, end in self.outages])
+        if self.start_skew is not None: summary['start_skew_ms'] = self.start_skew * 1000.0
+        if self.tcp is not None:
+            summary['tcp_window_kbytes'] = parse_size(self.tcp['window']) / 1024
+            summary['tcp_streams'] = self.tcp['streams']
+            if self.tcp['rtt'] is not None: summary['tcp_rtt_ms'] = self.tcp['rtt'] * 1000.0
+        if not rows: return summary
+
+        # Only the part of each busy window that the reports cover:
+        first, last = min(columns['start']), max(columns['end'])
+        summary['rig_busy_secs'] = sum([max(0.0, min(end, last) - max(start, first)) for start, end in self.busy])
+        if numpy is not None:
+            index = numpy.array(rows, dtype=numpy.intp)
+            column = lambda name: numpy.frombuffer(columns[name], dtype=columns[name].typecode)[index]
+            kbps = column('kbps').astype(numpy.float64)
+            jitter = column('jitter')
+            jitter = jitter[~numpy.isnan(jitter)]
+            lost = column('lost')
+            total = column('total')
+            summary['mean_kbps'] = float(kbps.mean())
+            summary['min_kbps'] = float(kbps.min())
+            summary['max_kbps'] = float(kbps.max())
+            summary['p5_kbps'], summary['p50_kbps'], summary['p95_kbps'] = \
+                [float(p) for p in numpy.percentile(kbps, [5, 50, 95])]
+            summary['total_kbytes'] = float(column('kbytes').astype(numpy.float64).sum())
+            if len(jitter): summary['mean_jitter'] = float(jitter.mean())
+            summary['lost'] = int(lost[lost >= 0].sum())
+            summary['total'] = int(total[total >= 0].sum())
+        else:
+            kbps = sorted([columns['kbps'][i] for i in rows])
+            jitter = [columns['jitter'][i] for i in rows if not math.isnan(columns['jitter'][i])]
+            summary['mean_kbps'] = sum(kbps) / len(kbps)
+            summary['min_kbps'] = kbps[0]
+            summary['max_kbps'] = kbps[-1]
+            summary['p5_kbps'] = percentile(kbps, 5)
+            summary['p50_kbps'] = percentile(kbps, 50)
+            summary['p95_kbps'] = percentile(kbps, 95)
+            summary['total_kbytes'] = sum([columns['kbytes'][i] for i in rows])
+            if jitter: summary['mean_jitter'] = sum(jitter) / len(jitter)
+            summary['lost'] = sum([columns['lost'][i] for i in rows if columns['lost'][i] >= 0])
+            summary['total'] = sum([columns['total'][i] for i in rows if columns['total'][i] >= 0])
+        if summary['total'] > 0:
+            summary['loss_pct'] = 100.0 * summary['lost'] / summary['total']
+        return summary
+    #} End method summary
+
+    def aggregate(self): #{
+        # The [SUM] rows if there are any (multi-stream tests), every row if there is only one stream, otherwise the
+        # streams' reports of each interval added together:
+        streams = self.columns['stream']
+        if -1 in streams:
+            return self.columns, [i for i in xrange(len(streams)) if streams[i] == -1]
+        if len(set(streams)) < 2:
+            return self.columns, range(len(streams))
+        intervals = {}
+        for i in xrange(len(streams)):
+            key = (round(self.columns['start'][i], 1), round(self.columns['end'][i], 1))
+            intervals.setdefault(key, []).append(i)
+        columns = {}
+        for name, typecode in self.COLUMNS:
+            columns[name] = array(typecode)
+        for (start, end), rows in sorted(intervals.items()):
+            values = lambda name: [self.columns[name][i] for i in rows]
+            jitter = [value for value in values('jitter') if not math.isnan(value)]
+            lost = [value for value in values('lost') if value >= 0]
+            total = [value for value in values('total') if value >= 0]
+            columns['start'].append(start)
+            columns['end'].append(end)
+            columns['kbytes'].append(sum(values('kbytes')))
+            columns['kbps'].append(sum(values('kbps')))
+            columns['jitter'].append(sum(jitter) / len(jitter) if jitter else float('nan'))
+            columns['lost'].append(sum(lost) if lost else -1)
+            columns['total'].append(sum(total) if total else -1)
+            columns['stream'].append(-1)
+        return columns, range(len(columns['stream']))
+    #} End method aggregate
+#} End class ThroughputSeries
+
+
+class SeriesStore(object): #{
+    '''
+    class SeriesStore(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __series = Dictionary of (ue, phase, direction, role) keys to ThroughputSeries objects
+        __lock = threading.Lock guarding __series, as the series are created from the capture threads
+
+    Overview:
+    The SeriesStore holds all the ThroughputSeries of a test run.
+
+    Public methods:
+    get_series(self, ue, phase, direction, role):
+    Returns the series for the given key, creating it if it doesn't exist yet.
+
+    get_all_series(self):
+    Returns a list of all the series, sorted by key.
+
+    add_series(self, series):
+    Adds an existing series to the store (e.g. one collected from a worker process), replacing any with the same key.
+
+    write_summary(self, path):
+    Writes a comma-separated table with one line of summary statistics per series to path.
+
+    '''
+
+    def __init__(self): #{
+        '''
+        Constructor
+        '''
+        self.__series = {}
+        self.__lock = Lock()
+    #} End method __init__
+
+    def get_series(self, ue, phase, direction, role): #{
+        key = (ue, phase, direction, role)
+        with self.__lock:
+            if key not in self.__series:
+                self.__series[key] = ThroughputSeries(ue, phase, direction, role)
+            return self.__series[key]
+    #} End method get_series
+
+    def add_series(self, series): #{
+        with self.__lock:
+            self.__series[(series.ue, series.phase, series.direction, series.role)] = series
+    #} End method add_series
+
+    def get_all_series(self): #{
+        with self.__lock:
+            return [self.__series[key] for key in sorted(self.__series.keys())]
+    #} End method get_all_series
+
+    def write_summary(self, path): #{
+        summary_file = open(path, 'w')
+        summary_file.write(','.join(('ue', 'phase', 'direction', 'role') + ThroughputSeries.SUMMARY_FIELDS) + '\n')
+        for series in self.get_all_series():
+            summary = series.summary()
+            values = [series.ue, str(series.phase), series.direction, series.role]
+            values.extend([str(summary[field]) for field in ThroughputSeries.SUMMARY_FIELDS])
+            summary_file.write(','.join(values) + '\n')
+        summary_file.close()
+    #} End method write_summary
+#} End class SeriesStore
+
+
+def percentile(sorted_values, pct): #{
+    '''
+    Linear-interpolated percentile (same method as numpy.percentile) of an already sorted list
+    '''
+    if not sorted_values: return float('nan')
+    rank = (len(sorted_values) - 1) * pct / 100.0
+    lower = int(math.floor(rank))
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+#} End method percentile
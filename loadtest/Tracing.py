@@ -0,0 +1,250 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.Tracing records how long each stage of a run takes (config parse, interface enumeration, SSH connect, remote
+exec, local start, first report, kill, log close etc.), tagged with the UE and phase, and writes them out in the Chrome
+trace format, which chrome://tracing and https://ui.perfetto.dev open as a timeline. It is switched on with
+TestLauncher.py --trace.
+When tracing is off, span() returns a shared do-nothing span (and instant() returns) straight away, so the stages cost
+no more than a function call and a global lookup each.
+
+Tracing.py implements the Tracer, Span and NullSpan classes and methods, as well as the module functions that the rest
+of the load test calls (enable(), is_enabled(), span(), instant(), get_events(), add_events() and write()).
+'''
+
+import os
+import json
+import time
+import multiprocessing
+from threading import Lock, currentThread
+
+from loadtest.RunEngine import monotonic
+
+# The tracer of this process, None while tracing is off:
+tracer = None
+
+
+class Tracer(object): #{
+    '''
+    class Tracer(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __offset = Seconds to add to monotonic() to get the wall clock time at which tracing was enabled, so that the
+            traces of several processes (workers) line up
+        __pid = ID of this process
+        __lock = threading.Lock guarding __events and __tracks
+        __events = List of the Chrome trace events recorded so far
+        __tracks = Dictionary of track name to track (Chrome trace thread) ID
+
+    Overview:
+    Every span is recorded as a Chrome trace 'complete' event (ph 'X'), and every instant as a ph 'i' event, with the
+    span's tags as its args. A span tagged with a UE goes on that UE's track ('UE1 phase 0' etc.), so that the stages
+    of each UE and phase line up in their own row. Any other span goes on the track of the thread that recorded it.
+    The tracks are named with Chrome trace metadata events.
+
+    Public methods:
+    now(self):
+    Returns the current trace time, in microseconds.
+
+    add(self, name, start, end, tags):
+    Records a span from start to end (trace times), or an instant if end is None.
+
+    get_events(self):
+    Returns a copy of the events recorded so far.
+
+    add_events(self, events):
+    Adds events recorded by another process (e.g. a worker).
+
+    '''
+
+    def __init__(self): #{
+        '''
+        Constructor
+        '''
+        self.__offset = time.time() - monotonic()
+        self.__pid = os.getpid()
+        self.__lock = Lock()
+        self.__events = [{'name': 'process_name', 'ph': 'M', 'pid': self.__pid, 'tid': 0,
+                          'args': {'name': multiprocessing.current_process().name}}]
+        self.__tracks = {}
+    #} End method __init__
+
+    def now(self): #{
+        return (monotonic() + self.__offset) * 1e6
+    #} End method now
+
+    def add(self, name, start, end, tags): #{
+        if 'ue' in tags:
+            track_name = tags['ue'] + (' phase ' + str(tags['phase']) if 'phase' in tags else '')
+        else:
+            track_name = currentThread().getName()
+        event = {'name': name, 'cat': name.split('.')[0], 'pid': self.__pid, 'ts': start, 'args': tags}
+        if end is None:
+            event['ph'] = 'i'
+            event['s'] = 't'
+        else:
+            event['ph'] = 'X'
+            event['dur'] = end - start
+        with self.__lock:
+            if track_name not in self.__tracks:
+                self.__tracks[track_name] = len(self.__tracks) + 1
+                self.__events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.__pid,
+                                      'tid': self.__tracks[track_name], 'args': {'name': track_name}})
+            event['tid'] = self.__tracks[track_name]
+            self.__events.append(event)
+    #} End method add
+
+    def get_events(self): #{
+        with self.__lock:
+            return list(self.__events)
+    #} End method get_events
+
+    def add_events(self, events): #{
+        with self.__lock:
+            self.__events.extend(events)
+    #} End method add_events
+#} End class Tracer
+
+
+class Span(object): #{
+    '''
+    class Span(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __tracer = The Tracer the span is recorded on
+        __name = Name of the stage, e.g. 'ssh.connect' (the part before the first '.' is its category)
+        __tags = Dictionary of the span's tags (ue, phase, server etc.)
+        __start = Trace time the span started
+        __is_ended = True once the span has been recorded
+
+    Overview:
+    A stage being timed. It is used either as a context manager (with Tracing.span(...):) or, for a stage that ends on
+    another thread or in another method, started with Tracing.span() and ended with end().
+
+    Public methods:
+    end(self, **tags):
+    Ends the span, adding any more tags, and records it. Only the first call does anything.
+
+    '''
+
+    def __init__(self, tracer, name, tags): #{
+        '''
+        Constructor
+        '''
+        self.__tracer = tracer
+        self.__name = name
+        self.__tags = tags
+        self.__start = tracer.now()
+        self.__is_ended = False
+    #} End method __init__
+
+    def __enter__(self): #{
+        return self
+    #} End method __enter__
+
+    def __exit__(self, exc_type, exc_value, exc_traceback): #{
+        if exc_type is not None: self.__tags['error'] = exc_type.__name__
+        self.end()
+        return False
+    #} End method __exit__
+
+    def end(self, **tags): #{
+        if self.__is_ended: return
+        self.__is_ended = True
+        self.__tags.update(tags)
+        self.__tracer.add(self.__name, self.__start, self.__tracer.now(), self.__tags)
+    #} End method end
+#} End class Span
+
+
+class NullSpan(object): #{
+    '''
+    class NullSpan(object):
+    Sub-class of:                    object
+
+    Overview:
+    The span returned while tracing is off. It does nothing, and the one instance is shared by every caller.
+
+    '''
+
+    def __enter__(self): #{
+        return self
+    #} End method __enter__
+
+    def __exit__(self, exc_type, exc_value, exc_traceback): #{
+        return False
+    #} End method __exit__
+
+    def end(self, **tags): #{
+        pass
+    #} End method end
+#} End class NullSpan
+
+NULL_SPAN = NullSpan()
+
+
+def enable(): #{
+    '''
+    Switches tracing on for this process (and starts a new trace if it was already on)
+    '''
+    global tracer
+    tracer = Tracer()
+#} End method enable
+
+
+def is_enabled(): #{
+    '''
+    Returns True if tracing is on
+    '''
+    return tracer is not None
+#} End method is_enabled
+
+
+def span(name, **tags): #{
+    '''
+    Starts a Span, for use as a context manager (e.g. with Tracing.span('ssh.connect', server=ip):), or to be ended by
+    calling its end() method
+    '''
+    if tracer is None: return NULL_SPAN
+    return Span(tracer, name, tags)
+#} End method span
+
+
+def instant(name, **tags): #{
+    '''
+    Records a moment (rather than a stage with a duration), e.g. the first report of a phase
+    '''
+    if tracer is None: return
+    tracer.add(name, tracer.now(), None, tags)
+#} End method instant
+
+
+def get_events(): #{
+    '''
+    Returns the events recorded in this process, for passing on to the process that writes the trace
+    '''
+    if tracer is None: return []
+    return tracer.get_events()
+#} End method get_events
+
+
+def add_events(events): #{
+    '''
+    Adds the events of another process to this process's trace
+    '''
+    if tracer is not None: tracer.add_events(events)
+#} End method add_events
+
+
+def write(path): #{
+    '''
+    Writes the trace (in the Chrome trace JSON format) to path
+    '''
+    trace_file = open(path, 'w')
+    json.dump({'traceEvents': get_events(), 'displayTimeUnit': 'ms'}, trace_file)
+    trace_file.close()
+#} End method write
@@ -0,0 +1,458 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.TrafficEngine is a native (in-process) UDP traffic engine, which can be used instead of spawning a local iperf
+for the UL client and the DL server. It speaks the iperf 2 UDP datagram format, so it works against a normal iperf at the
+other end, and it prints its interval reports in the same format as iperf -f k, so the logs and the IntervalParser work
+exactly as they do with iperf.
+
+TrafficEngine.py implements the NativeStream, UDPSender and UDPReceiver classes, and the spawn() function.
+'''
+
+import os
+import sys
+import time
+import errno
+import socket
+import struct
+from threading import Thread
+from threading import Event
+
+from loadtest.RunEngine import monotonic
+from loadtest.IntervalParser import parse_size, format_kilo
+from loadtest.RateProfile import parse_profile
+
+# iperf 2 UDP datagram header: packet ID, then the send time in seconds and microseconds (network byte order)
+UDP_HEADER = struct.Struct('>iII')
+# iperf 2 server report, sent back to the client in reply to its final (negative ID) datagram
+SERVER_HEADER = struct.Struct('>IiIiiiiiii')
+HEADER_VERSION1 = 0x80000000
+# iperf uses the socket number as the stream ID in its reports, 3 is what it nearly always is
+STREAM_ID = 3
+# How long a UDP sender sleeps when the socket buffer refuses a datagram, before it tries again
+SEND_BACKOFF = 0.001
+
+
+class NativeStream(object): #{
+    '''
+    class NativeStream(object):
+    Sub-class of:                    object
+    Public instance variables:
+        pid = Always None, there is no separate process
+        returncode = None while running, then 0 (or 1 if the stream failed)
+        stdout = Read end of a pipe carrying the iperf-format report lines, the same as Popen(stdout=PIPE).stdout
+    Private instance variables:
+        __write_fd = Write end of the stdout pipe
+        __thread = Thread running the stream
+
+    Overview:
+    NativeStream is the base class of the native senders and receivers. It runs the stream on its own thread, and looks
+    like a subprocess.Popen object to the rest of the script (poll, wait, terminate and kill, and a stdout pipe that the
+    StreamCapture reads), so UEPhase doesn't need to know whether it started an iperf or a native stream.
+    Sub-classes implement _run(), which must return when _stop is set.
+
+    Public methods:
+    start(self):
+    Starts the stream thread.
+
+    poll(self), wait(self), terminate(self), kill(self):
+    As for subprocess.Popen.
+
+    '''
+
+    def __init__(self): #{
+        '''
+        Constructor
+        '''
+        self.pid = None
+        self.returncode = None
+        read_fd, self.__write_fd = os.pipe()
+        if sys.platform != 'win32':
+            # Don't let the iperf processes started later inherit the write end, or the pipe never reaches end of file:
+            import fcntl
+            fcntl.fcntl(self.__write_fd, fcntl.F_SETFD, fcntl.fcntl(self.__write_fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            fcntl.fcntl(read_fd, fcntl.F_SETFD, fcntl.fcntl(read_fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self.stdout = os.fdopen(read_fd, 'rb', 0)
+        self._stop = Event()
+        self.__thread = Thread(target=self.__run)
+        self.__thread.setDaemon(True)
+    #} End method __init__
+
+    def start(self): #{
+        self.__thread.start()
+    #} End method start
+
+    def poll(self): #{
+        if self.__thread.isAlive(): return None
+        return self.returncode
+    #} End method poll
+
+    def wait(self): #{
+        while self.__thread.isAlive(): self.__thread.join(0.1)
+        return self.returncode
+    #} End method wait
+
+    def terminate(self): #{
+        self._stop.set()
+    #} End method terminate
+
+    def kill(self): #{
+        self._stop.set()
+    #} End method kill
+
+    def _report(self, line): #{
+        os.write(self.__write_fd, line)
+    #} End method _report
+
+    def _run(self): #{
+        raise NotImplementedError
+    #} End method _run
+
+    def __run(self): #{
+        try:
+            self._run()
+            self.returncode = 0
+        except Exception, e:
+            self._report('native engine error: ' + str(e) + '\n')
+            self.returncode = 1
+        finally:
+            os.close(self.__write_fd)
+    #} End method __run
+#} End class NativeStream
+
+
+class UDPSender(NativeStream): #{
+    '''
+    class UDPSender(NativeStream):
+    Sub-class of:                    NativeStream
+    Private instance variables:
+        __bind_ip, __host, __port = Local address to send from, and the iperf server to send to
+        __rate = Offered rate in bits/sec
+        __length = Datagram length in bytes
+        __duration, __interval, __window = As iperf -t, -i and -w
+        __profile = RateProfile the rate and length follow instead (None to keep to __rate and __length)
+
+    Overview:
+    Equivalent of 'iperf -u -c host'. Every datagram is sent from the same pre-allocated buffer (through a memoryview, so
+    nothing is copied or allocated per packet) with only the iperf header re-written in place.
+    The rate is paced with a token bucket: tokens (bytes) build up at the offered rate, and every time the sender wakes up
+    it sends as many datagrams as the tokens allow in one batch. The bucket holds up to 20ms of traffic, which absorbs the
+    coarse sleep granularity on Windows without making the traffic bursty. If the socket buffer refuses a datagram, the
+    sender backs off for at least SEND_BACKOFF before it tries again.
+    At the end, the final datagram is sent (up to 10 times) until the server acknowledges it with its report, as iperf does.
+    With a rate profile (see RateProfile.py), the rate and datagram length are looked up again every time the sender
+    wakes up, so a whole step or ramp profile is one stream, with nothing restarted at the steps.
+
+    '''
+
+    def __init__(self, bind_ip, host, port, rate, length, duration, interval=1.0, window=None, profile=None): #{
+        '''
+        Constructor
+        '''
+        NativeStream.__init__(self)
+        self.__bind_ip = bind_ip
+        self.__host = host
+        self.__port = port
+        self.__rate = rate
+        self.__length = length
+        self.__duration = duration
+        self.__interval = interval
+        self.__window = window
+        self.__profile = profile
+    #} End method __init__
+
+    def _run(self): #{
+        length = self.__length
+        interval = self.__interval
+        profile = self.__profile
+        payload = bytearray(length if profile is None else max(length, profile.get_max_length()))
+        view = memoryview(payload)[:length]
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.__window: sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, int(self.__window))
+        if self.__bind_ip: sock.bind((self.__bind_ip, 0))
+        sock.connect((self.__host, self.__port))
+        local_ip, local_port = sock.getsockname()
+        self._report('------------------------------------------------------------\n' +
+                     'Client connecting to ' + self.__host + ', UDP port ' + str(self.__port) + ' (native engine)\n' +
+                     'Sending ' + str(length) + ' byte datagrams\n' +
+                     '------------------------------------------------------------\n' +
+                     '[%3d] local %s port %d connected with %s port %d\n' % (STREAM_ID, local_ip, local_port, self.__host, self.__port))
+
+        bytes_per_sec = max(self.__rate, 1.0) / 8.0
+        bucket_size = max(length, bytes_per_sec * 0.02)
+        tokens = float(length)
+        packet_id = 0
+        total_bytes = 0
+        interval_bytes = 0
+        start = last = monotonic()
+        end = start + self.__duration
+        next_report = start + interval
+
+        while not self._stop.isSet():
+            now = monotonic()
+            if now >= end: break
+            if profile is not None:
+                rate, segment_length = profile.get_segment(now - start)
+                bytes_per_sec = max(rate, 1.0) / 8.0
+                bucket_size = max(segment_length, bytes_per_sec * 0.02)
+                if segment_length != length:
+                    length = segment_length
+                    view = memoryview(payload)[:length]
+            tokens = min(tokens + (now - last) * bytes_per_sec, bucket_size)
+            last = now
+
+            # Send a batch of datagrams, all stamped with the same time:
+            is_refused = False
+            if tokens >= length:
+                wall = time.time()
+                seconds = int(wall)
+                microseconds = int((wall - seconds) * 1e6)
+                while tokens >= length:
+                    UDP_HEADER.pack_into(payload, 0, packet_id, seconds, microseconds)
+                    try:
+                        sock.send(view)
+                    except socket.error, e:
+                        # The socket buffer is full, so back off until the next wake-up:
+                        if e.args[0] in (errno.ENOBUFS, errno.EAGAIN, errno.EWOULDBLOCK):
+                            is_refused = True
+                            break
+                        # An ICMP unreachable came back (e.g. the remote server isn't listening yet), keep going:
+                        if e.args[0] in (errno.ECONNREFUSED, errno.ECONNRESET): continue
+                        raise
+                    packet_id += 1
+                    tokens -= length
+                    interval_bytes += length
+
+            while now >= next_report:
+                self.__report_interval(next_report - interval - start, next_report - start, interval_bytes)
+                total_bytes += interval_bytes
+                interval_bytes = 0
+                next_report += interval
+
+            # Sleep until there are enough tokens for the next datagram (or the next report is due):
+            # (the tokens are still there after a refused send, so back off for a while instead of spinning):
+            wait = min((length - tokens) / bytes_per_sec, next_report - now, end - now)
+            if is_refused: wait = max(wait, SEND_BACKOFF)
+            if wait > 0: time.sleep(wait)
+
+        now = monotonic()
+        total_bytes += interval_bytes
+        if interval_bytes and now - (next_report - interval) > interval * 0.5:
+            self.__report_interval(next_report - interval - start, now - start, interval_bytes)
+        self.__report_interval(0.0, now - start, total_bytes)
+        self._report('[%3d] Sent %d datagrams\n' % (STREAM_ID, packet_id))
+        self.__send_fin(sock, payload, view, packet_id)
+        sock.close()
+    #} End method _run
+
+    def __report_interval(self, start, end, num_bytes): #{
+        seconds = max(end - start, 1e-6)
+        self._report('[%3d] %4.1f-%4.1f sec  %s KBytes  %s Kbits/sec\n' %
+                     (STREAM_ID, start, end, format_kilo(num_bytes / 1024.0), format_kilo(num_bytes * 8 / seconds / 1000.0)))
+    #} End method __report_interval
+
+    def __send_fin(self, sock, payload, view, packet_id): #{
+        # iperf marks the last datagram with a negative ID, and the server replies to it with its own report:
+        reply = bytearray(2048)
+        sock.settimeout(0.25)
+        for _ in range(10):
+            wall = time.time()
+            UDP_HEADER.pack_into(payload, 0, -packet_id, int(wall), int((wall - int(wall)) * 1e6))
+            try:
+                sock.send(view)
+                received = sock.recv_into(reply)
+            except (socket.timeout, socket.error):
+                continue
+            if received < UDP_HEADER.size + SERVER_HEADER.size: continue
+            flags, total_len1, total_len2, stop_sec, stop_usec, error_cnt, outorder_cnt, datagrams, jitter1, jitter2 = \
+                SERVER_HEADER.unpack_from(reply, UDP_HEADER.size)
+            if not flags & HEADER_VERSION1: continue
+            total_bytes = (total_len1 << 32) + total_len2
+            duration = max(stop_sec + stop_usec / 1e6, 1e-6)
+            jitter_ms = (jitter1 + jitter2 / 1e6) * 1000
+            loss = 100.0 * error_cnt / datagrams if datagrams else 0.0
+            self._report('[%3d] Server Report:\n' % STREAM_ID)
+            self._report('[%3d] %4.1f-%4.1f sec  %s KBytes  %s Kbits/sec  %6.3f ms %4d/%5d (%.2g%%)\n' %
+                         (STREAM_ID, 0.0, duration, format_kilo(total_bytes / 1024.0),
+                          format_kilo(total_bytes * 8 / duration / 1000.0), jitter_ms, error_cnt, datagrams, loss))
+            return
+        self._report('[%3d] WARNING: did not receive ack of last datagram after 10 tries.\n' % STREAM_ID)
+    #} End method __send_fin
+#} End class UDPSender
+
+
+class UDPReceiver(NativeStream): #{
+    '''
+    class UDPReceiver(NativeStream):
+    Sub-class of:                    NativeStream
+    Private instance variables:
+        __bind_ip, __port = Local address to listen on
+        __interval, __window = As iperf -i and -w
+
+    Overview:
+    Equivalent of 'iperf -s -u'. Datagrams are received into one pre-allocated buffer. Loss is counted from gaps in the
+    packet IDs, and jitter is the RFC 1889 smoothed transit time variation, both as iperf does it.
+    A report is printed for every interval from the first datagram of a client. When the client's final datagram arrives,
+    the summary is printed and the server report is sent back to the client, and the receiver waits for the next client.
+    Like iperf -s, it keeps running until it is terminated.
+
+    '''
+
+    def __init__(self, bind_ip, port, interval=1.0, window=None): #{
+        '''
+        Constructor
+        '''
+        NativeStream.__init__(self)
+        self.__bind_ip = bind_ip
+        self.__port = port
+        self.__interval = interval
+        self.__window = window
+    #} End method __init__
+
+    def _run(self): #{
+        interval = self.__interval
+        buf = bytearray(65536)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.__window: sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(self.__window))
+        sock.bind((self.__bind_ip or '0.0.0.0', self.__port))
+        sock.settimeout(0.1)
+        self._report('------------------------------------------------------------\n' +
+                     'Server listening on UDP port ' + str(self.__port) + ' (native engine)\n' +
+                     '------------------------------------------------------------\n')
+        session = None
+        while not self._stop.isSet():
+            try:
+                received, peer = sock.recvfrom_into(buf)
+            except socket.timeout:
+                received = 0
+            except socket.error, e:
+                # Windows reports an ICMP unreachable for an earlier sendto() on the next receive, which can be ignored:
+                if e.args[0] not in (errno.ECONNREFUSED, errno.ECONNRESET, getattr(errno, 'WSAECONNRESET', None)): raise
+                received = 0
+            now = monotonic()
+
+            if received >= UDP_HEADER.size:
+                packet_id, seconds, microseconds = UDP_HEADER.unpack_from(buf, 0)
+                if session is None:
+                    session = self.__new_session(now)
+                    self._report('[%3d] local %s port %d connected with %s port %d\n' %
+                                 (STREAM_ID, self.__bind_ip or '0.0.0.0', self.__port, peer[0], peer[1]))
+                if packet_id < 0:
+                    # Final datagram, the client has finished:
+                    self.__end_session(session, now, sock, peer, buf)
+                    session = None
+                    continue
+                self.__count(session, packet_id, received, time.time() - (seconds + microseconds / 1e6))
+
+            if session is not None:
+                while now >= session['next_report']:
+                    self.__report_interval(session, session['next_report'] - interval, session['next_report'])
+                    session['next_report'] += interval
+        sock.close()
+    #} End method _run
+
+    def __new_session(self, now): #{
+        return {'start': now, 'next_report': now + self.__interval, 'last_id': -1, 'bytes': 0, 'jitter': 0.0,
+                'last_transit': None, 'lost': 0, 'out_of_order': 0,
+                'interval_bytes': 0, 'interval_lost': 0, 'interval_first_id': 0}
+    #} End method __new_session
+
+    def __count(self, session, packet_id, received, transit): #{
+        if session['last_transit'] is not None:
+            session['jitter'] += (abs(transit - session['last_transit']) - session['jitter']) / 16.0
+        session['last_transit'] = transit
+        if packet_id > session['last_id'] + 1:
+            gap = packet_id - session['last_id'] - 1
+            session['lost'] += gap
+            session['interval_lost'] += gap
+        elif packet_id <= session['last_id']:
+            # A late datagram, which was counted as lost when the gap was seen:
+            session['out_of_order'] += 1
+            session['lost'] -= 1
+            session['interval_lost'] -= 1
+        session['last_id'] = max(packet_id, session['last_id'])
+        session['bytes'] += received
+        session['interval_bytes'] += received
+    #} End method __count
+
+    def __report_interval(self, session, start, end): #{
+        total = session['last_id'] + 1 - session['interval_first_id']
+        lost = max(session['interval_lost'], 0)
+        self.__report_line(start - session['start'], end - session['start'], session['interval_bytes'],
+                           session['jitter'], lost, total)
+        session['interval_bytes'] = 0
+        session['interval_lost'] = 0
+        session['interval_first_id'] = session['last_id'] + 1
+    #} End method __report_interval
+
+    def __report_line(self, start, end, num_bytes, jitter, lost, total): #{
+        seconds = max(end - start, 1e-6)
+        loss = 100.0 * lost / total if total > 0 else 0.0
+        self._report('[%3d] %4.1f-%4.1f sec  %s KBytes  %s Kbits/sec  %6.3f ms %4d/%5d (%.2g%%)\n' %
+                     (STREAM_ID, start, end, format_kilo(num_bytes / 1024.0), format_kilo(num_bytes * 8 / seconds / 1000.0),
+                      jitter * 1000, lost, total, loss))
+    #} End method __report_line
+
+    def __end_session(self, session, now, sock, peer, buf): #{
+        duration = now - session['start']
+        datagrams = session['last_id'] + 1
+        lost = max(session['lost'], 0)
+        if session['interval_bytes'] and now - (session['next_report'] - self.__interval) > self.__interval * 0.5:
+            self.__report_interval(session, session['next_report'] - self.__interval, now)
+        self.__report_line(0.0, duration, session['bytes'], session['jitter'], lost, datagrams)
+        if session['out_of_order']:
+            self._report('[%3d] %4.1f-%4.1f sec  %d datagrams received out-of-order\n' %
+                         (STREAM_ID, 0.0, duration, session['out_of_order']))
+
+        # Send the server report back to the client, in the reply to its final datagram:
+        jitter = session['jitter']
+        SERVER_HEADER.pack_into(buf, UDP_HEADER.size, HEADER_VERSION1,
+                                session['bytes'] >> 32, session['bytes'] & 0xffffffff,
+                                int(duration), int((duration - int(duration)) * 1e6),
+                                lost, session['out_of_order'], datagrams,
+                                int(jitter), int((jitter - int(jitter)) * 1e6))
+        try:
+            sock.sendto(memoryview(buf)[:UDP_HEADER.size + SERVER_HEADER.size], peer)
+        except socket.error:
+            pass
+    #} End method __end_session
+#} End class UDPReceiver
+
+
+def spawn(command): #{
+    '''
+    Starts a native stream from an iperf-style command line, e.g. 'native -s -p 5031 -B 10.0.0.2 -u -i 1 -f k'.
+    Only UDP (-u) is supported. Options the native engine has no use for (-P, -U, -f) are ignored.
+    A sender can also be given a rate profile with --profile (and --ramp to ramp it), see RateProfile.py.
+    Returns the started NativeStream.
+    '''
+    args = command.split()[1:]
+    options = {}
+    flags = set()
+    i = 0
+    while i < len(args):
+        if args[i] in ('-p', '-c', '-B', '-t', '-b', '-l', '-i', '-w', '-P', '-f', '--profile'):
+            options[args[i]] = args[i + 1]
+            i += 2
+        else:
+            flags.add(args[i])
+            i += 1
+    if '-u' not in flags: raise ValueError('The native traffic engine only supports UDP: ' + command)
+
+    interval = float(options.get('-i', '1'))
+    window = parse_size(options['-w']) if '-w' in options else None
+    if '-s' in flags:
+        stream = UDPReceiver(options.get('-B'), int(options['-p']), interval, window)
+    else:
+        stream = UDPSender(options.get('-B'), options['-c'], int(options['-p']),
+                           parse_size(options.get('-b', '1M')), int(parse_size(options.get('-l', '1470'))),
+                           float(options.get('-t', '10')), interval, window,
+                           parse_profile(options['--profile'], '--ramp' in flags) if '--profile' in options else None)
+    stream.start()
+    return stream
+#} End method spawn
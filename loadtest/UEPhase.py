@@ -0,0 +1,385 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.UEPhase runs one phase of one UE's test: it starts the local and remote iperf processes, reports when the
+traffic has finished, and tears everything down again. It replaces the old run_ue_test thread target, split into steps
+so that the RunEngine can drive any number of phases from one thread.
+
+UEPhase.py implements the UEPhase class and methods, as well as the spawn_local() function.
+'''
+
+import os
+import sys
+import shlex
+import subprocess
+import logging
+from threading import Event
+
+from loadtest.IntervalParser import IntervalParser
+from loadtest.RunEngine import monotonic
+from loadtest import TrafficEngine
+from loadtest import Tracing
+
+# Most seconds prepare() waits for the local server to say it is listening. An iperf whose output is block-buffered by
+# the pipe doesn't say so until much later, but it is listening within milliseconds of being started, so this is short:
+LOCAL_LISTEN_TIMEOUT = 0.5
+# Most seconds prepare() waits for the remote server to say it is listening. It is only listening once the channel has
+# been opened and the command run over SSH, and anything sent before then is lost as start-of-test loss:
+REMOTE_LISTEN_TIMEOUT = 5.0
+
+class UEPhase(object): #{
+    '''
+    class UEPhase(object):
+    Sub-class of:                    object
+    Public instance variables:
+        name = Name of the phase for debug purposes, e.g. 'UE1-phase0'
+        delay = Seconds from the start of the test until the phase starts
+        duration = Length of the phase (iperf -t) in seconds
+        ue = Adapter name of the UE
+        ue_ip = The UE address that the iperfs of this phase are bound to
+    Private instance variables:
+        __remote = RemoteProcesses used to start and kill the remote iperf processes
+        __capture = StreamCapture that the logs and the iperf output go through
+        __series = SeriesStore that the parsed iperf reports are added to
+        __test_config = test_config dict built by TestInstance.get_test_config
+        __is_dl, __is_ul, __is_logging = Convenience booleans as used by TestInstance
+        __logs = Dictionary of log name ('dl_client' etc.) to open log file
+        __readers = List of capture reader threads
+        __dl_local, __ul_local = Local iperf sub-processes, or native streams (None until started)
+        __dl_remote, __ul_remote = stdout files of the remote iperf channels (None until started)
+        __dl_handle, __ul_handle = RemoteProcesses handles of the remote iperf processes
+        __phase_series = List of the ThroughputSeries this phase's output is parsed into
+        __is_prepared = True once prepare() has been called
+        __listening = List of (threading.Event, timeout) tuples, one per server: the event is set once the server has
+            said it is listening, timeout is the most seconds to wait for it
+        __started_at = monotonic() time the phase was started (None until started)
+        __down_since = monotonic() time the UE lost the address of this phase (None if it hasn't)
+        __is_closed = True once close() has been called
+        __trace = Tracing span of the whole phase, from prepare() to close()
+
+    Overview:
+    prepare() and start() do what the first half of run_ue_test used to do. prepare() does everything that can be done
+    ahead of the phase's start time: it opens the logs and starts the servers (the local server for DL, the remote
+    server for UL), and waits for them to say they are listening. start() then only starts the traffic-generating
+    side, so the phases the RunEngine releases together start their traffic together. The time from the scheduled start
+    to each client actually being started is recorded as the start skew of the phase's series.
+    Instead of then sleeping for duration + 3 seconds, the
+    caller polls is_finished(), which is true as soon as the traffic-generating side (the remote client for DL, the local
+    client for UL) has exited. stop() then kills the server sides (and the clients too if the test was interrupted), and
+    close() waits for the last of the output to be captured and closes the channels and logs.
+    The remote processes are killed by PID through the RemoteProcesses, which batches the kills of all the phases
+    stopping at the same time into one command per server.
+    If the UE's interface loses its address (see InterfaceWatcher.py), interface_changed() is called, and the time until
+    the address comes back (or the phase ends) is marked on the phase's series as an outage. A phase started part way
+    through an earlier one (test_config 'offset' > 0) reports its times from the start of the earlier one.
+    For a DL rate profile, the remote client is a chain of iperf runs, one per step (test_config 'dl_client_steps'), and
+    the DL reports on both sides are parsed as chained output.
+    With tracing on (see Tracing.py), each step (remote exec, local start, first report, kill, close) is traced on the
+    phase's track.
+
+    Public methods:
+    prepare(self):
+    Opens the logs and starts the iperf servers, returning once they have said they are listening, or after at most
+    LOCAL_LISTEN_TIMEOUT seconds for the local server and REMOTE_LISTEN_TIMEOUT seconds for the remote one.
+
+    start(self, scheduled=None):
+    Starts the iperf clients, preparing the phase first if it hasn't been. scheduled is the monotonic() time the phase
+    was due to start, which the start skew is measured from (default now).
+
+    is_finished(self):
+    Returns True once all the iperf clients of this phase have exited.
+
+    stop(self, is_interrupted):
+    Kills the iperf servers, and the clients as well if is_interrupted is True.
+
+    close(self, is_interrupted):
+    Waits for the output capture to finish, closes the channels and closes the logs.
+
+    interface_changed(self, addr, when):
+    Tells the phase the UE's usable address is now addr (None if it has none) as of monotonic() time when.
+    Returns True if the phase is bound to an address the UE no longer has, but the UE has a new one.
+
+    get_elapsed(self, when):
+    Returns the seconds from the start of the phase (including any offset) to when, or None if not started.
+
+    get_test_config(self):
+    Returns the test_config dict of the phase.
+
+    get_state(self):
+    Returns 'pending' until the phase is started, 'running' until it is closed, then 'finished'.
+
+    '''
+
+    def __init__(self, remote, capture, series, test_config, is_dl, is_ul, is_logging): #{
+        '''
+        Constructor
+        '''
+        self.name = test_config['ue'] + '-phase' + str(test_config['phase'])
+        self.delay = test_config['delay']
+        self.duration = test_config['duration']
+        self.ue = test_config['ue']
+        self.ue_ip = test_config['ue_ip']
+        self.__remote = remote
+        self.__capture = capture
+        self.__series = series
+        self.__test_config = test_config
+        self.__is_dl = is_dl
+        self.__is_ul = is_ul
+        self.__is_logging = is_logging
+        self.__logs = {}
+        self.__readers = []
+        self.__dl_local = None
+        self.__ul_local = None
+        self.__dl_remote = None
+        self.__ul_remote = None
+        self.__dl_handle = None
+        self.__ul_handle = None
+        self.__phase_series = []
+        self.__is_prepared = False
+        self.__listening = []
+        self.__started_at = None
+        self.__down_since = None
+        self.__is_closed = False
+        self.__trace = Tracing.NULL_SPAN
+    #} End method __init__
+
+    def prepare(self): #{
+        if self.__is_prepared: return
+        self.__is_prepared = True
+        test_config = self.__test_config
+        capture = self.__capture
+        # the ftpServer item of the UE config contains a list of three values specifying the IP, Username and Password of the FTP server
+        # The connection to it is already open in the pool, each command below only opens a new channel on it:
+        server = test_config['ftpserver']
+        self.__trace = self.__span('phase', delay=self.delay, duration=self.duration)
+
+        if self.__is_dl:
+            self.__open_log('dl_client')
+            dl_server_log = self.__open_log('dl_server')
+            # Start the local server:
+            capture.write(dl_server_log, '\n-----------Executing command - ' + test_config['dl_server_str'] + '--------------\n\n')
+            with self.__span('local.start', role='dl_server'):
+                self.__dl_local = spawn_local(test_config['dl_server_str'])
+            self.__attach(self.__dl_local.stdout, dl_server_log, 'DL', 'server', LOCAL_LISTEN_TIMEOUT)
+            logging.debug(self.name + ': dl server started (local) with pid = ' + str(self.__dl_local.pid))
+        if self.__is_ul:
+            self.__open_log('ul_client')
+            ul_server_log = self.__open_log('ul_server')
+            # Start the remote server:
+            capture.write(ul_server_log, '\n-----------Executing command - ' + test_config['ul_server_str'] + '--------------\n\n')
+            capture.write(ul_server_log, '\n-----------NOTE: IF RUNNING UPLINK TCP TEST, VALUES MAY BE ZERO DUE TO SERVER PERMISSIONS--------------\n\n')
+            with self.__span('remote.exec', role='ul_server'):
+                self.__ul_handle, self.__ul_remote = self.__remote.start(server, self.name + '_ul_server', test_config['ul_server_str'])
+            self.__attach(self.__ul_remote, ul_server_log, 'UL', 'server', REMOTE_LISTEN_TIMEOUT)
+            logging.debug(self.name + ': ul server started (remote)')
+
+        # Give the servers time to start listening before anything is sent to them. The 'listening' line cuts the wait
+        # short: the local server's may be held back in the pipe's buffer, so it is only given a moment, but the remote
+        # server's is waited for, as the remote server can take a while to start:
+        with self.__span('listen.wait'):
+            waited_from = monotonic()
+            for listening, timeout in self.__listening:
+                if not listening.wait(max(0.0, waited_from + timeout - monotonic())):
+                    if timeout == REMOTE_LISTEN_TIMEOUT:
+                        logging.warning(self.name + ': the remote server has not said it is listening, starting anyway')
+                    else:
+                        logging.debug(self.name + ': the local server has not said it is listening yet, starting anyway')
+    #} End method prepare
+
+    def start(self, scheduled=None): #{
+        if scheduled is None: scheduled = monotonic()
+        self.prepare()
+        test_config = self.__test_config
+        capture = self.__capture
+        server = test_config['ftpserver']
+        self.__started_at = monotonic()
+
+        if self.__is_dl:
+            dl_client_log = self.__logs['dl_client']
+            # Start the remote client:
+            capture.write(dl_client_log, '\n-----------Executing command - ' + test_config['dl_client_str'] + '--------------\n\n')
+            with self.__span('remote.exec', role='dl_client'):
+                if 'dl_client_steps' in test_config: # A rate profile, run as a chain of clients (see RateProfile.py)
+                    self.__dl_handle, self.__dl_remote = self.__remote.start_chain(server, self.name + '_dl_client', test_config['dl_client_steps'])
+                else:
+                    self.__dl_handle, self.__dl_remote = self.__remote.start(server, self.name + '_dl_client', test_config['dl_client_str'])
+            skew = monotonic() - scheduled
+            self.__attach(self.__dl_remote, dl_client_log, 'DL', 'client')
+            self.__set_start_skew('DL', skew)
+            logging.debug(self.name + ': dl client started (remote)')
+        if self.__is_ul:
+            ul_client_log = self.__logs['ul_client']
+            # Start the local client:
+            capture.write(ul_client_log, '\n-----------Executing command - ' + test_config['ul_client_str'] + '--------------\n\n')
+            with self.__span('local.start', role='ul_client'):
+                self.__ul_local = spawn_local(test_config['ul_client_str'])
+            skew = monotonic() - scheduled
+            self.__attach(self.__ul_local.stdout, ul_client_log, 'UL', 'client')
+            self.__set_start_skew('UL', skew)
+            logging.debug(self.name + ': ul client started (local) with pid = ' + str(self.__ul_local.pid))
+    #} End method start
+
+    def is_finished(self): #{
+        # A client that never started (start() failed part way) counts as finished, so the phase still gets torn down:
+        if self.__dl_remote is not None and not self.__dl_remote.channel.exit_status_ready(): return False
+        if self.__ul_local is not None and self.__ul_local.poll() is None: return False
+        return True
+    #} End method is_finished
+
+    def stop(self, is_interrupted): #{
+        trace = self.__span('kill', is_interrupted=is_interrupted)
+        remote_kills = []
+        # If the test was interrupted then kill the client processes early:
+        if is_interrupted and self.__ul_local is not None and self.__ul_local.poll() is None:
+            self.__ul_local.kill() # Kill the UL client process
+        if is_interrupted and self.__dl_handle is not None:
+            remote_kills.append(self.__dl_handle) # Kill the DL client process
+
+        if self.__ul_handle is not None:
+            # kill the UL server process
+            remote_kills.append(self.__ul_handle)
+        # Both remote kills go in one command (along with any other phases' that are stopping), and don't wait:
+        self.__remote.kill(self.__test_config['ftpserver'], remote_kills)
+        if remote_kills: logging.debug(self.name + ': Remote processes killed')
+        if self.__dl_local is not None and self.__dl_local.poll() is None:
+            # kill the DL server process
+            self.__dl_local.terminate()
+            logging.debug(self.name + ': Local DL server process killed')
+        trace.end()
+    #} End method stop
+
+    def close(self, is_interrupted): #{
+        capture = self.__capture
+        # Every process has now ended, so wait for the last of their output to be captured:
+        for reader in self.__readers: reader.join(5)
+        # Close this phase's channels (the SSH connection itself belongs to the pool and is closed at the end of the test)
+        # This also ends the capture of any remote output that is still hanging on after its process was killed:
+        if self.__dl_remote is not None: self.__dl_remote.channel.close()
+        if self.__ul_remote is not None: self.__ul_remote.channel.close()
+        logging.debug(self.name + ': Server channels closed')
+        for reader in self.__readers: reader.join()
+        logging.debug(self.name + ': Output capture finished')
+        trace = self.__span('log.close')
+        self.__is_closed = True
+        # The UE never got its address back:
+        if self.__down_since is not None: self.__mark_outage(self.__down_since, monotonic())
+
+        for log in self.__logs.values():
+            # if interrupt then write a final note to the logs:
+            if is_interrupted: capture.write(log, '\nProcess Interrupted by User.\n')
+            # and close the files before you go!
+            capture.close_log(log)
+        logging.debug(self.name + ': Log files closed')
+        trace.end()
+        self.__trace.end(is_interrupted=is_interrupted)
+    #} End method close
+
+    def interface_changed(self, addr, when): #{
+        if addr == self.ue_ip:
+            if self.__down_since is not None:
+                self.__mark_outage(self.__down_since, when)
+                self.__down_since = None
+            return False
+        if self.__down_since is None and self.__started_at is not None and not self.__is_closed:
+            logging.warning(self.name + ': UE lost address ' + self.ue_ip)
+            self.__down_since = when
+        return addr is not None and not self.__is_closed
+    #} End method interface_changed
+
+    def get_elapsed(self, when): #{
+        if self.__started_at is None: return None
+        return when - self.__started_at + self.__test_config['offset']
+    #} End method get_elapsed
+
+    def get_test_config(self): #{
+        return self.__test_config
+    #} End method get_test_config
+
+    def get_state(self): #{
+        if self.__started_at is None: return 'pending'
+        if not self.__is_closed: return 'running'
+        return 'finished'
+    #} End method get_state
+
+    def __mark_outage(self, start, end): #{
+        for series in self.__phase_series:
+            series.mark_outage(self.get_elapsed(start), self.get_elapsed(end))
+    #} End method __mark_outage
+
+    def __open_log(self, log_name): #{
+        if self.__is_logging:
+            log_path = self.__test_config['logpath'] + os.path.sep + self.__test_config['logname'] + '_' + log_name + '.log'
+            log = self.__capture.open_log(log_path)
+        else: # Set logs to write to null device:
+            log = self.__capture.open_log(os.devnull)
+        self.__logs[log_name] = log
+        return log
+    #} End method __open_log
+
+    def __attach(self, source, log, direction, role, listen_timeout=None): #{
+        # Each log is also parsed into its own throughput series as it is captured:
+        series = self.__series.get_series(self.__test_config['ue'], self.__test_config['phase'], direction, role)
+        self.__phase_series.append(series)
+        # What a TCP series was run with goes in its summary:
+        if self.__test_config['traffic_type'] == 'TCP': series.tcp = self.__test_config['tcp'][direction]
+        # The DL reports of a chain of clients start from 0 again for every client, on both sides:
+        parser = IntervalParser(series, offset=self.__test_config['offset'],
+                                is_chained=direction == 'DL' and 'dl_client_steps' in self.__test_config)
+        listener = parser.feed
+        # A server's output is also watched for the line saying it is listening:
+        if listen_timeout is not None:
+            listener = self.__watch_listening(listener, listen_timeout)
+        if Tracing.is_enabled():
+            listener = self.__trace_first_report(series, listener, direction, role)
+        self.__readers.append(self.__capture.attach(source, log, listener))
+    #} End method __attach
+
+    def __watch_listening(self, feed, timeout): #{
+        # Wraps the parser's feed, to set an event once the server says it is listening:
+        listening = Event()
+        self.__listening.append((listening, timeout))
+        def listener(data):
+            feed(data)
+            if not listening.is_set() and 'listening' in data: listening.set()
+        return listener
+    #} End method __watch_listening
+
+    def __set_start_skew(self, direction, skew): #{
+        # Only the first start of a phase counts (not the restart of a phase on a UE's new address):
+        for series in self.__phase_series:
+            if series.direction == direction and series.start_skew is None: series.start_skew = skew
+    #} End method __set_start_skew
+
+    def __span(self, name, **tags): #{
+        return Tracing.span(name, ue=self.ue, phase=self.__test_config['phase'], **tags)
+    #} End method __span
+
+    def __trace_first_report(self, series, feed, direction, role): #{
+        # Wraps the parser's feed, to trace the time from the start of the process to its first interval report:
+        trace = self.__span('first.report', direction=direction, role=role)
+        rows = len(series)
+        def listener(data):
+            feed(data)
+            if len(series) > rows: trace.end()
+        return listener
+    #} End method __trace_first_report
+#} End class UEPhase
+
+
+def spawn_local(command): #{
+    '''
+    Starts a local iperf (or native engine) command, and returns its Popen (or NativeStream)
+    '''
+    # Commands for the native traffic engine look like iperf commands, but with 'native' as the program name:
+    if command.startswith('native '):
+        return TrafficEngine.spawn(command)
+    if sys.platform == 'win32':
+        return subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,bufsize=0)
+    # Everywhere else the command line has to be split into arguments, and the other processes' pipes must not be
+    # inherited (or their output would never end until this process had ended too):
+    return subprocess.Popen(shlex.split(command),stdout=subprocess.PIPE,stderr=subprocess.STDOUT,bufsize=0,close_fds=True)
+#} End method spawn_local
@@ -0,0 +1,313 @@
+'''
+The Load Test Script - VERSION 1.0 - MAY 2014
+
+Change history:
+Version 0.1 - Jan 2014 - Basic UDP testing implemented. No logging
+Version 1.0 - May 2014 - Full re-write of TestInstance, included support for logging and TCP tests and Ctrl-C test cancellation
+
+loadtest.WorkerPool spreads the UEs of a test over several worker processes, each pinned to its own CPU core, so that a
+single test host can drive many more interfaces before the CPU gets in the way of the measured throughput.
+
+WorkerPool.py implements the WorkerPool class and methods, as well as the run_worker process target method.
+'''
+
+import os
+import sys
+import logging
+import multiprocessing
+from Queue import Empty
+from threading import Thread, Event
+
+from loadtest.SSHPool import SSHPool
+from loadtest.RemoteProcesses import RemoteProcesses
+from loadtest.StreamCapture import StreamCapture
+from loadtest.ThroughputSeries import ThroughputSeries, SeriesStore
+from loadtest.UEPhase import UEPhase
+from loadtest.RunEngine import RunEngine
+from loadtest import Tracing
+
+# Seconds between the batches of new interval reports (and phase states) each worker sends to the parent:
+STREAM_INTERVAL = 1.0
+
+
+class WorkerPool(object): #{
+    '''
+    class WorkerPool(object):
+    Sub-class of:                    object
+    Private instance variables:
+        __workers = Number of worker processes to use
+        __pin = Whether to pin each worker process to its own CPU core
+        __use_agents = Whether each worker runs its remote processes through process agents (see ProcessAgent.py)
+        __compression = Compression of the iperf logs each worker writes (see StreamCapture.py)
+        __is_tracing = Whether the workers trace their stages and send their traces back (see Tracing.py)
+        __scope = Scope of the workers' PID files on the test servers (see RemoteProcesses.py)
+        __interrupt = multiprocessing.Event shared with all the workers, set on Ctrl-C (by any of the processes)
+        __reports = List of the SSH pool reports of the workers, in worker order
+        __phase_states = Dictionary of worker index to the list of (ue, phase, state) tuples it last sent
+
+    Overview:
+    The phases of the test (the (test_config, is_dl, is_ul) tuples built by TestInstance) are sharded by UE, so all the
+    phases of a UE run in the same worker. Each worker pins itself to a core (worker n to core n, wrapping round if
+    there are more workers than cores), then connects its own SSH pool, runs its own capture stage and run engine, and
+    writes its own logs. Local iperf processes inherit the affinity of the worker that starts them.
+    The parent only coordinates: it waits until every worker has connected to its servers, releases them all at the
+    same moment, and then collects each worker's throughput series when it has finished.
+    While the test runs, each worker sends the new interval reports of its series, and the states of its phases, every
+    STREAM_INTERVAL seconds, and they are added to the series store as they come in. So the results database and the
+    metrics (see MetricsExporter.py) are as live as without workers. The series a worker sends when it has finished
+    replaces what was streamed, so the results are always complete.
+    Ctrl-C reaches every process in the console, and any process that sees it sets the shared interrupt event, so all the
+    workers tear down their phases as interrupted.
+
+    Public methods:
+    run(self, phase_specs, is_logging, series, on_ready=None):
+    Runs the phases on the workers and adds every worker's throughput series to the series store. on_ready is called
+    once every worker is connected, and the workers are released when it returns.
+    Returns True if the test ran to completion and False if it was interrupted.
+
+    get_report(self):
+    Returns the SSH pool reports of all the workers.
+
+    get_phase_states(self):
+    Returns a (ue, phase, state) tuple for every phase the workers have reported, as last sent (called on the metrics
+    threads).
+
+    '''
+
+    def __init__(self, workers, pin=True, use_agents=False, compression='off', is_tracing=False, scope=None): #{
+        '''
+        Constructor:
+            workers = number of worker processes
+            pin = pin each worker to a core
+            use_agents = start a process agent on each test server in each worker
+            compression = compression of the iperf logs (see StreamCapture.py)
+            is_tracing = trace the stages of each worker, and add them to this process's trace
+            scope = scope of the workers' PID files on the test servers, the same as the parent's
+        '''
+        self.__workers = workers
+        self.__pin = pin
+        self.__use_agents = use_agents
+        self.__compression = compression
+        self.__is_tracing = is_tracing
+        self.__scope = scope
+        self.__interrupt = multiprocessing.Event()
+        self.__reports = []
+        self.__phase_states = {}
+    #} End method __init__
+
+    def run(self, phase_specs, is_logging, series, on_ready=None): #{
+        # Shard by UE, so that every phase of a UE runs in the same worker:
+        ues = []
+        for test_config, _, _ in phase_specs:
+            if test_config['ue'] not in ues: ues.append(test_config['ue'])
+        workers = max(1, min(self.__workers, len(ues)))
+        shards = [[] for _ in range(workers)]
+        for spec in phase_specs:
+            shards[ues.index(spec[0]['ue']) % workers].append(spec)
+
+        cores = multiprocessing.cpu_count()
+        go = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = []
+        for index in range(workers):
+            core = index % cores if self.__pin else None
+            process = multiprocessing.Process(target=run_worker,
+                                              args=(index, core, shards[index], is_logging, go, self.__interrupt, results,
+                                                    self.__use_agents, self.__compression, self.__is_tracing,
+                                                    self.__scope))
+            process.name = 'worker-' + str(index)
+            processes.append(process)
+            process.start()
+        logging.debug('Started ' + str(workers) + ' workers for ' + str(len(ues)) + ' UEs')
+
+        # None until the worker has finished:
+        reports = [None] * workers
+        ready = 0
+        done = 0
+        try:
+            while done < workers:
+                try:
+                    # Time out now and again so Ctrl-C gets through, and so a dead worker doesn't hang the test:
+                    message = results.get(timeout=0.5)
+                except Empty:
+                    if not [p for p in processes if p.is_alive()] and results.empty():
+                        logging.warning('All workers have exited, ' + str(workers - done) + ' without results')
+                        break
+                    if ready < workers and not go.is_set() and [p for p in processes if not p.is_alive()]:
+                        # A worker died before it was ready, so the others would wait for it for ever:
+                        self.__abort_start('A worker has exited before it was ready', go)
+                    continue
+                if message[0] == 'intervals':
+                    _, index, rows, states = message
+                    # Anything still in flight once the worker's whole series has come in is already in it:
+                    if reports[index] is not None: continue
+                    for key, key_rows in rows:
+                        one_series = series.get_series(*key)
+                        for row in key_rows: one_series.append(*row)
+                    self.__phase_states[index] = states
+                elif message[0] == 'ready':
+                    ready += 1
+                    # Every worker is connected, so start them all together:
+                    if ready == workers:
+                        if on_ready is not None: on_ready()
+                        go.set()
+                elif message[0] == 'done':
+                    _, index, worker_series, reports[index], events = message
+                    for one_series in worker_series: series.add_series(one_series)
+                    Tracing.add_events(events)
+                    done += 1
+                    if ready < workers and not go.is_set():
+                        # The worker failed before it was ready (see its error above), so the others would wait for it
+                        # for ever:
+                        self.__abort_start('worker-' + str(index) + ' has finished before it was ready', go)
+        except KeyboardInterrupt:
+            # The workers get the Ctrl-C as well, but make sure they all stop:
+            self.__interrupt.set()
+            go.set()
+            logging.warning('Process interrupted by user, waiting for the workers to tear down...\n')
+            while done < workers and [p for p in processes if p.is_alive()]:
+                try:
+                    message = results.get(timeout=0.5)
+                except Empty:
+                    continue
+                except KeyboardInterrupt:
+                    continue
+                if message[0] == 'done':
+                    _, index, worker_series, reports[index], events = message
+                    for one_series in worker_series: series.add_series(one_series)
+                    Tracing.add_events(events)
+                    done += 1
+        for process in processes:
+            process.join()
+        self.__reports = [report or '' for report in reports]
+        return not self.__interrupt.is_set()
+    #} End method run
+
+    def get_report(self): #{
+        return ''.join(self.__reports)
+    #} End method get_report
+
+    def get_phase_states(self): #{
+        return [state for index in sorted(self.__phase_states.keys()) for state in self.__phase_states[index]]
+    #} End method get_phase_states
+
+    def __abort_start(self, reason, go): #{
+        # Releases the workers that are waiting for the start, as interrupted, so they tear down and finish:
+        logging.warning(reason + ', stopping the test')
+        self.__interrupt.set()
+        go.set()
+    #} End method __abort_start
+#} End class WorkerPool
+
+
+def run_worker(index, core, phase_specs, is_logging, go, interrupt, results, use_agents=False, compression='off',
+               is_tracing=False, scope=None): #{
+    '''
+    Worker process target: runs the given phases with a pool, capture stage and run engine of its own.
+    Always ends by sending 'done', even if it fails, so that the parent never waits for a worker that isn't there.
+    '''
+    series = SeriesStore()
+    pool = None
+    try:
+        if is_tracing: Tracing.enable()
+        if core is not None: pin_to_core(core)
+        pool = SSHPool()
+        remote = RemoteProcesses(pool, scope)
+        capture = StreamCapture(compression=compression)
+        engine = RunEngine(interrupt)
+        phases = []
+        for test_config, is_dl, is_ul in phase_specs:
+            phases.append(UEPhase(remote, capture, series, test_config, is_dl, is_ul, is_logging))
+            engine.schedule(phases[-1])
+
+        with Tracing.span('ssh.warm'):
+            pool.warm([test_config['ftpserver'] for test_config, _, _ in phase_specs])
+        if use_agents:
+            with Tracing.span('agents.start'):
+                remote.start_agents([test_config['ftpserver'] for test_config, _, _ in phase_specs])
+        capture.start()
+        try:
+            # Get the first phases ready, then wait for all the other workers to be ready too (polling, so that Ctrl-C
+            # gets through):
+            with Tracing.span('phases.prepare'):
+                engine.prepare()
+            results.put(('ready', index))
+            try:
+                while not go.wait(0.1): pass
+            except KeyboardInterrupt:
+                # The engine tears down the prepared phases as interrupted:
+                interrupt.set()
+            stop = Event()
+            streamer = Thread(target=stream_loop, args=[index, series, phases, results, stop])
+            streamer.setName('worker-stream')
+            streamer.setDaemon(True)
+            streamer.start()
+            try:
+                engine.run()
+            finally:
+                # Stopped before 'done' is sent, so nothing streamed can arrive after it:
+                stop.set()
+                streamer.join()
+        finally:
+            remote.teardown()
+            capture.stop()
+            pool.close_all()
+    except KeyboardInterrupt:
+        interrupt.set()
+    finally:
+        results.put(('done', index, series.get_all_series(), pool.get_report() if pool is not None else '',
+                     Tracing.get_events()))
+#} End method run_worker
+
+
+def stream_loop(index, series_store, phases, results, stop): #{
+    '''
+    Worker thread: sends the new interval reports of the worker's series, and the states of its phases, to the parent
+    every STREAM_INTERVAL seconds until stop is set
+    '''
+    names = [name for name, _ in ThroughputSeries.COLUMNS]
+    written = {}
+    while not stop.wait(STREAM_INTERVAL):
+        rows = []
+        for series in series_store.get_all_series():
+            key = (series.ue, series.phase, series.direction, series.role)
+            # The capture threads append to the columns one at a time, and stream is always the last, so every column
+            # has at least this many entries:
+            count = len(series.columns['stream'])
+            first = written.get(key, 0)
+            if count <= first: continue
+            rows.append((key, [[series.columns[name][row] for name in names] for row in xrange(first, count)]))
+            written[key] = count
+        states = [(phase.ue, phase.get_test_config()['phase'], phase.get_state()) for phase in phases]
+        results.put(('intervals', index, rows, states))
+#} End method stream_loop
+
+
+def pin_to_core(core): #{
+    '''
+    Pins the current process (and so every process it starts from now on) to a single CPU core.
+    Uses psutil if it is installed, otherwise the native call for the platform.
+    '''
+    try:
+        import psutil
+        psutil.Process(os.getpid()).cpu_affinity([core])
+        return True
+    except ImportError:
+        pass
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, [core])
+        return True
+    if sys.platform == 'win32':
+        import win32api
+        import win32process
+        win32process.SetProcessAffinityMask(win32api.GetCurrentProcess(), 1 << core)
+        return True
+    if sys.platform.startswith('linux'):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        mask = ctypes.c_ulong(1 << core)
+        if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) == 0: return True
+    logging.warning('Could not pin worker to core ' + str(core))
+    return False
+#} End method pin_to_core